@@ -12,12 +12,29 @@ python -m serial.tools.list_ports
 Needs Arduino installed (to get USB drivers)
 """
 
+import os
 import sys
 import glob
+import json
 import serial
+import serial.tools.list_ports
 import io
 import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+#seconds to wait for a target to answer SCORE
+SCORE_TIMEOUT = 0.5
+
+#USB (VID, PID) of the Teensy 3.2 boards in the targets and bots (USB Type: Serial)
+PIXY_USB_IDS = [(0x16C0, 0x0483)]
+#both firmwares answer VERSION the same way; the first line of HELP tells them apart
+FIRMWARE_KINDS = {"Pixy Battle Target": 'target', "Pixy Battle Bot": 'bot'}
+#seconds to wait for a port to answer VERSION and HELP
+HANDSHAKE_TIMEOUT = 1.0
+#where discover_devices() remembers what it found
+PORT_CACHE = os.path.join(os.path.expanduser('~'), '.pixybattle-ports.json')
 
 
 def serial_ports():
@@ -49,6 +66,112 @@ def serial_ports():
     return result
 
 
+class Device(object):
+    """ What answered on a serial port: kind is 'target', 'bot' or None
+        for something that didn't answer like a Pixy Battle board
+    """
+    def __init__(self, port, kind, version, usbSerial=None):
+        self.port = port
+        self.kind = kind
+        self.version = version
+        self.usbSerial = usbSerial
+
+    def to_json(self):
+        return {'kind': self.kind, 'version': self.version, 'usbSerial': self.usbSerial}
+
+    def __repr__(self):
+        return "Device(%s, %s, %s)" % (self.port, self.kind, self.version)
+
+
+def usb_candidates(usbIds=PIXY_USB_IDS):
+    """ Lists the serial ports whose USB VID/PID could be a Pixy Battle
+        board, from the operating system's device list, without opening
+        any of them
+
+        :returns:
+            A list of (port name, USB serial number) pairs
+    """
+    return [(info.device, info.serial_number) for info in serial.tools.list_ports.comports()
+            if (info.vid, info.pid) in usbIds]
+
+
+def identify_port(portID, timeout=HANDSHAKE_TIMEOUT):
+    """ Asks whatever is on a port for VERSION and HELP
+
+        :returns:
+            A Device, whose kind is None if the answer wasn't recognised
+    """
+    try:
+        ser = serial_open(portID)
+    except (OSError, serial.SerialException):
+        return Device(portID, None, None)
+    try:
+        ser.reset_input_buffer()
+        ser.write(b'VERSION\r\nHELP\r\n')
+        ser.flush()
+        kind = version = None
+        deadline = time.monotonic() + timeout
+        while (kind is None or version is None) and time.monotonic() < deadline:
+            line = str(ser.readline().rstrip(),"utf-8","replace")
+            if line in FIRMWARE_KINDS:
+                kind = FIRMWARE_KINDS[line]
+            elif version is None and line.isdigit():
+                version = line
+        return Device(portID, kind, version)
+    except (OSError, serial.SerialException):
+        return Device(portID, None, None)
+    finally:
+        serial_close(ser)
+
+
+def load_port_cache(cacheFile=PORT_CACHE):
+    try:
+        with open(cacheFile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_port_cache(devices, cacheFile=PORT_CACHE):
+    try:
+        with open(cacheFile, 'w') as f:
+            #ports that didn't answer may just have been busy, so they are asked again next time
+            json.dump(dict((port, d.to_json()) for port, d in devices.items() if d.kind), f, indent=2)
+    except IOError as err:
+        print("Couldn't save the port cache: ", err)
+
+
+def discover_devices(candidates=None, cacheFile=PORT_CACHE, refresh=False, timeout=HANDSHAKE_TIMEOUT):
+    """ Finds the Pixy Battle targets and bots plugged in. Only ports
+        with a Teensy's USB VID/PID are considered, and those are asked
+        for VERSION and HELP all at once. A port is only asked again if
+        the board on it has changed since the last run (a different USB
+        serial number), so usually no port is opened at all.
+
+        :returns:
+            A dict of port name to Device
+    """
+    if candidates is None:
+        candidates = usb_candidates()
+    cache = {} if refresh or not cacheFile else load_port_cache(cacheFile)
+    devices = {}
+    unknown = []
+    for port, usbSerial in candidates:
+        cached = cache.get(port)
+        if cached and usbSerial and cached.get('usbSerial') == usbSerial:
+            devices[port] = Device(port, cached['kind'], cached['version'], usbSerial)
+        else:
+            unknown.append((port, usbSerial))
+    if unknown:
+        with ThreadPoolExecutor(max_workers=len(unknown)) as pool:
+            found = pool.map(lambda port: identify_port(port, timeout), [port for port, usbSerial in unknown])
+            for device, (port, usbSerial) in zip(found, unknown):
+                device.usbSerial = usbSerial
+                devices[port] = device
+        if cacheFile:
+            save_port_cache(devices, cacheFile)
+    return devices
+
 
 def serial_open(portID):
     ser = serial.Serial()
@@ -87,12 +210,133 @@ def target_get_version(ser):
     ser.flush()
     return str(ser.readline().rstrip(),"utf-8") 
   
-def target_get_score(ser):
+def parse_score(line):
+    """ Parses one line of a target's answer to SCORE
+
+        :returns:
+            ('RED' or 'BLUE', (#1st hits, #2nd hits, #final)), or None
+            for any other line
+    """
+    team, sep, counts = line.partition(':')
+    if not sep or team not in ('RED', 'BLUE'):
+        return None
+    try:
+        return team, tuple(int(c) for c in counts.split(','))
+    except ValueError:
+        return None
+
+def target_query_score(ser, timeout=SCORE_TIMEOUT):
+    """ Asks a target for its score. HIT and NEUTRAL lines the target
+        sends on its own may arrive before the answer; they are kept
+        rather than mistaken for it.
+
+        :returns:
+            The RED and BLUE lines (None if the target didn't answer in
+            time) and a list of the other lines read
+    """
     ser.write(b'SCORE\r\n')
-    scoreRed = str(p.readline().rstrip(),"utf-8")
-    scoreBlue = str(p.readline().rstrip(),"utf-8")
+    ser.flush()
+    deadline = time.monotonic() + timeout
+    score = {}
+    others = []
+    while len(score) < 2 and time.monotonic() < deadline:
+        line = str(ser.readline().rstrip(),"utf-8")
+        if not line:
+            continue
+        parsed = parse_score(line)
+        if parsed:
+            score[parsed[0]] = line
+        else:
+            others.append(line)
+    return score.get('RED'), score.get('BLUE'), others
+
+def target_get_score(ser):
+    scoreRed, scoreBlue, others = target_query_score(ser)
     return scoreRed, scoreBlue
 
+
+class TargetScore(object):
+    """ One target's answer to SCORE, and how long it took """
+    def __init__(self, port, scoreRed, scoreBlue, latency, others=(), error=None):
+        self.port = port
+        self.red = parse_score(scoreRed)[1] if scoreRed else None
+        self.blue = parse_score(scoreBlue)[1] if scoreBlue else None
+        self.latency = latency
+        self.others = list(others)
+        self.error = error
+
+    @property
+    def answered(self):
+        return self.red is not None and self.blue is not None
+
+
+class ScoreSnapshot(object):
+    """ The scores of every target from one polling round. All targets
+        are asked at the same moment, so the scores belong together.
+    """
+    def __init__(self, scores, taken, duration):
+        self.scores = scores
+        self.taken = taken
+        self.duration = duration
+
+    def totals(self):
+        """ Sum of the final hit counts over the targets that answered
+
+            :returns:
+                red, blue
+        """
+        red = sum(s.red[2] for s in self.scores if s.answered)
+        blue = sum(s.blue[2] for s in self.scores if s.answered)
+        return red, blue
+
+    def show(self):
+        for s in self.scores:
+            if s.error:
+                print("%-14s error: %s" % (s.port, s.error))
+            elif not s.answered:
+                print("%-14s no answer in %.0fms" % (s.port, s.latency * 1000))
+            else:
+                print("%-14s RED %s  BLUE %s  (%.1fms)" % (s.port, s.red, s.blue, s.latency * 1000))
+        red, blue = self.totals()
+        print("Total RED %d  BLUE %d  (%d targets polled in %.1fms)" %
+              (red, blue, len(self.scores), self.duration * 1000))
+
+
+class ScorePoller(object):
+    """ Polls the score of every target at once, one worker thread per
+        port, over connections opened with serial_open(). A refresh takes
+        as long as the slowest target instead of the sum of them all.
+    """
+    def __init__(self, ports, timeout=SCORE_TIMEOUT):
+        self.ports = ports
+        self.timeout = timeout
+        self.locks = [threading.Lock() for p in ports]
+        self.pool = ThreadPoolExecutor(max_workers=max(len(ports), 1))
+        self.polls = 0
+
+    def query(self, index):
+        ser = self.ports[index]
+        with self.locks[index]:
+            start = time.perf_counter()
+            try:
+                scoreRed, scoreBlue, others = target_query_score(ser, self.timeout)
+            except (OSError, serial.SerialException) as err:
+                return TargetScore(ser.port, None, None, time.perf_counter() - start, error=err)
+            return TargetScore(ser.port, scoreRed, scoreBlue, time.perf_counter() - start, others)
+
+    def poll(self):
+        """ :returns:
+                A ScoreSnapshot, once every target has answered or timed out
+        """
+        taken = time.time()
+        start = time.perf_counter()
+        scores = list(self.pool.map(self.query, range(len(self.ports))))
+        self.polls += 1
+        return ScoreSnapshot(scores, taken, time.perf_counter() - start)
+
+    def close(self):
+        self.pool.shutdown()
+
 #open all ports
 #start all targets
 #wait 3 minutes and periodically display score
@@ -100,11 +344,34 @@ def target_get_score(ser):
 #get final score
 #close all ports    
 if __name__ == '__main__':
-    portsList = serial_ports()    
+    parser = argparse.ArgumentParser(description='Runs a game on every target and shows the score')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to play') #CHANGE TO: 3 * 60.0
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between score updates')
+    parser.add_argument('--fake', type=int, default=0, metavar='N',
+                        help='play against N emulated targets on ptys instead (see emulator.py)')
+    parser.add_argument('--scan', action='store_true',
+                        help='try to open every serial port instead of looking for Teensy boards')
+    parser.add_argument('--rediscover', action='store_true',
+                        help='ask every Teensy board what it is, ignoring %s' % PORT_CACHE)
+    args = parser.parse_args()
+
+    arena = None
+    if args.fake:
+        import emulator
+        arena = emulator.Arena()
+        portsList = [arena.add_target(hitRate=30.0, seed=i).port for i in range(args.fake)]
+    elif args.scan:
+        portsList = serial_ports()    
+    else:
+        start = time.perf_counter()
+        devices = discover_devices(refresh=args.rediscover)
+        print("Found in %.0fms: " % ((time.perf_counter() - start) * 1000),
+              sorted(devices.values(), key=lambda d: d.port))
+        portsList = sorted(port for port, d in devices.items() if d.kind == 'target')
     print("Available: ", portsList) 
     
     #remove COM1 (first port) for WINDOWS OS
-    if sys.platform.startswith('win'):    
+    if sys.platform.startswith('win') and args.scan:    
         portsList.pop(0)
 
     #open all COM ports
@@ -117,38 +384,41 @@ if __name__ == '__main__':
 
     print()
     
-    #start all targets    
+    #start all targets, then give them all one second to settle
     for p in ports:    
         target_reset(p)
         target_start(p)   
-        time.sleep(1);
+    time.sleep(1);
+    for p in ports:    
         p.reset_input_buffer();
         #target_get_version(ser)
         #serial_send_text(ser, "HELP")
         #serial_read_text(ser)  
       
     #wait 3 minutes and periodically display score
-    timeStart = time.clock() 
-    timeStop = timeStart + 10.0 #CHANGE TO: 3 * 60.0
-    while (time.clock() < timeStop):
-        print(time.clock() - timeStart)
+    poller = ScorePoller(ports)
+    timeStart = time.monotonic() 
+    timeStop = timeStart + args.duration
+    while (time.monotonic() < timeStop):
+        print(time.monotonic() - timeStart)
         
-        for p in ports:
-            print (target_get_score(p))
+        poller.poll().show()
 
         print()        
-        time.sleep(1);
+        time.sleep(args.interval);
     
     #stop all targets 
     for p in ports:    
         target_stop(p)
         
     #get final score
-    for p in ports:  
-        print("Target on port: ", p.port)
-        print (target_get_score(p))    
+    print("Final score")
+    poller.poll().show()
+    poller.close()
 
     #close all COM ports
     for p in ports:       
         serial_close(p)
+    if arena:
+        arena.close()
     
\ No newline at end of file
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Emulated Pixy Battle targets and bots on pseudo terminals, for trying
+SerialTest.py, lasertag.py and circle.py without any hardware (Linux and
+macOS only).
+
+Each emulated board opens a pty and speaks the serial protocol of its
+firmware on it (PixyTarget1.ino or PixyBattle2.ino). Its port can be
+opened with serial_open() like a real one. One thread serves every board
+of an Arena, so hundreds of them are cheap.
+
+Run an arena and leave it up for the robots to connect to:
+python emulator.py --targets 20 --bots 2
+
+Load test the score poller against 200 emulated targets:
+python emulator.py --targets 200 --bench
+"""
+
+import os
+import pty
+import tty
+import sys
+import time
+import random
+import argparse
+import selectors
+import threading
+
+VERSION = "20170612"
+
+#PixyTarget1 timings [sec]
+TARGET_LOOP = 0.2           #both sides listen for RX_WAIT_TIME each time round the loop
+TIMEOUT_TRIGGER = 1.0       #a side ignores hits for this long after changing state
+TIMEOUT_GO_NEUTRAL = 20.0   #a hit side goes back to green after this long
+#PixyBattle2 timings [sec]
+BOT_LOOP = 0.05
+FIRING_COOL_DOWN = 10 * BOT_LOOP
+FIRE_LOCK_OUT = 200 * BOT_LOOP
+
+TARGET_HELP = [
+    "Pixy Battle Target",
+    "TX:",
+    "  NEUTRAL,<LEFT/RIGHT>                   --> when going to default (green)",
+    "  HIT,<RED/BLUE,<LEFT/RIGHT>             --> when getting 1st or 2nd hit",
+    "  <RED/BLUE>:#1st hits,#2nd hits,#final  --> upon receiving 'SCORE' command",
+    "RX:",
+    "  START          --> starts the game",
+    "  STOP           --> stops the game",
+    "  SCORE          --> sends total hit counts",
+    "  TEST_RED       --> sets both sides to red",
+    "  TEST_BLUE      --> sets both sides to blue",
+    "  TEST_GREEN     --> sets both sides to green",
+    "  TEST_RED_BLUE  --> sets one side to red, one side to blue",
+    "  TEST_BLUE_HIT\t --> Simulate a blue hit to both sides",
+    "  TEST_RED_HIT\t --> Simulate a red hit to both sides",
+    "  TEST_BLACK     --> Simulate no LED on both sides",
+    "  RESET          --> reset target (ready to receive 'START')",
+    "  HELP           --> list of commands",
+    "  VERSION        --> code version",
+    "",
+]
+
+BOT_HELP = [
+    "Pixy Battle Bot",
+    "TX:",
+    "  <RED/BLUE>     --> upon receiving 'TEAM?' command",
+    "RX:",
+    "  FIRE           --> to fire IR pulses",
+    "  TEAM           --> to display team color",
+    "  HELP           --> list of commands",
+    "  VERSION        --> code version",
+    "",
+]
+
+
+class Board(object):
+    """ One emulated board on a pty. Commands are answered delay seconds
+        after they arrive. With noise > 0 that fraction of the lines sent
+        is garbled or has a garbage line sent ahead of it.
+    """
+    loopTime = 0.0
+
+    def __init__(self, delay=0.0, hitRate=0.0, noise=0.0, seed=None):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.delay = delay
+        self.hitRate = hitRate
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.buffer = b''
+        self.outbox = []
+        self.commands = 0
+        self.linesSent = 0
+        self.garbled = 0
+        self.hitsTaken = 0
+
+    def send(self, line, now):
+        self.outbox.append((now + self.delay, line))
+
+    def send_due(self, now):
+        while self.outbox and self.outbox[0][0] <= now:
+            line = self.outbox.pop(0)[1]
+            data = line.encode("utf-8")
+            if self.noise and self.random.random() < self.noise:
+                self.garbled += 1
+                if data and self.random.random() < 0.5:
+                    i = self.random.randrange(len(data))
+                    data = data[:i] + bytes([self.random.randrange(33, 127)]) + data[i + 1:]
+                else:
+                    data = bytes(self.random.randrange(33, 127) for i in range(8)) + b'\r\n' + data
+            try:
+                os.write(self.master, data + b'\r\n')
+                self.linesSent += 1
+            except OSError:
+                #nobody is reading and the pty is full
+                pass
+
+    def receive(self, now):
+        try:
+            self.buffer += os.read(self.master, 4096)
+        except OSError:
+            return
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            self.commands += 1
+            self.handle(str(line.strip(), "utf-8", "replace"), now)
+
+    def chance(self, rate, dt):
+        """ True with the probability of an event happening rate times
+            a minute happening within dt seconds
+        """
+        return rate and self.random.random() < rate / 60.0 * dt
+
+    def handle(self, command, now):
+        pass
+
+    def tick(self, now, dt):
+        pass
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class EmulatedTarget(Board):
+    """ A PixyTarget1 target: two sides that go green on START, turn the
+        colour of the team that hits them, and go back to green after
+        TIMEOUT_GO_NEUTRAL. A side only counts a hit TIMEOUT_TRIGGER after
+        its last change. With hitLines=False the HIT lines are left out,
+        as the 20170612 firmware does.
+    """
+    loopTime = TARGET_LOOP
+
+    def __init__(self, delay=TARGET_LOOP, hitRate=0.0, noise=0.0, seed=None, hitLines=True):
+        Board.__init__(self, delay, hitRate, noise, seed)
+        self.hitLines = hitLines
+        self.state = {'LEFT': 'IDLE', 'RIGHT': 'IDLE'}
+        self.colour = {'LEFT': None, 'RIGHT': None}
+        self.changed = {'LEFT': 0.0, 'RIGHT': 0.0}
+        self.first = {'RED': 0, 'BLUE': 0}
+        self.second = {'RED': 0, 'BLUE': 0}
+
+    def set_state(self, side, state, now, team=None):
+        if state == 'NEUTRAL':
+            if self.state[side] == 'IDLE':
+                self.first = {'RED': 0, 'BLUE': 0}
+                self.second = {'RED': 0, 'BLUE': 0}
+            self.colour[side] = None
+            self.send("NEUTRAL,%s" % side, now)
+        elif state == 'HIT':
+            self.colour[side] = team
+            if self.hitLines:
+                self.send("HIT,%s,%s" % (team, side), now)
+        self.state[side] = state
+        self.changed[side] = now
+
+    def hit(self, side, team, now):
+        """ An IR hit from team on one side, counted if the side is
+            playing and ready for it
+        """
+        if now - self.changed[side] < TIMEOUT_TRIGGER:
+            return
+        if self.state[side] == 'NEUTRAL':
+            self.first[team] += 1
+        elif self.state[side] == 'HIT' and self.colour[side] != team:
+            self.second[team] += 1
+        else:
+            return
+        self.hitsTaken += 1
+        self.set_state(side, 'HIT', now, team)
+
+    def handle(self, command, now):
+        if command == "START":
+            for side in ('LEFT', 'RIGHT'):
+                if self.state[side] == 'IDLE':
+                    self.set_state(side, 'NEUTRAL', now)
+        elif command == "STOP":
+            for side in ('LEFT', 'RIGHT'):
+                self.set_state(side, 'IDLE', now)
+        elif command == "SCORE":
+            for team in ('RED', 'BLUE'):
+                final = list(self.colour.values()).count(team)
+                self.send("%s:%d,%d,%d" % (team, self.first[team], self.second[team], final), now)
+        elif command in ("TEST_RED", "TEST_BLUE", "TEST_GREEN", "TEST_RED_BLUE", "TEST_BLACK"):
+            for side in ('LEFT', 'RIGHT'):
+                self.state[side] = 'NONE'
+        elif command in ("TEST_RED_HIT", "TEST_BLUE_HIT"):
+            for side in ('LEFT', 'RIGHT'):
+                self.hit(side, command.split('_')[1], now)
+        elif command == "RESET":
+            for side in ('LEFT', 'RIGHT'):
+                self.set_state(side, 'IDLE', now)
+        elif command == "VERSION":
+            self.send(VERSION, now)
+        elif command == "HELP":
+            for line in TARGET_HELP:
+                self.send(line, now)
+
+    def tick(self, now, dt):
+        for side in ('LEFT', 'RIGHT'):
+            if self.state[side] == 'HIT' and now - self.changed[side] > TIMEOUT_GO_NEUTRAL:
+                self.set_state(side, 'NEUTRAL', now)
+            if self.chance(self.hitRate / 2.0, dt):
+                self.hit(side, self.random.choice(('RED', 'BLUE')), now)
+
+
+class EmulatedBot(Board):
+    """ A PixyBattle2 bot's IR board: FIRE is ignored while cooling down
+        or locked out, and being hit sends HIT and locks it out for
+        FIRE_LOCK_OUT
+    """
+    loopTime = BOT_LOOP
+
+    def __init__(self, team='RED', delay=BOT_LOOP, hitRate=0.0, noise=0.0, seed=None):
+        Board.__init__(self, delay, hitRate, noise, seed)
+        self.team = team
+        self.coolDownUntil = 0.0
+        self.lockedOutUntil = 0.0
+        self.fired = 0
+
+    def handle(self, command, now):
+        if command == "FIRE":
+            if now >= self.coolDownUntil and now >= self.lockedOutUntil:
+                self.fired += 1
+                self.coolDownUntil = now + FIRING_COOL_DOWN
+        elif command == "TEAM":
+            self.send(self.team, now)
+        elif command == "HELP":
+            for line in BOT_HELP:
+                self.send(line, now)
+        elif command == "VERSION":
+            self.send(VERSION, now)
+
+    def tick(self, now, dt):
+        if now >= self.lockedOutUntil and self.chance(self.hitRate, dt):
+            self.hitsTaken += 1
+            self.lockedOutUntil = now + FIRE_LOCK_OUT
+            self.send("HIT", now)
+
+
+class Arena(object):
+    """ Serves any number of emulated boards from one background thread """
+    def __init__(self, tick=0.01):
+        self.boards = []
+        self.tickTime = tick
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, board):
+        with self.lock:
+            self.boards.append(board)
+            self.selector.register(board.master, selectors.EVENT_READ, board)
+        return board
+
+    def add_target(self, **kwargs):
+        return self.add(EmulatedTarget(**kwargs))
+
+    def add_bot(self, **kwargs):
+        return self.add(EmulatedBot(**kwargs))
+
+    def run(self):
+        last = time.monotonic()
+        while self.running:
+            for key, events in self.selector.select(self.tickTime):
+                with self.lock:
+                    key.data.receive(time.monotonic())
+            now = time.monotonic()
+            with self.lock:
+                for board in self.boards:
+                    board.tick(now, now - last)
+                    board.send_due(now)
+            last = now
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        with self.lock:
+            for board in self.boards:
+                self.selector.unregister(board.master)
+                board.close()
+        self.selector.close()
+
+    def report(self):
+        print("Arena: %d boards, %d commands, %d lines sent (%d garbled), %d hits" %
+              (len(self.boards), sum(b.commands for b in self.boards), sum(b.linesSent for b in self.boards),
+               sum(b.garbled for b in self.boards), sum(b.hitsTaken for b in self.boards)))
+
+
+def build_arena(args):
+    arena = Arena()
+    targets = []
+    for i in range(args.targets):
+        targets.append(arena.add_target(delay=TARGET_LOOP if args.delay is None else args.delay,
+                                        hitRate=args.target_hits, noise=args.noise, seed=i))
+    bots = []
+    for i in range(args.bots):
+        bots.append(arena.add_bot(team=('RED', 'BLUE')[i % 2], delay=BOT_LOOP if args.delay is None else args.delay,
+                                  hitRate=args.bot_hits, noise=args.noise, seed=1000 + i))
+    return arena, targets, bots
+
+
+def serve(args, conn):
+    """ Runs an arena in a child process, sending back the target ports
+        and stopping when told to
+    """
+    arena, targets, bots = build_arena(args)
+    conn.send([t.port for t in targets])
+    conn.recv()
+    arena.report()
+    arena.close()
+
+
+def bench(portsList, delay, rounds):
+    """ Times a score refresh of every target, asking them one after
+        another and all at once
+    """
+    import SerialTest
+
+    ports = [SerialTest.serial_open(p) for p in portsList]
+    for p in ports:
+        SerialTest.target_start(p)
+    time.sleep(TARGET_LOOP * 2)
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        for p in ports:
+            SerialTest.target_get_score(p)
+    sequential = (time.perf_counter() - start) / rounds
+
+    poller = SerialTest.ScorePoller(ports)
+    start = time.perf_counter()
+    for i in range(rounds):
+        snapshot = poller.poll()
+    concurrent = (time.perf_counter() - start) / rounds
+    poller.close()
+
+    latencies = sorted(s.latency for s in snapshot.scores)
+    red, blue = snapshot.totals()
+    print("%d targets answering in %.0fms:" % (len(ports), delay * 1000))
+    print("  one at a time: %8.1fms per refresh" % (sequential * 1000))
+    print("  concurrently:  %8.1fms per refresh" % (concurrent * 1000))
+    print("  latency: median %.1fms, max %.1fms" % (latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+    print("  %d targets didn't answer, score RED %d BLUE %d" %
+          (sum(not s.answered for s in snapshot.scores), red, blue))
+    for p in ports:
+        SerialTest.serial_close(p)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulates Pixy Battle targets and bots on pseudo terminals')
+    parser.add_argument('--targets', type=int, default=10)
+    parser.add_argument('--bots', type=int, default=0)
+    parser.add_argument('--delay', type=float, help='seconds a board takes to answer (default: its loop time)')
+    parser.add_argument('--target-hits', type=float, default=30.0, help='hits per minute on each target')
+    parser.add_argument('--bot-hits', type=float, default=2.0, help='hits per minute on each bot')
+    parser.add_argument('--noise', type=float, default=0.0, help='fraction of lines sent garbled')
+    parser.add_argument('--ports-file', metavar='FILE', help='write "kind port" for each board to FILE')
+    parser.add_argument('--bench', action='store_true', help='time score polling against the targets, then exit')
+    parser.add_argument('--rounds', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.bench:
+        #pyserial waits on its ports with select(), which can't go past
+        #file descriptor 1024, so the arena's ptys are kept in another process
+        import multiprocessing
+        conn, childConn = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=serve, args=(args, childConn))
+        child.start()
+        bench(conn.recv(), TARGET_LOOP if args.delay is None else args.delay, args.rounds)
+        conn.send('stop')
+        child.join()
+        sys.exit(0)
+
+    arena, targets, bots = build_arena(args)
+    lines = ["target %s" % t.port for t in targets] + ["bot %s %s" % (b.port, b.team) for b in bots]
+    if args.ports_file:
+        with open(args.ports_file, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+    print("Ctrl-C to stop")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    arena.report()
+    arena.close()
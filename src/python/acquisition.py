@@ -0,0 +1,132 @@
+import time
+import threading
+
+import framewait
+
+class Frame(object):
+    """
+    One published camera frame.  blocks is one of the grabber's
+    pre-allocated BlockArrays and stays valid until the next call
+    to FrameGrabber.next_frame().
+    """
+    def __init__(self, blocks, count, seq, stamp):
+        self.blocks = blocks
+        self.count = count
+        self.seq = seq
+        self.stamp = stamp
+
+class FrameGrabber(threading.Thread):
+    """
+    Owns the camera on a background thread.  Each new frame is read into
+    a free pre-allocated BlockArray and then published as the latest frame
+    with a sequence number and capture timestamp, so the control loop never
+    waits on USB.
+
+    Buffers alternate between the thread and the published slot; a third
+    one is kept for the frame the control loop is still reading, so
+    publishing never has to wait for the consumer.
+
+    Servo and brightness writes are queued here too and issued between
+    frames, so only this thread ever talks to libpixyusb.
+    """
+    def __init__(self, source, size, wait_mode='backoff', wait_budget=framewait.WAIT_BUDGET):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.m_source = source
+        self.m_size = size
+        self.m_buffers = [source.BlockArray(size) for i in range(3)]
+        self.m_waiter = framewait.FrameWaiter(source, wait_mode, wait_budget)
+        self.m_cond = threading.Condition()
+        self.m_running = True
+        self.m_published = None
+        self.m_held = None
+        self.m_seq = 0
+        self.m_commands = {}
+        self.m_frame = None
+        self.m_brightness = source.pixy_cam_get_brightness()
+        self.m_lastTaken = 0
+        self.captured = 0
+        self.taken = 0
+        self.dropped = 0
+
+    def _running(self):
+        return self.m_running
+
+    def _free_buffer(self):
+        for i in range(len(self.m_buffers)):
+            if i != self.m_published and i != self.m_held:
+                return i
+
+    def run(self):
+        source = self.m_source
+        while self.m_running:
+            if not self.m_waiter.wait(self._running):
+                break
+            with self.m_cond:
+                commands = self.m_commands
+                self.m_commands = {}
+                index = self._free_buffer()
+            for key, value in commands.items():
+                if key == 'brightness':
+                    source.pixy_cam_set_brightness(value)
+                    self.m_brightness = value
+                else:
+                    source.pixy_rcs_set_position(key, value)
+            count = source.pixy_get_blocks(self.m_size, self.m_buffers[index])
+            stamp = time.time()
+            with self.m_cond:
+                self.m_seq += 1
+                self.m_published = index
+                self.m_frame = Frame(self.m_buffers[index], count, self.m_seq, stamp)
+                self.captured += 1
+                self.m_cond.notify_all()
+
+    def next_frame(self, last_seq, running=None, timeout=0.1):
+        """
+        Return the newest frame with a sequence number above last_seq,
+        waiting for one if needed.  Returns None if running() goes false
+        or the grabber is stopped first.
+        """
+        with self.m_cond:
+            while self.m_seq <= last_seq:
+                if not self.m_running or (running is not None and not running()):
+                    return None
+                self.m_cond.wait(timeout)
+            frame = self.m_frame
+            self.m_held = self.m_published
+            if self.m_lastTaken:
+                self.dropped += frame.seq - self.m_lastTaken - 1
+            self.m_lastTaken = frame.seq
+            self.taken += 1
+            return frame
+
+    @property
+    def seq(self):
+        return self.m_seq
+
+    def pixy_rcs_set_position(self, channel, pos):
+        with self.m_cond:
+            self.m_commands[channel] = pos
+        return 0
+
+    def pixy_cam_set_brightness(self, brightness):
+        with self.m_cond:
+            self.m_commands['brightness'] = brightness
+        return 0
+
+    def pixy_cam_get_brightness(self):
+        with self.m_cond:
+            return self.m_commands.get('brightness', self.m_brightness)
+
+    def stop(self):
+        with self.m_cond:
+            self.m_running = False
+            self.m_cond.notify_all()
+        if self.is_alive():
+            self.join(1.0)
+
+    def report(self):
+        # anything captured after the last frame we took was never used either
+        unused = self.dropped + self.m_seq - self.m_lastTaken
+        print "Acquisition: %d frames captured, %d used, %d dropped" % (self.captured, self.taken, unused)
+        self.m_waiter.report()
@@ -0,0 +1,98 @@
+import time
+
+# default write suppression thresholds, in motor driver and servo units
+MOTOR_THRESHOLD = 2
+SERVO_THRESHOLD = 1
+
+class Channel(object):
+    """
+    Decides whether a new value for one actuator is worth writing: it must
+    differ from the last written value by at least threshold, and at least
+    interval seconds must have passed since the last write.
+    """
+    def __init__(self, name, threshold=0, interval=0):
+        self.name = name
+        self.m_threshold = threshold
+        self.m_interval = interval
+        self.m_last = None
+        self.m_lastTime = 0
+        self.issued = 0
+        self.suppressed = 0
+
+    def wanted(self, values, force=False):
+        now = time.time() if self.m_interval else 0
+        if not force and self.m_last is not None:
+            change = max(abs(a - b) for a, b in zip(values, self.m_last))
+            if change == 0 or change < self.m_threshold or now - self.m_lastTime < self.m_interval:
+                self.suppressed += 1
+                return False
+        self.m_last = values
+        self.m_lastTime = now
+        self.issued += 1
+        return True
+
+    def report(self):
+        total = self.issued + self.suppressed
+        if total:
+            print "Output %s: %d writes issued, %d suppressed (%.0f%%)" % \
+                (self.name, self.issued, self.suppressed, 100.0 * self.suppressed / total)
+
+class MotorOutput(object):
+    """
+    Sits in front of the motor driver and drops redundant setSpeeds calls.
+    Stopping (0, 0) always goes straight through.
+    """
+    def __init__(self, motors, threshold=MOTOR_THRESHOLD, interval=0):
+        self.m_motors = motors
+        self.m_channel = Channel('motors', threshold, interval)
+
+    def __getattr__(self, name):
+        return getattr(self.m_motors, name)
+
+    def setSpeeds(self, left, right):
+        stop = left == 0 and right == 0
+        if self.m_channel.wanted((left, right), stop):
+            self.m_motors.setSpeeds(left, right)
+
+    def report(self):
+        self.m_channel.report()
+
+class ServoOutput(object):
+    """
+    Sits in front of the camera and drops redundant pixy_rcs_set_position
+    calls, each of which is a USB round trip to the Pixy.  Everything
+    else is passed straight to the camera.
+    """
+    def __init__(self, camera, threshold=SERVO_THRESHOLD, interval=0):
+        self.m_camera = camera
+        self.m_threshold = threshold
+        self.m_interval = interval
+        self.m_channels = {}
+
+    def __getattr__(self, name):
+        return getattr(self.m_camera, name)
+
+    def pixy_rcs_set_position(self, channel, pos):
+        if channel not in self.m_channels:
+            self.m_channels[channel] = Channel('servo %d' % channel, self.m_threshold, self.m_interval)
+        if self.m_channels[channel].wanted((pos,)):
+            return self.m_camera.pixy_rcs_set_position(channel, pos)
+        return 0
+
+    def report(self):
+        for channel in sorted(self.m_channels):
+            self.m_channels[channel].report()
+
+def add_arguments(parser):
+    parser.add_argument('--no-coalesce', dest='coalesce', action='store_false',
+                        help='write every motor and servo command, even repeats')
+    parser.set_defaults(coalesce=True)
+    parser.add_argument('--motor-threshold', dest='motor_threshold', type=int,
+                        help='smallest motor speed change worth writing')
+    parser.set_defaults(motor_threshold=MOTOR_THRESHOLD)
+    parser.add_argument('--servo-threshold', dest='servo_threshold', type=int,
+                        help='smallest servo position change worth writing')
+    parser.set_defaults(servo_threshold=SERVO_THRESHOLD)
+    parser.add_argument('--write-interval', dest='write_interval', type=float,
+                        help='least ms between writes to the same motor or servo')
+    parser.set_defaults(write_interval=0)
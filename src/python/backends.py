@@ -0,0 +1,307 @@
+import math
+import time
+import random
+
+import startup
+import framewait
+
+# signature ids the simulated camera makes up (same as racer.py)
+OBSTACLE = 1
+CENTER_LINE = 2
+LEFT_LINE = 3
+RIGHT_LINE = 4
+
+##### cameras
+
+def pixy_camera(options):
+    from pixy import pixy
+    return pixy
+
+def init_camera(camera, deadline=startup.RETRY_DEADLINE):
+    """
+    pixy_init() the camera, retrying while it is still enumerating on
+    USB, and hand it back ready for setup()
+    """
+    def attempt():
+        status = camera.pixy_init()
+        if status != 0:
+            raise IOError("pixy_init() [%d]" % status)
+    startup.retry(attempt, "Starting the camera", deadline)
+    return camera
+
+class NullPixy(object):
+    """
+    A camera that always has a new, empty frame
+    """
+    def BlockArray(self, size):
+        return (framewait.Blocks * size)()
+
+    def pixy_init(self):
+        return 0
+
+    def pixy_close(self):
+        pass
+
+    def pixy_error(self, code):
+        print "Camera error %d" % code
+
+    def pixy_blocks_are_new(self):
+        return 1
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        return 0
+
+    def pixy_cam_get_brightness(self):
+        return 0
+
+    def pixy_cam_set_brightness(self, brightness):
+        return 0
+
+    def pixy_rcs_set_position(self, channel, pos):
+        return 0
+
+class SimPixy(NullPixy):
+    """
+    Makes up frames of a gently curving track: center line blocks below
+    the horizon with the edge lines either side, and a signature 1 target
+    drifting across the view.  With a frame_rate of 0 every call gets a
+    new frame, which is what the benchmarks want.
+    """
+    def __init__(self, frame_rate=framewait.PIXY_FRAME_RATE):
+        self.m_period = 1.0 / frame_rate if frame_rate else 0
+        self.m_start = time.time()
+        self.m_served = -1
+        self.m_frame = 0
+        self.m_brightness = 0
+
+    def _latest(self):
+        if not self.m_period:
+            return self.m_served + 1
+        return int((time.time() - self.m_start) / self.m_period)
+
+    def pixy_blocks_are_new(self):
+        return 1 if self._latest() > self.m_served else 0
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        self.m_served = self._latest()
+        self.m_frame += 1
+        drift = math.sin(self.m_frame / 50.0)
+        frame = [
+            (0, OBSTACLE, int(160 + 120 * drift), 90, 12, 12, 0),
+            (0, CENTER_LINE, int(160 + 60 * drift), 180, 20, 10, 0),
+            (0, CENTER_LINE, int(160 + 90 * drift), 120, 14, 8, 0),
+            (0, LEFT_LINE, int(40 + 60 * drift), 170, 16, 10, 0),
+            (0, RIGHT_LINE, int(280 + 60 * drift), 170, 16, 10, 0),
+        ]
+        count = min(len(frame), max_blocks)
+        for i in range(count):
+            block = blocks[i]
+            (block.type, block.signature, block.x, block.y,
+             block.width, block.height, block.angle) = frame[i]
+        return count
+
+    def pixy_cam_get_brightness(self):
+        return self.m_brightness
+
+    def pixy_cam_set_brightness(self, brightness):
+        self.m_brightness = brightness
+        return 0
+
+def scripted_camera(options):
+    if not options.replay:
+        raise ValueError("the scripted camera plays back --replay FILE")
+    import recorder
+    return recorder.ReplayPixy(options.replay, options.on_end)
+
+CAMERAS = {
+    'pixy': pixy_camera,
+    'null': lambda options: NullPixy(),
+    'sim': lambda options: SimPixy(),
+    'scripted': scripted_camera,
+}
+
+##### motor drivers
+
+def pololu_motors(options):
+    from pololu_drv8835_rpi import motors
+    return motors
+
+class NullMotors(object):
+    """
+    A motor driver that goes nowhere
+    """
+    def setSpeeds(self, left, right):
+        pass
+
+class SimMotors(object):
+    """
+    Integrates the speed commands into a rough pose (mm and radians) for
+    a differential drive robot, speeds being in the driver's -480..480
+    units.
+    """
+    def __init__(self, mm_per_unit=1.0, track_width=120.0):
+        self.m_mmPerUnit = mm_per_unit
+        self.m_track = track_width
+        self.m_speeds = (0, 0)
+        self.m_last = time.time()
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.commands = 0
+
+    def _integrate(self):
+        now = time.time()
+        dt = now - self.m_last
+        self.m_last = now
+        left = self.m_speeds[0] * self.m_mmPerUnit
+        right = self.m_speeds[1] * self.m_mmPerUnit
+        self.heading += (right - left) / self.m_track * dt
+        self.x += (left + right) / 2 * math.cos(self.heading) * dt
+        self.y += (left + right) / 2 * math.sin(self.heading) * dt
+
+    def setSpeeds(self, left, right):
+        self._integrate()
+        self.m_speeds = (left, right)
+        self.commands += 1
+
+def scripted_motors(options):
+    if not options.replay:
+        raise ValueError("the scripted motors check commands against --replay FILE")
+    import recorder
+    return recorder.ReplayMotors(options.camera_backend)
+
+MOTORS = {
+    'pololu': pololu_motors,
+    'null': lambda options: NullMotors(),
+    'sim': lambda options: SimMotors(),
+    'scripted': scripted_motors,
+}
+
+##### IR serial links
+
+def serial_link(options):
+    import serial
+    return startup.retry(lambda: serial.Serial(options.device, options.baud),
+                         "Opening serial device %s" % options.device, options.retry_deadline)
+
+class NullLink(object):
+    """
+    An IR board that never gets hit
+    """
+    in_waiting = 0
+
+    def readline(self):
+        return ''
+
+    def write(self, data):
+        return len(data)
+
+class ScriptedLink(NullLink):
+    """
+    Plays back lines from a script file, one 'seconds line' pair per row,
+    each line arriving that many seconds after the link was opened.
+    """
+    def __init__(self, lines):
+        self.m_lines = sorted(lines)
+        self.m_start = time.time()
+        self.written = []
+
+    @property
+    def in_waiting(self):
+        if self.m_lines and time.time() - self.m_start >= self.m_lines[0][0]:
+            return len(self.m_lines[0][1]) + 1
+        return 0
+
+    def readline(self):
+        if not self.in_waiting:
+            return ''
+        return self.m_lines.pop(0)[1] + '\n'
+
+    def write(self, data):
+        self.written.append(data)
+        return len(data)
+
+class SimLink(ScriptedLink):
+    """
+    Gets hit at random, on average hit_rate times a minute
+    """
+    def __init__(self, hit_rate=2.0, seed=None):
+        rng = random.Random(seed)
+        lines = []
+        t = 0.0
+        while t < 3600:
+            t += rng.expovariate(hit_rate / 60.0)
+            lines.append((t, 'HIT'))
+        ScriptedLink.__init__(self, lines)
+
+def scripted_link(options):
+    if not options.link_script:
+        raise ValueError("the scripted link needs --link-script FILE")
+    lines = []
+    with open(options.link_script) as f:
+        for row in f:
+            row = row.strip()
+            if row and not row.startswith('#'):
+                seconds, line = row.split(None, 1)
+                lines.append((float(seconds), line))
+    return ScriptedLink(lines)
+
+LINKS = {
+    'serial': serial_link,
+    'null': lambda options: NullLink(),
+    'sim': lambda options: SimLink(),
+    'scripted': scripted_link,
+}
+
+class Options(object):
+    """
+    Settings the backend factories may need, for building backends
+    without going through argparse (benchmarks, simulations)
+    """
+    def __init__(self, replay=None, on_end=None, link_script=None, device='/dev/ttyACM0', baud=9600,
+                 retry_deadline=startup.RETRY_DEADLINE):
+        self.replay = replay
+        self.on_end = on_end
+        self.link_script = link_script
+        self.device = device
+        self.baud = baud
+        self.retry_deadline = retry_deadline
+        self.camera_backend = None
+
+def open_camera(name, options):
+    options.camera_backend = CAMERAS[name](options)
+    return options.camera_backend
+
+def open_motors(name, options):
+    return MOTORS[name](options)
+
+def open_link(name, options):
+    return LINKS[name](options)
+
+def add_arguments(parser, camera=True, link=False):
+    # --record and --replay are here so the scripts need not import
+    # recorder.py unless one is given
+    parser.add_argument('--record', dest='record', metavar='FILE',
+                        help='append every frame and motor/servo command to FILE')
+    parser.add_argument('--replay', dest='replay', metavar='FILE',
+                        help='run the loop on a recording instead of the hardware')
+    if camera:
+        parser.add_argument('--camera', dest='camera', choices=sorted(CAMERAS.keys()),
+                            help='camera backend (scripted plays back --replay)')
+        parser.set_defaults(camera='pixy')
+    parser.add_argument('--motors', dest='motors', choices=sorted(MOTORS.keys()),
+                        help='motor driver backend (scripted checks commands against --replay)')
+    parser.set_defaults(motors='pololu')
+    if link:
+        parser.add_argument('--link', dest='link', choices=sorted(LINKS.keys()),
+                            help='IR serial link backend')
+        parser.set_defaults(link='serial')
+        parser.add_argument('--link-script', dest='link_script', metavar='FILE',
+                            help="lines for the scripted link, one 'seconds line' per row")
+        parser.add_argument('--link-device', dest='link_device', metavar='PORT',
+                            help='serial port of the IR board, e.g. an emulated one (SerialTest/emulator.py)')
+
+def options_from(args, on_end=None, device='/dev/ttyACM0', baud=9600):
+    device = getattr(args, 'link_device', None) or device
+    return Options(getattr(args, 'replay', None), on_end, getattr(args, 'link_script', None), device, baud,
+                   getattr(args, 'retry_deadline', startup.RETRY_DEADLINE))
@@ -0,0 +1,77 @@
+"""
+Times the robot control loops on a dev machine, with the camera, motor
+driver and IR link swapped for backends that need no hardware.
+
+    python bench.py racer --iterations 5000
+    python bench.py lasertag --camera null
+"""
+import os
+import sys
+import time
+import argparse
+
+import backends
+
+def quietly(fn, *args):
+    """
+    Call fn with whatever it prints thrown away
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return fn(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def time_calls(fn, iterations):
+    """
+    Seconds per call of fn
+    """
+    def run():
+        start = time.time()
+        for i in range(iterations):
+            fn()
+        return time.time() - start
+    return quietly(run) / iterations
+
+# the controller class each robot script defines
+CONTROLLERS = {'racer': 'Racer', 'lasertag': 'LaserTag', 'circle': 'Circle'}
+
+def prepare(name, camera):
+    """
+    Import a robot script, build its controller with hardware-free
+    backends and set it up
+    """
+    module = __import__(name)
+    robot = getattr(module, CONTROLLERS[name])()
+    options = backends.Options()
+    if hasattr(robot, 'pixy'):
+        if camera == 'sim':
+            # unclocked, so the loop never waits for a frame
+            robot.pixy = backends.SimPixy(frame_rate=0)
+        else:
+            robot.pixy = backends.open_camera(camera, options)
+    robot.motors = backends.open_motors('null', options)
+    if hasattr(robot, 'ser'):
+        robot.ser = backends.open_link('null', options)
+    quietly(robot.setup)
+    return robot
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-iteration cost of loop() and drive() without hardware')
+    parser.add_argument('script', choices=['racer', 'lasertag', 'circle'])
+    parser.add_argument('--camera', choices=['null', 'sim'], default='sim',
+                        help='null never sees anything, sim sees a made up track')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    robot = prepare(args.script, args.camera)
+
+    loop_cost = time_calls(robot.loop, args.iterations)
+    drive_cost = time_calls(robot.drive, args.iterations)
+    # stops the IR reader thread lasertag and circle start
+    quietly(robot.close)
+    print "%s with %s camera, %d iterations (output discarded):" % (args.script, args.camera, args.iterations)
+    print "  loop():  %8.1f us" % (loop_cost * 1e6)
+    print "  drive(): %8.1f us" % (drive_cost * 1e6)
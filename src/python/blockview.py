@@ -0,0 +1,245 @@
+import sys
+import time
+import ctypes
+import argparse
+
+# imported by load_numpy() or the first BlockView or fit_path(), so the
+# plain Python path never pays for loading NumPy
+numpy = None
+# powers of t fit_path() takes moments of, and how small a determinant
+# (relative to the product of its diagonal) counts as rows too close
+# together to fit
+_EXPONENTS = None
+_SINGULAR = 1e-9
+
+def _import_numpy():
+    global numpy, _EXPONENTS
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            raise ImportError("numpy is needed for --numpy and --lookahead")
+        numpy = module
+        _EXPONENTS = numpy.arange(5.0)
+
+def load_numpy():
+    """
+    Import NumPy now, during setup, rather than stalling the first frame
+    that needs it
+    """
+    _import_numpy()
+
+def group_blocks(blocks, count, ignore):
+    """
+    Package the first count blocks per signature, skipping the ones
+    ignore() rejects.  This is the plain Python path.
+    """
+    blockmap = {}
+    for i in range(count):
+        block = blocks[i]
+        if ignore(block):
+            continue
+        if block.signature not in blockmap:
+            blockmap[block.signature] = []
+        blockmap[block.signature].append(block)
+    return blockmap
+
+def count_sides(blockmap, signature, x_center):
+    """
+    Count (left, right) blocks of a signature either side of x_center
+    """
+    right = 0
+    left = 0
+    for block in blockmap.get(signature, ()):
+        if block.x > x_center:
+            right += 1
+        else:
+            left += 1
+    return left, right
+
+def fit_path(blocks, order):
+    """
+    Weighted least squares fit of x against y through a signature's
+    blocks (a list of Blocks, or a record array from BlockView.group),
+    with bigger and nearer (lower in the image) blocks counting for more.
+    order 1 fits a line and 2 a curve; with too few rows to fit that, a
+    lower order is used.  Returns the fitted x at the nearest and the
+    furthest block rows.
+    """
+    _import_numpy()
+    if isinstance(blocks, numpy.ndarray):
+        x = blocks['x'].astype(float)
+        y = blocks['y'].astype(float)
+        area = blocks['width'] * blocks['height']
+    else:
+        data = numpy.array([(b.x, b.y, b.width * b.height) for b in blocks], dtype=float)
+        x, y, area = data.T
+    weight = (area + 1.0) * (y + 1.0)
+    near = y.max()
+    half = (near - y.min()) / 2.0
+    if half == 0:
+        # all on one row: the weighted mean
+        mean = weight.dot(x) / weight.sum()
+        return mean, mean
+    # rows centered and scaled to -1 (furthest) .. 1 (nearest), so the
+    # normal equations stay well conditioned however close the rows are
+    t = (y - (near - half)) / half
+    # every moment the normal equations need, in two dot products:
+    # m[k] = sum(w t^k) and r[k] = sum(w x t^k)
+    powers = t[:, None] ** _EXPONENTS
+    m = weight.dot(powers).tolist()
+    r = (weight * x).dot(powers[:, :3]).tolist()
+    if order >= 2:
+        # Cramer's rule on the 3x3 system
+        det = (m[0] * (m[2] * m[4] - m[3] * m[3]) - m[1] * (m[1] * m[4] - m[3] * m[2]) +
+               m[2] * (m[1] * m[3] - m[2] * m[2]))
+        if abs(det) > _SINGULAR * m[0] * m[2] * m[4]:
+            c0 = (r[0] * (m[2] * m[4] - m[3] * m[3]) - m[1] * (r[1] * m[4] - m[3] * r[2]) +
+                  m[2] * (r[1] * m[3] - m[2] * r[2])) / det
+            c1 = (m[0] * (r[1] * m[4] - m[3] * r[2]) - r[0] * (m[1] * m[4] - m[3] * m[2]) +
+                  m[2] * (m[1] * r[2] - r[1] * m[2])) / det
+            c2 = (m[0] * (m[2] * r[2] - r[1] * m[3]) - m[1] * (m[1] * r[2] - r[1] * m[2]) +
+                  r[0] * (m[1] * m[3] - m[2] * m[2])) / det
+            return c0 + c1 + c2, c0 - c1 + c2
+    if order >= 1:
+        det = m[0] * m[2] - m[1] * m[1]
+        if abs(det) > _SINGULAR * m[0] * m[2]:
+            c0 = (r[0] * m[2] - m[1] * r[1]) / det
+            c1 = (m[0] * r[1] - m[1] * r[0]) / det
+            return c0 + c1, c0 - c1
+    mean = r[0] / m[0]
+    return mean, mean
+
+def block_address(blocks):
+    """
+    Address of the first Block in a BlockArray.  Works for ctypes arrays
+    and for the SWIG BlockArray built by install.sh.
+    """
+    if isinstance(blocks, ctypes.Array):
+        return ctypes.addressof(blocks)
+    return int(blocks.this)
+
+class BlockView(object):
+    """
+    Views a BlockArray as a NumPy structured array laid out like the
+    Blocks ctypes struct, so a frame is filtered and grouped with a few
+    masked operations instead of a Python loop over every block.
+
+    The view is zero-copy: BlockArrays are allocated once and refilled
+    in place, so each buffer is mapped the first time it is seen.
+
+    NumPy has a fixed cost per call, so with Pixy's 10 block buffer the
+    Python path is usually still faster; run this file to compare.
+    """
+    def __init__(self, struct, size, horizon, lines, center_signature, x_center):
+        _import_numpy()
+        self.m_dtype = numpy.dtype([(name, numpy.uint32) for name, ctype in struct._fields_])
+        if self.m_dtype.itemsize != ctypes.sizeof(struct):
+            raise ValueError("Blocks struct is not a plain array of uints")
+        self.m_size = size
+        self.m_horizon = horizon
+        # Pixy signatures are 16 bit, so a lookup table marks the line ones
+        self.m_isLine = numpy.zeros(1 << 16, dtype=bool)
+        self.m_isLine[list(lines)] = True
+        self.m_center = center_signature
+        self.m_xCenter = x_center
+        self.m_views = {}
+        self.left = 0
+        self.right = 0
+
+    def view(self, blocks):
+        """
+        The whole BlockArray as a structured array
+        """
+        key = id(blocks)
+        view = self.m_views.get(key)
+        if view is None:
+            raw = (ctypes.c_char * (self.m_size * self.m_dtype.itemsize)).from_address(block_address(blocks))
+            # keep blocks alive as long as we hold a view of its memory
+            view = (blocks, numpy.frombuffer(raw, dtype=self.m_dtype))
+            self.m_views[key] = view
+        return view[1]
+
+    def group(self, blocks, count):
+        """
+        Same result as group_blocks() but each signature maps to a record
+        array, and the center line left/right counts are kept in
+        self.left and self.right.
+        """
+        frame = self.view(blocks)[:count]
+        # horizon filter: lines above the horizon are ignored
+        kept = frame[~((frame['y'] < self.m_horizon) & self.m_isLine[frame['signature']])]
+        # per signature grouping: one stable sort, then split wherever the signature changes
+        kept = kept[numpy.argsort(kept['signature'], kind='mergesort')].view(numpy.recarray)
+        signature = kept.signature
+        bounds = (numpy.flatnonzero(signature[1:] != signature[:-1]) + 1).tolist()
+        starts = [0] + bounds
+        ends = bounds + [len(kept)]
+        blockmap = {}
+        if len(kept):
+            sigs = signature[starts].tolist()
+            for i in range(len(starts)):
+                blockmap[sigs[i]] = kept[starts[i]:ends[i]]
+        center = blockmap.get(self.m_center)
+        if center is None:
+            self.left = self.right = 0
+        else:
+            self.right = int(numpy.count_nonzero(center.x > self.m_xCenter))
+            self.left = len(center) - self.right
+        return blockmap
+
+if __name__ == '__main__':
+    import framewait
+
+    parser = argparse.ArgumentParser(description='Compare the Python and NumPy block grouping paths')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    try:
+        _import_numpy()
+    except ImportError:
+        print "numpy is not installed"
+        sys.exit(1)
+
+    # fit_path() against numpy.polyfit, including rows nearly on top of
+    # each other where solving the plain normal equations goes wrong
+    rows = [(112, 136, 137), (100, 101, 102), (10, 60, 120, 180), (40, 40, 170), (90, 91)]
+    rng = numpy.random.RandomState(1)
+    worst = 0.0
+    for ys in rows:
+        for trial in range(100):
+            center = [framewait.Blocks() for y in ys]
+            for block, y in zip(center, ys):
+                block.x = rng.randint(0, 320)
+                block.y = y
+                block.width = rng.randint(1, 40)
+                block.height = rng.randint(1, 40)
+            x, y, area = numpy.array([(b.x, b.y, b.width * b.height) for b in center], dtype=float).T
+            order = min(2, len(set(ys)) - 1)
+            fit = numpy.polyfit(y, x, order, w=numpy.sqrt((area + 1.0) * (y + 1.0)))
+            expected = numpy.polyval(fit, [y.max(), y.min()])
+            worst = max(worst, abs(numpy.array(fit_path(center, 2)) - expected).max())
+    print "fit_path: within %.2g pixels of numpy.polyfit" % worst
+    assert worst < 1e-3
+
+    def ignore(block):
+        return block.y < 60 and block.signature in (2, 3, 4)
+
+    size = 10
+    blocks = (framewait.Blocks * size)()
+    bv = BlockView(framewait.Blocks, size, 60, (2, 3, 4), 2, 159)
+    for i in range(size):
+        blocks[i].signature = 2 + i % 5
+        blocks[i].x = 30 * i
+        blocks[i].y = 20 * i
+
+    for count in [0, 1, 5, 10]:
+        start = time.time()
+        for i in range(args.iterations):
+            count_sides(group_blocks(blocks, count, ignore), 2, 159)
+        python_cost = (time.time() - start) / args.iterations
+        start = time.time()
+        for i in range(args.iterations):
+            bv.group(blocks, count)
+        numpy_cost = (time.time() - start) / args.iterations
+        print "%2d blocks: python %6.1fus, numpy %6.1fus" % (count, python_cost * 1e6, numpy_cost * 1e6)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+
+# brightness range the camera accepts
+BRIGHTNESS_MIN = 0
+BRIGHTNESS_MAX = 255
+
+# first step away from the starting brightness when bracketing
+BRACKET_STEP = 8
+# how far either side of the start every brightness is tried before
+# giving up, as the racer always has
+WALK_RANGE = 20
+
+LIGHTING_FILE = 'lighting.json'
+DEFAULT_VENUE = 'default'
+
+def score(blockmap, weights, cap=3):
+    """
+    Sufficiency score for one frame: each signature in weights adds its
+    weight for every block seen, counting at most cap blocks of it.
+    """
+    if not blockmap:
+        return 0
+    total = 0
+    for signature, weight in weights.items():
+        if signature in blockmap:
+            total += weight * min(len(blockmap[signature]), cap)
+    return total
+
+class BrightnessCalibrator(object):
+    """
+    Finds a brightness with a good sufficiency score in a handful of frames.
+
+    measure(brightness) sets the camera brightness, grabs a fresh frame and
+    returns its score.  The search stops as soon as a frame scores target
+    or better.  Otherwise it brackets the peak by stepping away from the
+    start, doubling the step while the score keeps improving, and then
+    narrows the bracket with a ternary search.  Scores are assumed to rise
+    and then fall with brightness (too dark, then good, then washed out).
+    A window too narrow for that to find is caught by trying every
+    brightness within WALK_RANGE of the start, nearest first.
+    """
+    def __init__(self, measure, target, lo=BRIGHTNESS_MIN, hi=BRIGHTNESS_MAX, step=BRACKET_STEP):
+        self.m_measure = measure
+        self.target = target
+        self.m_lo = lo
+        self.m_hi = hi
+        self.m_step = step
+        self.m_scores = {}
+        self.last = None
+        self.frames = 0
+
+    def _score(self, brightness):
+        brightness = max(self.m_lo, min(self.m_hi, brightness))
+        if brightness not in self.m_scores:
+            self.m_scores[brightness] = self.m_measure(brightness)
+            self.last = brightness
+            self.frames += 1
+        return self.m_scores[brightness]
+
+    def _best(self):
+        return max(self.m_scores.items(), key=lambda item: item[1])
+
+    def _done(self):
+        return self._best()[1] >= self.target
+
+    def search(self, start):
+        """
+        Returns (brightness, score) of the best frame seen
+        """
+        self.m_scores = {}
+        self.frames = 0
+        start = max(self.m_lo, min(self.m_hi, start))
+        self._refine(start)
+        if self._best()[1] == 0:
+            self._sweep(start)
+        if not self._done():
+            self._walk(start)
+        return self._best()
+
+    def _sweep(self, start):
+        """
+        Nothing seen near the start: sweep outwards coarsely until
+        something shows up, then refine around it
+        """
+        stride = 2 * self.m_step
+        for offset in range(stride, self.m_hi - self.m_lo + stride, stride):
+            for brightness in (start + offset, start - offset):
+                if self.m_lo <= brightness <= self.m_hi and self._score(brightness) > 0:
+                    self._refine(brightness)
+                    return
+
+    def _walk(self, start):
+        for offset in range(1, WALK_RANGE + 1):
+            for brightness in (start + offset, start - offset):
+                if self.m_lo <= brightness <= self.m_hi:
+                    self._score(brightness)
+                    if self._done():
+                        return
+
+    def _refine(self, start):
+        base = self._score(start)
+        if self._done():
+            return
+
+        # bracket: try both sides, then keep going the way that got better
+        up = self._score(start + self.m_step)
+        if self._done():
+            return
+        down = self._score(start - self.m_step)
+        if self._done():
+            return
+        if up >= down:
+            direction = 1
+            current, current_score = start + self.m_step, up
+        else:
+            direction = -1
+            current, current_score = start - self.m_step, down
+        lo_edge, hi_edge = start - self.m_step, start + self.m_step
+        if current_score > base:
+            step = self.m_step
+            while self.m_lo < current < self.m_hi:
+                step *= 2
+                following = current + direction * step
+                following_score = self._score(following)
+                if self._done():
+                    return
+                if following_score <= current_score:
+                    break
+                current, current_score = following, following_score
+            if direction > 0:
+                lo_edge, hi_edge = current - step / 2, current + step
+            else:
+                lo_edge, hi_edge = current - step, current + step / 2
+        lo_edge = max(self.m_lo, lo_edge)
+        hi_edge = min(self.m_hi, hi_edge)
+
+        # narrow the bracket
+        while hi_edge - lo_edge > 2:
+            third = (hi_edge - lo_edge) / 3
+            left, right = lo_edge + third, hi_edge - third
+            if self._score(left) < self._score(right):
+                lo_edge = left
+            else:
+                hi_edge = right
+            if self._done():
+                return
+
+class LightingProfile(object):
+    """
+    Best known brightness per venue, kept in a small JSON file so later
+    runs start from a known-good value.
+    """
+    def __init__(self, path=LIGHTING_FILE, venue=DEFAULT_VENUE):
+        self.m_path = path
+        self.m_venue = venue
+        self.m_profiles = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.m_profiles = json.load(f)
+            except (IOError, ValueError), err:
+                print "Could not read lighting profile %s: %s" % (path, err)
+
+    @property
+    def brightness(self):
+        profile = self.m_profiles.get(self.m_venue)
+        if profile:
+            return profile['brightness']
+        return None
+
+    @property
+    def score(self):
+        profile = self.m_profiles.get(self.m_venue)
+        if profile:
+            return profile['score']
+        return 0
+
+    def save(self, brightness, score):
+        """
+        Remember brightness, and the score a frame got at it, for this
+        venue.  Called on every recovery from inside the control loop, so
+        the file is only rewritten when either has changed.
+        """
+        if brightness == self.brightness and score == self.score:
+            return
+        self.m_profiles[self.m_venue] = {
+            'brightness': brightness,
+            'score': score,
+            'updated': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        try:
+            with open(self.m_path, 'w') as f:
+                json.dump(self.m_profiles, f, indent=2, sort_keys=True)
+        except IOError, err:
+            print "Could not save lighting profile %s: %s" % (self.m_path, err)
+
+def add_arguments(parser):
+    parser.add_argument('--venue', dest='venue',
+                        help='lighting profile to start brightness calibration from')
+    parser.set_defaults(venue=DEFAULT_VENUE)
+    parser.add_argument('--lighting-file', dest='lighting_file',
+                        help='where lighting profiles are kept')
+    parser.set_defaults(lighting_file=LIGHTING_FILE)
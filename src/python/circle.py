@@ -1,45 +1,29 @@
-
 import time
 import sys
+import argparse
 import signal
-import ctypes
 import math
-import serial
 from datetime import datetime
-from pololu_drv8835_rpi import motors
+
+import backends
+import scheduler
+import actuators
+import irlink
+import startup
+import control
 
 serialDevice = '/dev/ttyACM0'
 baudRate = 9600
 
-while True:
-    try:
-        ser = serial.Serial(serialDevice, baudRate)
-        break
-    except:
-        print "Could not open serial device %s"%serialDevice
-        time.sleep(10)
-
 MAX_MOTOR_SPEED = 300#480
-MIN_MOTOR_SPEED = -480
-
-run_flag = 1
 
 # 20ms time interval for 50Hz
 dt = 20
 # check timeout dt*3
 timeout = 0.5
-currentTime = datetime.now()
-lastTime = datetime.now()
-
 
-#### defining motor function variables
-# 5% drive is deadband
-deadband = 0.05 * MAX_MOTOR_SPEED
-# totalDrive is the total power available
-totalDrive = MAX_MOTOR_SPEED
 # throttle is how much of the totalDrive to use [0~1]
 throttle = 0.7
-# differential drive level [0~1]
 # this is the drive level allocated for steering [0~1] dynamically modulate
 diffDrive = 0.3
 # this is the gain for scaling diffDrive
@@ -55,84 +39,114 @@ h_pgain = 0.5
 # body turning d-gain
 h_dgain = 0
 
-def handle_SIGINT(sig, frame):
+class Circle(object):
     """
-    Handle CTRL-C quit by setting run flag to false
-    This will break out of main loop and let you close
-    pixy gracefully
+    Roams around in circles and pauses when hit.  There is no camera; a
+    replay or recording (set from the command line) marks each step.
     """
-    global run_flag
-    run_flag = False
-
-
-def setup():
-    signal.signal(signal.SIGINT, handle_SIGINT)
-
-killed = False
-
-def loop():
-    """
-    Main loop, Gets blocks from pixy, analyzes target location,
-    chooses action for robot and sends instruction to motors
-    """
-    global throttle, diffDrive, diffGain, bias, advance, turnError, currentTime, lastTime, objectDist, distError, panError_prev, distError_prev, panLoop, killed
-
-    if ser.in_waiting:
-        print "reading line from serial.."
-        code = ser.readline().rstrip()
-        print "Got IR code %s" % code
-        killed = True
-
-    if killed:
-        motors.setSpeeds(0, 0)
-        time.sleep(5)
-
-    currentTime = datetime.now()
-    drive()
-    return run_flag
-
-def drive():
-    # synDrive is the drive level for going forward or backward (for both wheels)
-    synDrive = advance * (1 - diffDrive) * throttle * totalDrive
-    leftDiff = bias * diffDrive * throttle * totalDrive
-    rightDiff = -bias * diffDrive * throttle * totalDrive
-
-    # construct the drive levels
-    LDrive = (synDrive + leftDiff)
-    RDrive = (synDrive + rightDiff)
-
-    # Make sure that it is outside dead band and less than the max
-    if LDrive > deadband:
-        if LDrive > MAX_MOTOR_SPEED:
-            LDrive = MAX_MOTOR_SPEED
-    elif LDrive < -deadband:
-        if LDrive < -MAX_MOTOR_SPEED:
-            LDrive = -MAX_MOTOR_SPEED
-    else:
-        LDrive = 0
-
-    if RDrive > deadband:
-        if RDrive > MAX_MOTOR_SPEED:
-            RDrive = MAX_MOTOR_SPEED
-    elif RDrive < -deadband:
-        if RDrive < -MAX_MOTOR_SPEED:
-            RDrive = -MAX_MOTOR_SPEED
-    else:
-        RDrive = 0
-
-    # Actually Set the motors
-    motors.setSpeeds(int(LDrive), int(RDrive))
+    __slots__ = ('motors', 'ser', 'irReader', 'lockout', 'flag', 'motion', 'recording', 'replay', 'currentTime')
+
+    def __init__(self, motors=None, ser=None):
+        # hardware, picked from the command line (see backends.py)
+        self.motors = motors
+        self.ser = ser
+        self.irReader = None
+        self.lockout = irlink.Lockout()
+        self.flag = control.RunFlag()
+        self.motion = control.Drive(motors, MAX_MOTOR_SPEED, throttle, diffDrive, bias, advance)
+        self.recording = None
+        self.replay = None
+        self.currentTime = datetime.now()
+
+    def setup(self):
+        self.motion.motors = self.motors
+        if self.ser:
+            self.irReader = irlink.IRReader(self.ser)
+            self.irReader.start()
+        signal.signal(signal.SIGINT, self.flag.handle_SIGINT)
+
+    def loop(self):
+        """
+        Main loop, Gets blocks from pixy, analyzes target location,
+        chooses action for robot and sends instruction to motors
+        """
+        if self.replay and not self.replay.advance():
+            return self.flag.running
+        if self.recording:
+            # there is no camera, so record an empty frame to mark each step
+            self.recording.frame(0, None)
+
+        if self.irReader:
+            for event in self.irReader.events():
+                print "Got IR code %s" % event.line
+                if event.hit:
+                    self.lockout.hit(event.stamp)
+                    self.motors.setSpeeds(0, 0)
+
+        self.currentTime = datetime.now()
+        # pause while hit, then carry on roaming
+        if not self.lockout.active():
+            self.drive()
+        return self.flag.running
+
+    def drive(self):
+        self.motion.send()
+
+    def close(self):
+        if self.irReader:
+            self.irReader.stop()
+            self.irReader.report()
+        self.motors.setSpeeds(0, 0)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Roams around in circles and pauses when hit')
+    scheduler.add_arguments(parser, dt)
+    actuators.add_arguments(parser)
+    backends.add_arguments(parser, camera=False, link=True)
+    irlink.add_arguments(parser)
+    startup.add_arguments(parser)
+    args = parser.parse_args()
+    robot = Circle()
+    robot.lockout = irlink.Lockout(args.lockout)
+
+    options = backends.options_from(args, lambda: robot.flag.handle_SIGINT(None, None), serialDevice, baudRate)
+    if args.replay:
+        # the recording's frames only count the steps
+        robot.replay = backends.open_camera('scripted', options)
+        args.motors = 'scripted'
+        args.link = 'null'
+        # replays run flat out
+        args.period = 0
+    # bring the motor driver and IR board up side by side
+    boot = startup.Bringup()
+    boot.start('motors', lambda: backends.open_motors(args.motors, options))
+    boot.start('link', lambda: backends.open_link(args.link, options))
+    motors = boot.result('motors')
+    robot.ser = boot.result('link', required=False)
+    if args.record:
+        import recorder
+        robot.recording = recorder.Recorder(args.record)
+        motors = recorder.RecordingMotors(motors, robot.recording)
+    if args.coalesce:
+        motors = actuators.MotorOutput(motors, args.motor_threshold, args.write_interval / 1000.0)
+    robot.motors = motors
+
+    sched = scheduler.RateScheduler(args.period, args.overrun)
     try:
-        setup()
+        boot.step('setup', robot.setup)
+        boot.ready()
         while True:
-            ok = loop()
+            sched.tick()
+            ok = robot.loop()
             if not ok:
                 break
     finally:
-        motors.setSpeeds(0, 0)
+        robot.close()
+        sched.report()
+        if args.coalesce:
+            motors.report()
+        if robot.recording:
+            robot.recording.close()
+        if robot.replay:
+            robot.replay.report()
         print "Robot Shutdown Completed"
-
-
-
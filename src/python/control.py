@@ -0,0 +1,180 @@
+"""
+The control pieces racer.py, lasertag.py and circle.py share: Pixy and
+motor constants, the pan servo loop, the PID controller and the motor
+mixer.  State lives in __slots__ objects rather than module globals, so
+each robot script's controller is an instance and several can run side
+by side in one process (tracksim.py, tuning.py, bench.py).
+"""
+import framewait
+
+#### signature ids ####
+OBSTACLE = 1
+CENTER_LINE = 2
+LEFT_LINE = 3
+RIGHT_LINE = 4
+L_POST = 5
+R_POST = 6
+
+##### defining PixyCam sensory variables
+PIXY_MIN_X = 0
+PIXY_MAX_X = 319
+PIXY_MIN_Y = 0
+PIXY_MAX_Y = 199
+
+PIXY_X_CENTER = ((PIXY_MAX_X-PIXY_MIN_X) / 2)
+PIXY_Y_CENTER = ((PIXY_MAX_Y-PIXY_MIN_Y) / 2)
+PIXY_RCS_MIN_POS = 0
+PIXY_RCS_MAX_POS = 1000
+PIXY_RCS_CENTER_POS = ((PIXY_RCS_MAX_POS-PIXY_RCS_MIN_POS) / 2)
+BLOCK_BUFFER_SIZE = 10
+
+##### defining PixyCam motor variables
+PIXY_RCS_PAN_CHANNEL = 0
+PIXY_RCS_TILT_CHANNEL = 1
+
+MAX_MOTOR_SPEED = 480
+MIN_MOTOR_SPEED = -480
+# 5% drive is deadband
+DEADBAND = 0.05
+
+# block structure filled in by pixy_get_blocks()
+Blocks = framewait.Blocks
+
+class RunFlag(object):
+    """
+    Cleared by CTRL-C so the main loop can stop and close pixy gracefully;
+    calling it says whether to keep running
+    """
+    __slots__ = ('running',)
+
+    def __init__(self):
+        self.running = True
+
+    def handle_SIGINT(self, sig, frame):
+        self.running = False
+
+    def __call__(self):
+        return self.running
+
+class ServoLoop(object):
+    """
+    Loop to set pixy pan position
+    """
+    __slots__ = ('m_pos', 'm_prevError', 'm_pgain', 'm_dgain')
+
+    def __init__(self, pgain, dgain):
+        self.m_pos = PIXY_RCS_CENTER_POS
+        self.m_prevError = 0x80000000L
+        self.m_pgain = pgain
+        self.m_dgain = dgain
+
+    def update(self, error):
+        if self.m_prevError != 0x80000000:
+            vel = (error * self.m_pgain + (error - self.m_prevError) * self.m_dgain) >> 10
+            self.m_pos += vel
+            if self.m_pos > PIXY_RCS_MAX_POS:
+                self.m_pos = PIXY_RCS_MAX_POS
+            elif self.m_pos < PIXY_RCS_MIN_POS:
+                self.m_pos = PIXY_RCS_MIN_POS
+        self.m_prevError = error
+
+class PID(object):
+    """
+    Discrete PID control
+    """
+    __slots__ = ('Kp', 'Ki', 'Kd', 'Derivator', 'Integrator', 'Integrator_max', 'Integrator_min',
+                 'set_point', 'error')
+
+    def __init__(self, P=2.0, I=0.0, D=1.0, Derivator=0, Integrator=0, Integrator_max=500, Integrator_min=-500):
+        self.Kp=P
+        self.Ki=I
+        self.Kd=D
+        self.Derivator=Derivator
+        self.Integrator=Integrator
+        self.Integrator_max=Integrator_max
+        self.Integrator_min=Integrator_min
+        self.set_point=0.0
+        self.error=0.0
+
+    def update(self,current_value):
+        """
+        Calculate PID output value for given reference input and feedback
+        """
+        self.error = self.set_point - current_value
+        P_value = self.Kp * self.error
+        D_value = self.Kd * ( self.error - self.Derivator)
+        self.Derivator = self.error
+        self.Integrator = self.Integrator + self.error
+        if self.Integrator > self.Integrator_max:
+                self.Integrator = self.Integrator_max
+        elif self.Integrator < self.Integrator_min:
+                self.Integrator = self.Integrator_min
+        I_value = self.Integrator * self.Ki
+        return P_value + I_value + D_value
+
+    def setPoint(self,set_point):
+        """
+        Initilize the setpoint of PID
+        """
+        self.set_point = set_point
+        self.Integrator=0
+        self.Derivator=0
+
+class Drive(object):
+    """
+    Mixes the drive state into left and right motor speeds and sends them:
+    advance is the drive direction and magnitude [-1~1], throttle how much
+    of the total drive to use [0~1], diffDrive how much of that goes to
+    steering [0~1] and bias which way to steer [-1~1].  The deadband and
+    speed limits are worked out once, not on every call.
+    """
+    __slots__ = ('motors', 'throttle', 'diffDrive', 'bias', 'advance', 'levels',
+                 'm_total', 'm_deadband', 'm_max')
+
+    def __init__(self, motors, max_speed=MAX_MOTOR_SPEED, throttle=0, diffDrive=0, bias=0, advance=0):
+        self.motors = motors
+        self.throttle = throttle
+        self.diffDrive = diffDrive
+        self.bias = bias
+        self.advance = advance
+        # the last speeds sent
+        self.levels = (0, 0)
+        # totalDrive is the total power available
+        self.m_total = max_speed
+        self.m_deadband = DEADBAND * max_speed
+        self.m_max = int(max_speed)
+
+    def set(self, advance, throttle, diffDrive, bias):
+        self.advance = advance
+        self.throttle = throttle
+        self.diffDrive = diffDrive
+        self.bias = bias
+
+    def send(self):
+        """Mix the drive state into left and right speeds and send them"""
+        # multiplied out in the same order as the scripts always have, so
+        # int() truncates the speeds exactly as before
+        synDrive = self.advance * (1 - self.diffDrive) * self.throttle * self.m_total
+        diff = self.bias * self.diffDrive * self.throttle * self.m_total
+        LDrive = synDrive + diff
+        RDrive = synDrive - diff
+
+        # Make sure that it is outside dead band and less than the max
+        deadband = self.m_deadband
+        top = self.m_max
+        if LDrive > deadband:
+            LDrive = int(LDrive) if LDrive < top else top
+        elif LDrive < -deadband:
+            LDrive = int(LDrive) if LDrive > -top else -top
+        else:
+            LDrive = 0
+        if RDrive > deadband:
+            RDrive = int(RDrive) if RDrive < top else top
+        elif RDrive < -deadband:
+            RDrive = int(RDrive) if RDrive > -top else -top
+        else:
+            RDrive = 0
+        self.levels = (LDrive, RDrive)
+
+        # Actually Set the motors
+        self.motors.setSpeeds(LDrive, RDrive)
@@ -0,0 +1,188 @@
+import os
+import time
+import ctypes
+import argparse
+
+# Pixy streams blocks at 50 frames per second
+PIXY_FRAME_RATE = 50
+
+# default latency budget for noticing a new frame (ms)
+WAIT_BUDGET = 5
+# first sleep of the backoff schedule (ms)
+WAIT_MIN_SLEEP = 0.5
+
+WAIT_MODES = ['spin', 'sleep', 'backoff']
+
+def cpu_time():
+    """
+    CPU seconds (user + system) used by this process so far
+    """
+    t = os.times()
+    return t[0] + t[1]
+
+class Blocks(ctypes.Structure):
+    """
+    Block structure for use with getting blocks from
+    pixy.get_blocks()
+    """
+    _fields_ = [
+        ("type", ctypes.c_uint),
+        ("signature", ctypes.c_uint),
+        ("x", ctypes.c_uint),
+        ("y", ctypes.c_uint),
+        ("width", ctypes.c_uint),
+        ("height", ctypes.c_uint),
+        ("angle", ctypes.c_uint)
+    ]
+
+class FakePixy(object):
+    """
+    Clocked stand-in for the pixy module.  A new frame becomes available
+    every 1/frame_rate seconds; frames is an optional list of block lists
+    (each block a tuple of the Blocks fields) played round-robin.
+    """
+    def __init__(self, frame_rate=PIXY_FRAME_RATE, frames=None):
+        self.m_period = 1.0 / frame_rate
+        self.m_frames = frames or [[]]
+        self.m_start = time.time()
+        self.m_served = -1
+        self.m_brightness = 0
+        self.last_frame_time = None
+
+    def BlockArray(self, size):
+        return (Blocks * size)()
+
+    def _latest(self):
+        return int((time.time() - self.m_start) / self.m_period)
+
+    def pixy_blocks_are_new(self):
+        latest = self._latest()
+        if latest > self.m_served:
+            self.last_frame_time = self.m_start + latest * self.m_period
+            return 1
+        return 0
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        self.m_served = self._latest()
+        frame = self.m_frames[self.m_served % len(self.m_frames)]
+        count = min(len(frame), max_blocks)
+        for i in range(count):
+            block = blocks[i]
+            (block.type, block.signature, block.x, block.y,
+             block.width, block.height, block.angle) = frame[i]
+        return count
+
+    def pixy_cam_get_brightness(self):
+        return self.m_brightness
+
+    def pixy_cam_set_brightness(self, brightness):
+        self.m_brightness = brightness
+        return 0
+
+    def pixy_rcs_set_position(self, channel, pos):
+        return 0
+
+class FrameWaiter(object):
+    """
+    Waits for pixy_blocks_are_new() without pinning a CPU core.
+
+    spin    -- the original busy loop, kept for comparison
+    sleep   -- poll every budget ms
+    backoff -- poll after min_sleep ms, doubling up to budget ms
+
+    Either way a new frame is noticed at most budget ms after it lands.
+    """
+    def __init__(self, source, mode='backoff', budget=WAIT_BUDGET, min_sleep=WAIT_MIN_SLEEP):
+        if mode not in WAIT_MODES:
+            raise ValueError("Unknown wait mode '%s'" % mode)
+        self.m_source = source
+        self.m_mode = mode
+        self.m_budget = budget / 1000.0
+        self.m_minSleep = min(min_sleep, budget) / 1000.0
+        self.frames = 0
+        self.wait_time = 0.0
+        self.wait_cpu = 0.0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def wait(self, running=None):
+        """
+        Block until the source has a new frame.  Returns False if
+        running() went false before one arrived.
+        """
+        source = self.m_source
+        start = time.time()
+        start_cpu = cpu_time()
+        pause = self.m_minSleep if self.m_mode == 'backoff' else self.m_budget
+        polled = None
+        ok = True
+        while not source.pixy_blocks_are_new():
+            if running is not None and not running():
+                ok = False
+                break
+            polled = time.time()
+            if self.m_mode == 'spin':
+                continue
+            time.sleep(pause)
+            if self.m_mode == 'backoff':
+                pause = min(pause * 2, self.m_budget)
+        woke = time.time()
+        self.wait_time += woke - start
+        self.wait_cpu += cpu_time() - start_cpu
+        if not ok:
+            return False
+
+        # a frame that was already waiting costs no latency; otherwise it
+        # landed at worst just after the last empty poll.  The fake source
+        # knows exactly when.
+        frame_time = getattr(source, 'last_frame_time', None)
+        if frame_time is not None:
+            latency = max(0.0, woke - max(frame_time, start))
+        elif polled is not None:
+            latency = woke - polled
+        else:
+            latency = 0.0
+        self.frames += 1
+        self.last_latency = latency
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+        return True
+
+    @property
+    def cpu_saved(self):
+        """Seconds of CPU a spin loop would have burnt over the same waits"""
+        return self.wait_time - self.wait_cpu
+
+    def report(self):
+        if self.frames == 0:
+            print "Frame wait (%s): no frames" % self.m_mode
+            return
+        print "Frame wait (%s): %d frames, waited %.2fs, cpu used %.2fs, cpu saved %.2fs" % \
+            (self.m_mode, self.frames, self.wait_time, self.wait_cpu, self.cpu_saved)
+        print "Frame wait (%s): wake latency avg %.2fms, max %.2fms" % \
+            (self.m_mode, 1000.0 * self.total_latency / self.frames, 1000.0 * self.max_latency)
+
+def add_arguments(parser):
+    parser.add_argument('--wait', dest='wait', choices=WAIT_MODES,
+                        help='how to wait for new camera frames')
+    parser.set_defaults(wait='backoff')
+    parser.add_argument('--wait-budget', dest='wait_budget', type=float,
+                        help='max ms between a frame arriving and the loop waking')
+    parser.set_defaults(wait_budget=WAIT_BUDGET)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure frame wait modes against a fake 50Hz Pixy')
+    parser.add_argument('--frames', type=int, default=100)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    for mode in WAIT_MODES:
+        fake = FakePixy()
+        blocks = fake.BlockArray(10)
+        waiter = FrameWaiter(fake, mode, args.wait_budget)
+        for i in range(args.frames):
+            waiter.wait()
+            fake.pixy_get_blocks(10, blocks)
+        waiter.report()
@@ -0,0 +1,101 @@
+import time
+import threading
+from Queue import Queue, Empty
+
+# seconds a robot sits still after being hit
+HIT_LOCKOUT = 5.0
+# how long the reader rests when the link has nothing for it
+IDLE_SLEEP = 0.01
+
+class Event(object):
+    """
+    One line from the IR board, with the time it was read
+    """
+    def __init__(self, line, stamp):
+        self.line = line
+        self.stamp = stamp
+        self.hit = line == 'HIT'
+
+class IRReader(threading.Thread):
+    """
+    Reads lines from the IR board on a background thread and queues them
+    as Events, so the control loop never blocks in readline().  Writes
+    (FIRE) still go straight to the link from the control loop.
+    """
+    def __init__(self, link):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.m_link = link
+        self.m_queue = Queue()
+        self.m_running = True
+        self.lines = 0
+        self.hits = 0
+
+    def run(self):
+        while self.m_running:
+            try:
+                line = self.m_link.readline()
+            except Exception, err:
+                print "IR link failed:", err
+                return
+            if not line:
+                time.sleep(IDLE_SLEEP)
+                continue
+            event = Event(line.strip(), time.time())
+            self.lines += 1
+            if event.hit:
+                self.hits += 1
+            self.m_queue.put(event)
+
+    def events(self):
+        """
+        Every event read since the last call; never blocks
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.m_queue.get_nowait())
+            except Empty:
+                return events
+
+    def stop(self):
+        # a readline() already waiting on the serial port can't be
+        # interrupted, so only wait for it a while and leave the rest to
+        # the daemon thread
+        self.m_running = False
+        if self.is_alive():
+            self.join(1.0)
+
+    def report(self):
+        print "IR: %d lines read, %d hits" % (self.lines, self.hits)
+
+class Lockout(object):
+    """
+    The penalty for being hit: active for duration seconds after the
+    latest hit.  Hits during a lockout extend it.
+    """
+    def __init__(self, duration=HIT_LOCKOUT):
+        self.m_duration = duration
+        self.m_until = 0
+        self.hits = 0
+
+    def hit(self, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        self.hits += 1
+        self.m_until = max(self.m_until, stamp + self.m_duration)
+
+    def active(self, now=None):
+        if now is None:
+            now = time.time()
+        return now < self.m_until
+
+    def remaining(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(self.m_until - now, 0)
+
+def add_arguments(parser):
+    parser.add_argument('--lockout', dest='lockout', type=float,
+                        help='seconds to stay still after being hit')
+    parser.set_defaults(lockout=HIT_LOCKOUT)
@@ -1,77 +1,39 @@
-
 import time
 import sys
+import argparse
 import signal
-import ctypes
-import math
-import serial
 from datetime import datetime
-from pixy import pixy
-from pololu_drv8835_rpi import motors
+
+import backends
+import framewait
+import scheduler
+import actuators
+import irlink
+import latency
+import tracking
+import targeting
+import startup
+import control
+from control import (PIXY_MAX_X, PIXY_X_CENTER, PIXY_Y_CENTER, PIXY_RCS_MIN_POS, PIXY_RCS_MAX_POS, PIXY_RCS_CENTER_POS,
+                     BLOCK_BUFFER_SIZE, PIXY_RCS_PAN_CHANNEL, PIXY_RCS_TILT_CHANNEL, Blocks)
 
 serialDevice = '/dev/ttyACM0'
 baudRate = 9600
 
-while True:
-    try:
-        ser = serial.Serial(serialDevice, baudRate)
-        break
-    except:
-        print "Could not open serial device %s"%serialDevice
-        time.sleep(10)
-
-##### defining PixyCam sensory variables
-PIXY_MIN_X = 0
-PIXY_MAX_X = 319
-PIXY_MIN_Y = 0
-PIXY_MAX_Y = 199
-
-PIXY_X_CENTER = ((PIXY_MAX_X-PIXY_MIN_X) / 2)
-PIXY_Y_CENTER = ((PIXY_MAX_Y-PIXY_MIN_Y) / 2)
-PIXY_RCS_MIN_POS = 0
-PIXY_RCS_MAX_POS = 1000
-PIXY_RCS_CENTER_POS = ((PIXY_RCS_MAX_POS-PIXY_RCS_MIN_POS) / 2)
-BLOCK_BUFFER_SIZE = 10
-
-##### defining PixyCam motor variables
-PIXY_RCS_PAN_CHANNEL = 0
-PIXY_RCS_TILT_CHANNEL = 1
-
 PAN_PROPORTIONAL_GAIN = 400
 PAN_DERIVATIVE_GAIN = 300
 TILT_PROPORTIONAL_GAIN = 500
 TILT_DERIVATIVE_GAIN = 400
 
 MAX_MOTOR_SPEED = 300#480
-MIN_MOTOR_SPEED = -480
-
-run_flag = 1
 
 # 20ms time interval for 50Hz
 dt = 20
 # check timeout dt*3
 timeout = 0.5
-currentTime = datetime.now()
-lastTime = datetime.now()
-lastFire = lastTime
 
-#### defining motor function variables
-# 5% drive is deadband
-deadband = 0.05 * MAX_MOTOR_SPEED
-# totalDrive is the total power available
-totalDrive = MAX_MOTOR_SPEED
-# throttle is how much of the totalDrive to use [0~1]
-throttle = 0
-# differential drive level [0~1]
-diffDrive = 0
-# this is the drive level allocated for steering [0~1] dynamically modulate
-diffDrive = 0
 # this is the gain for scaling diffDrive
 diffGain = 1
-# this ratio determines the steering [-1~1]
-bias = 0
-# this ratio determines the drive direction and magnitude [-1~1]
-advance = 0
 # this gain currently modulates the forward drive enhancement
 driveGain = 1
 # body turning p-gain
@@ -90,218 +52,281 @@ pix2ang_factor = 0.117
 refSize1 = 12
 # reference object two is side post (~50mm tall)
 refSize2 = 50
-# this is the distance estimation of an object
-objectDist = 0
 # this is some desired distance to keep (mm)
 targetDist = 100
 # reference distance; some fix distance to compare the object distance with
 refDist = 400
 
-blocks = None
+# distance (mm) for every block width, for each reference object
+RANGE_TABLES = {refSize1: targeting.range_table(refSize1, pix2ang_factor),
+                refSize2: targeting.range_table(refSize2, pix2ang_factor)}
+# signatures worth chasing with --rank-targets: (weight, range table)
+TARGETS = {1: (1.0, RANGE_TABLES[refSize1])}
 
-def handle_SIGINT(sig, frame):
+def estimate_distance(width, size=refSize1):
     """
-    Handle CTRL-C quit by setting run flag to false
-    This will break out of main loop and let you close
-    pixy gracefully
+    Distance (mm) to a reference object size mm across that shows up
+    width pixels wide
     """
-    global run_flag
-    run_flag = False
+    return RANGE_TABLES[size][min(width, PIXY_MAX_X + 1)]
 
-class Blocks(ctypes.Structure):
+class LaserTag(object):
     """
-    Block structure for use with getting blocks from
-    pixy.get_blocks()
-    """
-    _fields_ = [
-        ("type", ctypes.c_uint),
-        ("signature", ctypes.c_uint),
-        ("x", ctypes.c_uint),
-        ("y", ctypes.c_uint),
-        ("width", ctypes.c_uint),
-        ("height", ctypes.c_uint),
-        ("angle", ctypes.c_uint)
-    ]
-
-class ServoLoop(object):
+    The laser tag robot: chases signature #1 and fires the IR gun every
+    second.  The IR link (ser) is optional.
     """
-    Loop to set pixy pan position
-    """
-    def __init__(self, pgain, dgain):
-        self.m_pos = PIXY_RCS_CENTER_POS
-        self.m_prevError = 0x80000000L
-        self.m_pgain = pgain
-        self.m_dgain = dgain
-
-    def update(self, error):
-        if self.m_prevError != 0x80000000:
-            vel = (error * self.m_pgain + (error - self.m_prevError) * self.m_dgain) >> 10
-            self.m_pos += vel
-            if self.m_pos > PIXY_RCS_MAX_POS:
-                self.m_pos = PIXY_RCS_MAX_POS
-            elif self.m_pos < PIXY_RCS_MIN_POS:
-                self.m_pos = PIXY_RCS_MIN_POS
-        self.m_prevError = error
-
-# define pan loop
-panLoop = ServoLoop(300, 500)
-
-
-def setup():
-    """
-    One time setup. Inialize pixy and set sigint handler
-    """
-    global blocks
-    pixy_init_status = pixy.pixy_init()
-    if pixy_init_status != 0:
-        print 'Error: pixy_init() [%d] ' % pixy_init_status
-        pixy.pixy_error(pixy_init_status)
-        return
-    else:
-        print "Pixy setup OK"
-    blocks = pixy.BlockArray(BLOCK_BUFFER_SIZE)
-    signal.signal(signal.SIGINT, handle_SIGINT)
-
-killed = False
-
-def loop():
-    """
-    Main loop, Gets blocks from pixy, analyzes target location,
-    chooses action for robot and sends instruction to motors
-    """
-    global blocks, throttle, diffDrive, diffGain, bias, advance, turnError, currentTime, lastTime, objectDist, distError, panError_prev, distError_prev, panLoop, killed, lastFire
-
-    if ser.in_waiting:
-        print "Reading line from serial.."
-        code = ser.readline().rstrip()
-        print "Got IR code %s" % code
-        killed = True
-        #if code=="58391E4E" or code=="9DF14DB3" or code=="68B92":
-        #    killed = True
-        #
-        #if code=="E4F74E5A" or code=="A8FA9FFD":
-        #    killed = False
-
-    if killed:
-        print "I'm hit!"
-        motors.setSpeeds(0, 0)
-        time.sleep(5)
-
-    currentTime = datetime.now()
-    # If no new blocks, don't do anything
-    while not pixy.pixy_blocks_are_new() and run_flag:
-        pass
-    count = pixy.pixy_get_blocks(BLOCK_BUFFER_SIZE, blocks)
-    # If negative blocks, something went wrong
-    if count < 0:
-        print 'Error: pixy_get_blocks() [%d] ' % count
-        pixy.pixy_error(count)
-        sys.exit(1)
-    # if more than one block
-    # Check which the largest block's signature and either do target chasing or
-    # line following
-    if count > 0:
-
-        time_difference = currentTime - lastFire
-        if time_difference.total_seconds() >= 1:
-            print "Fire!"
-            ser.write("FIRE\n")
-            lastFire = currentTime
-
-        lastTime = currentTime
-        # if the largest block is the object to pursue, then prioritize this behavior
-        if blocks[0].signature == 1:
-            panError = PIXY_X_CENTER - blocks[0].x
-            objectDist = refSize1 / (2 * math.tan(math.radians(blocks[0].width * pix2ang_factor)))
-            throttle = 0.5
-            # amount of steering depends on how much deviation is there
-            diffDrive = diffGain * abs(float(panError)) / PIXY_X_CENTER
-            distError = objectDist - targetDist
-            # this is in float format with sign indicating advancing or retreating
-            advance = driveGain * float(distError) / refDist
-        # if Pixy sees a guideline, perform line following algorithm
-        elif blocks[0].signature == 2:
-            panError = PIXY_X_CENTER-blocks[0].x
-            throttle = 1.0
-            diffDrive = 0.6
-            # amount of steering depends on how much deviation is there
-            # diffDrive = diffGain * abs(float(turnError)) / PIXY_X_CENTER
-            # use full available throttle for charging forward
-            advance = 1            
-        # if none of the blocks make sense, just pause
+    __slots__ = ('pixy', 'motors', 'ser', 'blocks', 'waiter', 'irReader', 'lockout', 'profiler', 'tracker', 'selector', 'flag',
+                 'panLoop', 'motion', 'camera_ready',
+                 'currentTime', 'lastTime', 'lastFire', 'turnError', 'objectDist', 'distError')
+
+    def __init__(self, pixy=None, motors=None, ser=None):
+        # hardware, picked from the command line (see backends.py)
+        self.pixy = pixy
+        self.motors = motors
+        self.ser = ser
+        self.blocks = None
+        self.waiter = None
+        self.irReader = None
+        self.lockout = irlink.Lockout()
+        self.profiler = latency.NullProfiler()
+        # predicts block positions with --predict (see tracking.py)
+        self.tracker = None
+        # picks which target to chase with --rank-targets (see targeting.py)
+        self.selector = None
+        self.flag = control.RunFlag()
+        # define pan loop
+        self.panLoop = control.ServoLoop(300, 500)
+        self.motion = control.Drive(motors, MAX_MOTOR_SPEED)
+        # set once the camera has been initialised during bring-up
+        self.camera_ready = False
+        self.currentTime = datetime.now()
+        self.lastTime = datetime.now()
+        self.lastFire = self.lastTime
+        self.turnError = 0
+        # this is the distance estimation of an object
+        self.objectDist = 0
+        self.distError = 0
+
+    def setup(self):
+        """
+        One time setup. Inialize pixy and set sigint handler
+        """
+        pixy = self.pixy
+        pixy_init_status = 0 if self.camera_ready else pixy.pixy_init()
+        if pixy_init_status != 0:
+            print 'Error: pixy_init() [%d] ' % pixy_init_status
+            pixy.pixy_error(pixy_init_status)
+            return
         else:
-            panError = 0
-            throttle = 0.0
-            diffDrive = 1
-        panLoop.update(panError)
-
-    # Update pixy's pan position
-    pixy.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, panLoop.m_pos)
-
-    # if Pixy sees nothing recognizable, don't move.
-    time_difference = currentTime - lastTime
-    if time_difference.total_seconds() >= timeout:
-        throttle = 0.0
-        diffDrive = 1
-
-    # this is turning to left
-    if panLoop.m_pos > PIXY_RCS_CENTER_POS:
-        # should be still int32_t
-        turnError = panLoop.m_pos - PIXY_RCS_CENTER_POS
-        # <0 is turning left; currently only p-control is implemented
-        bias = - float(turnError) / float(PIXY_RCS_CENTER_POS) * h_pgain
-    # this is turning to right
-    elif panLoop.m_pos < PIXY_RCS_CENTER_POS:
-        # should be still int32_t
-        turnError = PIXY_RCS_CENTER_POS - panLoop.m_pos
-        # >0 is turning left; currently only p-control is implemented
-        bias = float(turnError) / float(PIXY_RCS_CENTER_POS) * h_pgain
-    drive()
-    return run_flag
-
-def drive():
-    # synDrive is the drive level for going forward or backward (for both wheels)
-    synDrive = advance * (1 - diffDrive) * throttle * totalDrive
-    leftDiff = bias * diffDrive * throttle * totalDrive
-    rightDiff = -bias * diffDrive * throttle * totalDrive
-
-    # construct the drive levels
-    LDrive = (synDrive + leftDiff)
-    RDrive = (synDrive + rightDiff)
-
-    # Make sure that it is outside dead band and less than the max
-    if LDrive > deadband:
-        if LDrive > MAX_MOTOR_SPEED:
-            LDrive = MAX_MOTOR_SPEED
-    elif LDrive < -deadband:
-        if LDrive < -MAX_MOTOR_SPEED:
-            LDrive = -MAX_MOTOR_SPEED
-    else:
-        LDrive = 0
-
-    if RDrive > deadband:
-        if RDrive > MAX_MOTOR_SPEED:
-            RDrive = MAX_MOTOR_SPEED
-    elif RDrive < -deadband:
-        if RDrive < -MAX_MOTOR_SPEED:
-            RDrive = -MAX_MOTOR_SPEED
-    else:
-        RDrive = 0
-
-    # Actually Set the motors
-    motors.setSpeeds(int(LDrive), int(RDrive))
+            print "Pixy setup OK"
+        self.motion.motors = self.motors
+        self.blocks = pixy.BlockArray(BLOCK_BUFFER_SIZE)
+        self.waiter = framewait.FrameWaiter(pixy)
+        if self.ser:
+            self.irReader = irlink.IRReader(self.ser)
+            self.irReader.start()
+        signal.signal(signal.SIGINT, self.flag.handle_SIGINT)
+
+    def loop(self):
+        """
+        Main loop, Gets blocks from pixy, analyzes target location,
+        chooses action for robot and sends instruction to motors
+        """
+        pixy = self.pixy
+        blocks = self.blocks
+        motion = self.motion
+        panLoop = self.panLoop
+        profiler = self.profiler
+
+        if self.irReader:
+            for event in self.irReader.events():
+                print "Got IR code %s" % event.line
+                if event.hit:
+                    print "I'm hit!"
+                    self.lockout.hit(event.stamp)
+                    self.motors.setSpeeds(0, 0)
+
+        self.currentTime = currentTime = datetime.now()
+        profiler.start_frame()
+        # If no new blocks, don't do anything
+        if not self.waiter.wait(self.flag):
+            return self.flag.running
+        profiler.camera()
+        profiler.mark('camera wait')
+        count = pixy.pixy_get_blocks(BLOCK_BUFFER_SIZE, blocks)
+        profiler.mark('get blocks')
+        # If negative blocks, something went wrong
+        if count < 0:
+            print 'Error: pixy_get_blocks() [%d] ' % count
+            pixy.pixy_error(count)
+            sys.exit(1)
+        if self.tracker:
+            # chase the target where it will be when the motors respond
+            self.tracker.update(blocks, count)
+            profiler.mark('tracking')
+        # if more than one block
+        # Check which the largest block's signature and either do target chasing or
+        # line following
+        if count > 0:
+
+            time_difference = currentTime - self.lastFire
+            if time_difference.total_seconds() >= 1:
+                print "Fire!"
+                if self.ser:
+                    self.ser.write("FIRE\n")
+                self.lastFire = currentTime
+
+            self.lastTime = currentTime
+            target = blocks[0]
+            if self.selector:
+                best = self.selector.select(blocks, count)
+                if best >= 0:
+                    target = blocks[best]
+                profiler.mark('targeting')
+            # if the largest (or best) block is the object to pursue, then prioritize this behavior
+            if target.signature == 1:
+                panError = PIXY_X_CENTER - target.x
+                self.objectDist = estimate_distance(target.width)
+                motion.throttle = 0.5
+                # amount of steering depends on how much deviation is there
+                motion.diffDrive = diffGain * abs(float(panError)) / PIXY_X_CENTER
+                self.distError = self.objectDist - targetDist
+                # this is in float format with sign indicating advancing or retreating
+                motion.advance = driveGain * float(self.distError) / refDist
+            # if Pixy sees a guideline, perform line following algorithm
+            elif target.signature == 2:
+                panError = PIXY_X_CENTER-target.x
+                motion.throttle = 1.0
+                motion.diffDrive = 0.6
+                # amount of steering depends on how much deviation is there
+                # diffDrive = diffGain * abs(float(turnError)) / PIXY_X_CENTER
+                # use full available throttle for charging forward
+                motion.advance = 1
+            # if none of the blocks make sense, just pause
+            else:
+                panError = 0
+                motion.throttle = 0.0
+                motion.diffDrive = 1
+            panLoop.update(panError)
+        profiler.mark('pan loop')
+
+        # Update pixy's pan position
+        pixy.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, panLoop.m_pos)
+        profiler.mark('servo write')
+
+        # if Pixy sees nothing recognizable, don't move.
+        time_difference = currentTime - self.lastTime
+        if time_difference.total_seconds() >= timeout:
+            motion.throttle = 0.0
+            motion.diffDrive = 1
+
+        # this is turning to left
+        if panLoop.m_pos > PIXY_RCS_CENTER_POS:
+            # should be still int32_t
+            self.turnError = panLoop.m_pos - PIXY_RCS_CENTER_POS
+            # <0 is turning left; currently only p-control is implemented
+            motion.bias = - float(self.turnError) / float(PIXY_RCS_CENTER_POS) * h_pgain
+        # this is turning to right
+        elif panLoop.m_pos < PIXY_RCS_CENTER_POS:
+            # should be still int32_t
+            self.turnError = PIXY_RCS_CENTER_POS - panLoop.m_pos
+            # >0 is turning left; currently only p-control is implemented
+            motion.bias = float(self.turnError) / float(PIXY_RCS_CENTER_POS) * h_pgain
+        # while hit, keep watching and panning so the target is still in view
+        # when the lockout ends, but leave the motors stopped
+        if not self.lockout.active():
+            self.drive()
+            if self.tracker:
+                # only a command that went out counts towards the lead
+                self.tracker.sent()
+        profiler.mark('motors')
+        profiler.end_frame()
+        return self.flag.running
+
+    def drive(self):
+        self.motion.send()
+
+    def close(self):
+        """Stop the robot and report, whatever state setup() got to"""
+        if self.irReader:
+            self.irReader.stop()
+            self.irReader.report()
+        self.pixy.pixy_close()
+        self.motors.setSpeeds(0, 0)
+        if self.waiter:
+            self.waiter.report()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Follows signature #1 and fires the IR gun every second')
+    scheduler.add_arguments(parser, dt)
+    actuators.add_arguments(parser)
+    backends.add_arguments(parser, link=True)
+    irlink.add_arguments(parser)
+    latency.add_arguments(parser)
+    tracking.add_arguments(parser)
+    targeting.add_arguments(parser)
+    startup.add_arguments(parser)
+    args = parser.parse_args()
+    robot = LaserTag()
+    robot.lockout = irlink.Lockout(args.lockout)
+    robot.profiler = latency.from_args(args)
+    robot.tracker = tracking.from_args(args)
+    robot.selector = targeting.from_args(args, TARGETS, refDist)
+
+    options = backends.options_from(args, lambda: robot.flag.handle_SIGINT(None, None), serialDevice, baudRate)
+    if args.replay:
+        args.camera = args.motors = 'scripted'
+        args.link = 'null'
+        # replays run flat out
+        args.period = 0
+    # bring the camera, motor driver and IR board up side by side
+    boot = startup.Bringup()
+    boot.start('camera', lambda: backends.init_camera(backends.open_camera(args.camera, options), args.retry_deadline))
+    if args.replay:
+        # the scripted motors check commands against the camera's recording
+        boot.result('camera')
+    boot.start('motors', lambda: backends.open_motors(args.motors, options))
+    boot.start('link', lambda: backends.open_link(args.link, options))
+    pixy = boot.result('camera')
+    motors = boot.result('motors')
+    # without the IR board we can still chase targets, just not score
+    robot.ser = boot.result('link', required=False)
+    robot.camera_ready = True
+    replay = pixy if args.replay else None
+    recording = None
+    if args.record:
+        import recorder
+        recording = recorder.Recorder(args.record)
+        pixy = recorder.RecordingPixy(pixy, recording)
+        motors = recorder.RecordingMotors(motors, recording)
+    if args.coalesce:
+        motors = actuators.MotorOutput(motors, args.motor_threshold, args.write_interval / 1000.0)
+        pixy = actuators.ServoOutput(pixy, args.servo_threshold, args.write_interval / 1000.0)
+    robot.pixy = pixy
+    robot.motors = motors
+
+    sched = scheduler.RateScheduler(args.period, args.overrun)
     try:
-        setup()
+        boot.step('setup', robot.setup)
+        boot.ready()
         while True:
-            ok = loop()
+            sched.tick()
+            ok = robot.loop()
             if not ok:
                 break
     finally:
-        pixy.pixy_close()
-        motors.setSpeeds(0, 0)
+        robot.close()
+        sched.report()
+        if args.coalesce:
+            motors.report()
+            pixy.report()
+        if recording:
+            recording.close()
+        if replay:
+            replay.report()
+        robot.profiler.report()
+        if robot.tracker:
+            robot.tracker.report()
+        if robot.selector:
+            robot.selector.report()
         print "Robot Shutdown Completed"
-
-
-
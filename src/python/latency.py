@@ -0,0 +1,172 @@
+import time
+import ctypes
+
+# histogram resolution: values below 2**SUB_BITS us are counted exactly,
+# above that each power of two is split into 2**(SUB_BITS-1) buckets, so
+# any value is reported to within about 3%
+SUB_BITS = 6
+# highest power of two kept, in us (2**36us is about 19 hours)
+MAX_BITS = 36
+
+PERCENTILES = (50, 95, 99)
+
+def _monotonic_clock():
+    """
+    A clock that never jumps with NTP: time.monotonic on Python 3,
+    clock_gettime(CLOCK_MONOTONIC) through ctypes on Python 2 / Linux,
+    falling back to time.time
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        try:
+            librt = ctypes.CDLL('librt.so.1', use_errno=True)
+        except OSError:
+            # find_library runs ldconfig, so only when the usual name fails
+            from ctypes.util import find_library
+            librt = ctypes.CDLL(find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        ts = timespec()
+        tsp = ctypes.pointer(ts)
+
+        def monotonic():
+            clock_gettime(CLOCK_MONOTONIC, tsp)
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError):
+        return time.time
+
+monotonic = _monotonic_clock()
+
+class Histogram(object):
+    """
+    Counts microsecond values in log-linear buckets, like HdrHistogram:
+    fixed memory and constant time per value whatever the range
+    """
+    def __init__(self):
+        self.m_half = 1 << (SUB_BITS - 1)
+        self.m_counts = [0] * ((1 << SUB_BITS) + (MAX_BITS - SUB_BITS) * self.m_half)
+        self.count = 0
+        self.max = 0
+
+    def _index(self, value):
+        if value < (1 << SUB_BITS):
+            return value
+        shift = min(value.bit_length() - SUB_BITS, MAX_BITS - SUB_BITS)
+        mantissa = min(value >> shift, (1 << SUB_BITS) - 1)
+        return (1 << SUB_BITS) + (shift - 1) * self.m_half + mantissa - self.m_half
+
+    def _value(self, index):
+        """Highest value counted in a bucket"""
+        if index < (1 << SUB_BITS):
+            return index
+        shift = (index - (1 << SUB_BITS)) // self.m_half + 1
+        mantissa = (index - (1 << SUB_BITS)) % self.m_half + self.m_half
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, us):
+        us = int(us)
+        if us < 0:
+            us = 0
+        self.m_counts[self._index(us)] += 1
+        self.count += 1
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        wanted = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for index, n in enumerate(self.m_counts):
+            seen += n
+            if seen >= wanted:
+                return min(self._value(index), self.max)
+        return self.max
+
+class Profiler(object):
+    """
+    Times the stages of a control loop.  start_frame() begins a frame,
+    mark(stage) charges the time since the previous mark to that stage,
+    and camera() notes when the frame came from the camera; end_frame()
+    then counts the whole loop and the camera to motor latency.
+    """
+    def __init__(self):
+        self.m_stages = []
+        self.m_histograms = {}
+        self.m_start = None
+        self.m_mark = None
+        self.m_camera = None
+        self.frames = 0
+
+    def _histogram(self, stage):
+        if stage not in self.m_histograms:
+            self.m_stages.append(stage)
+            self.m_histograms[stage] = Histogram()
+        return self.m_histograms[stage]
+
+    def start_frame(self):
+        self.m_start = self.m_mark = monotonic()
+        self.m_camera = None
+
+    def mark(self, stage):
+        if self.m_mark is None:
+            return
+        now = monotonic()
+        self._histogram(stage).record((now - self.m_mark) * 1e6)
+        self.m_mark = now
+
+    def camera(self, age=0):
+        """The frame being handled came from the camera age seconds ago"""
+        self.m_camera = monotonic() - age
+
+    def end_frame(self):
+        if self.m_start is None:
+            return
+        now = monotonic()
+        self._histogram('loop').record((now - self.m_start) * 1e6)
+        if self.m_camera is not None:
+            self._histogram('camera to motor').record((now - self.m_camera) * 1e6)
+        self.m_start = self.m_mark = None
+        self.frames += 1
+
+    def report(self):
+        print "Profile over %d frames (us):" % self.frames
+        print "  %-16s %7s %7s %7s %7s %7s" % (('stage', 'count') + tuple('p%d' % p for p in PERCENTILES) + ('max',))
+        for stage in self.m_stages:
+            h = self.m_histograms[stage]
+            print "  %-16s %7d %7d %7d %7d %7d" % ((stage, h.count) + tuple(h.percentile(p) for p in PERCENTILES) + (h.max,))
+
+class NullProfiler(object):
+    """
+    Stands in when profiling is off
+    """
+    frames = 0
+
+    def start_frame(self):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def camera(self, age=0):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def report(self):
+        pass
+
+def add_arguments(parser):
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='time each stage of the loop and report percentiles at exit')
+    parser.set_defaults(profile=False)
+
+def from_args(args):
+    return Profiler() if args.profile else NullProfiler()
@@ -0,0 +1,169 @@
+"""
+Micro-benchmarks for the control primitives the loops are built from,
+with the camera and motor driver swapped for backends that need no
+hardware.  Results can be saved as a baseline; later runs are compared
+against it and anything slower by more than the threshold is flagged
+(and the exit status is 1), so a change that slows the loop shows up.
+
+    python microbench.py --save
+    python microbench.py
+    python microbench.py --only get_frame --threshold 0.1
+"""
+import gc
+import sys
+import json
+import time
+import ctypes
+import argparse
+
+import bench
+import control
+import backends
+import blockview
+import framewait
+import recovery
+import targeting
+
+BASELINE_FILE = 'microbench.json'
+THRESHOLD = 0.2
+ITERATIONS = 20000
+REPEAT = 5
+BLOCK_COUNTS = (0, 1, 5, 10)
+
+class FixedPixy(backends.NullPixy):
+    """
+    A camera that returns the same count blocks every frame: center line
+    blocks below the horizon either side of the middle, then edge lines
+    """
+    def __init__(self, count):
+        self.m_count = count
+        self.m_blocks = (framewait.Blocks * max(count, 1))()
+        for i in range(count):
+            block = self.m_blocks[i]
+            block.signature = 2 if i < 3 else 3 + i % 2
+            block.x = 160 + (i - 1) * 25
+            block.y = 180 - i * 12
+            block.width = 30 - i * 2
+            block.height = 8
+        self.m_size = ctypes.sizeof(framewait.Blocks) * count
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        ctypes.memmove(blocks, self.m_blocks, self.m_size)
+        return self.m_count
+
+def measure(fn, iterations, repeat):
+    """
+    Best ns per call of fn over repeat runs, and the objects per call the
+    garbage collector was left tracking (CPython 2 cannot count every
+    allocation, but this catches anything kept alive per call)
+    """
+    def run():
+        best = None
+        retained = 0
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()
+            try:
+                before = len(gc.get_objects())
+                start = time.time()
+                for i in xrange(iterations):
+                    fn()
+                elapsed = time.time() - start
+                retained = max(retained, len(gc.get_objects()) - before)
+            finally:
+                gc.enable()
+            if best is None or elapsed < best:
+                best = elapsed
+        return best * 1e9 / iterations, float(retained) / iterations
+    return bench.quietly(run)
+
+def benchmarks():
+    """
+    (name, fn) for every benchmark, in order.  Each is set up just before
+    it is handed out, as the Scene ones share the racer's camera.
+    """
+    robot = bench.prepare('racer', 'null')
+    import racer
+    import lasertag
+
+    servo = control.ServoLoop(300, 500)
+    yield 'ServoLoop.update', lambda: servo.update(37)
+    pid = control.PID(racer.h_pgain, 0, 0)
+    yield 'PID.update', lambda: pid.update(0.3)
+    robot.motion.set(1, 1.0, 0.5, 0.2)
+    yield 'drive()', robot.drive
+    line = FixedPixy(1).m_blocks[0]
+    yield 'ignore()', lambda: racer.ignore(line)
+    for count in BLOCK_COUNTS:
+        robot.pixy = FixedPixy(count)
+        scene = racer.Scene(robot)
+        scene.get_frame()
+        yield 'Scene.get_blocks[%d]' % count, scene.get_blocks
+        yield 'Scene.get_frame[%d]' % count, scene.get_frame
+    # as setup() does with --lookahead
+    blockview.load_numpy()
+    for count in BLOCK_COUNTS[1:]:
+        center = list(FixedPixy(count).m_blocks)
+        yield 'fit_path[%d]' % count, lambda center=center: blockview.fit_path(center, 2)
+    history = recovery.SideHistory(racer.AVG_N)
+    yield 'SideHistory.add', lambda: history.add(3, 1)
+    # never finds the line, so it steps through the whole search
+    search = recovery.LineSearch(control.Drive(None), history, control.ServoLoop(300, 500))
+    yield 'LineSearch.update', lambda: search.update(False)
+    yield 'lasertag.estimate_distance', lambda: lasertag.estimate_distance(24)
+    for count in BLOCK_COUNTS[1:]:
+        # every block a target, so each is scored and matched to the last frame's
+        targets = FixedPixy(count).m_blocks
+        for block in targets:
+            block.signature = 1
+        selector = targeting.TargetSelector(lasertag.TARGETS, lasertag.refDist)
+        yield 'TargetSelector.select[%d]' % count, lambda targets=targets, count=count, selector=selector: \
+            selector.select(targets, count)
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the control primitives')
+    parser.add_argument('--only', help='run only benchmarks whose name contains this')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs per benchmark; the fastest counts')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='stored results to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='flag benchmarks this fraction slower than the baseline')
+    parser.add_argument('--save', action='store_true', help='store these results as the baseline')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    regressions = 0
+    print "%-28s %10s %8s %10s %8s" % ('benchmark', 'ns/op', 'objs/op', 'baseline', 'change')
+    for name, fn in benchmarks():
+        if args.only and args.only not in name:
+            continue
+        ns, objects = measure(fn, args.iterations, args.repeat)
+        results[name] = {'ns': ns, 'objects': objects}
+        base = baseline.get(name)
+        if base:
+            change = ns / base['ns'] - 1
+            flag = ''
+            if change > args.threshold:
+                flag = '  SLOWER'
+                regressions += 1
+            print "%-28s %10.0f %8.2f %10.0f %+7.0f%%%s" % (name, ns, objects, base['ns'], change * 100, flag)
+        else:
+            print "%-28s %10.0f %8.2f %10s %8s" % (name, ns, objects, '-', '-')
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print "Baseline saved to %s" % args.baseline
+    elif regressions:
+        print "%d benchmark%s more than %.0f%% slower than %s" % (regressions, 's' if regressions > 1 else '',
+                                                                  args.threshold * 100, args.baseline)
+        sys.exit(1)
@@ -1,109 +1,70 @@
 import sys
 import traceback
 import signal
-import ctypes
 import math
 import time
 from datetime import datetime
 import argparse
 
-from pixy import pixy
-from pololu_drv8835_rpi import motors
-
-# Libraries for playing sound on the web service
-import requests
-import threading
-from Queue import Queue
-
-#VOICE_SERVICE_URL = "http://localhost:8080"
-VOICE_SERVICE_URL = "http://10.9.6.2:8080"
+import backends
+import framewait
+import scheduler
+import acquisition
+import blockview
+import calibrate
+import actuators
+import telemetry
+import latency
+import tracking
+import recovery
+import startup
+import control
+from control import (OBSTACLE, CENTER_LINE, LEFT_LINE, RIGHT_LINE, L_POST, R_POST, PIXY_X_CENTER, PIXY_Y_CENTER,
+                     PIXY_RCS_MIN_POS, PIXY_RCS_MAX_POS, PIXY_RCS_CENTER_POS, BLOCK_BUFFER_SIZE,
+                     PIXY_RCS_PAN_CHANNEL, PIXY_RCS_TILT_CHANNEL, MAX_MOTOR_SPEED, Blocks)
 
 BRIGHTNESS = 185
 
-#### signature ids ####
-OBSTACLE = 1
-CENTER_LINE = 2
-LEFT_LINE = 3
-RIGHT_LINE = 4
-L_POST = 5
-R_POST = 6
-
-##### defining PixyCam sensory variables
-PIXY_MIN_X = 0
-PIXY_MAX_X = 319
-PIXY_MIN_Y = 0
-PIXY_MAX_Y = 199
-
-PIXY_X_CENTER = ((PIXY_MAX_X-PIXY_MIN_X) / 2)
-PIXY_Y_CENTER = ((PIXY_MAX_Y-PIXY_MIN_Y) / 2)
-PIXY_RCS_MIN_POS = 0
-PIXY_RCS_MAX_POS = 1000
-PIXY_RCS_CENTER_POS = ((PIXY_RCS_MAX_POS-PIXY_RCS_MIN_POS) / 2)
-BLOCK_BUFFER_SIZE = 10
-
-##### defining PixyCam motor variables
-PIXY_RCS_PAN_CHANNEL = 0
-PIXY_RCS_TILT_CHANNEL = 1
-
 PAN_PROPORTIONAL_GAIN = 400
 PAN_DERIVATIVE_GAIN = 300
 TILT_PROPORTIONAL_GAIN = 500
 TILT_DERIVATIVE_GAIN = 400
 
-MAX_MOTOR_SPEED = 480
-MIN_MOTOR_SPEED = -480
-
 AVG_N = 3
 
-run_flag = 1
-firstPass = True
-startTime = time.time()
+# lines above this y are beyond the horizon
+HORIZON_Y = 60
 
-# options that can be set by command-line arguments
-no_brightness_check = True 
-chatty = False
-allow_move = True
-finale = False
+# brightness calibration: how much each signature seen counts towards a
+# frame's score, and the score that means we can follow the track
+SCORE_WEIGHTS = {CENTER_LINE: 4, LEFT_LINE: 1, RIGHT_LINE: 1, L_POST: 1, R_POST: 1}
+SUFFICIENT_SCORE = SCORE_WEIGHTS[CENTER_LINE]
+# never calibrate darker than this
+BRIGHTNESS_FLOOR = 60
 
+# with --lookahead, throttle comes down by up to CORNER_SLOWDOWN as the
+# center line ahead strays up to FULL_BEND pixels to the side
+CORNER_SLOWDOWN = 0.3
+FULL_BEND = 80.0
+
+# default gains (see tuning.py)
 initThrottle = 1.0 #0.9
 diffDriveStraight = 0.4 #0.6
 diffDrivePosts = 0.5 #0.6
+# body turning p-gain
+h_pgain = 0.7
+# body turning d-gain
+h_dgain = 0.2
 
 # 20ms time interval for 50Hz
 dt = 20
 # check timeout dt*3
 timeout = 0.5
-currentTime = datetime.now()
-lastTime = datetime.now()
-
-
-#### defining motor function variables
-# 5% drive is deadband
-deadband = 0.05 * MAX_MOTOR_SPEED
-# totalDrive is the total power available
-totalDrive = MAX_MOTOR_SPEED
-# throttle is how much of the totalDrive to use [0~1]
-throttle = 0
-# this is the drive level allocated for steering [0~1] dynamically modulate
-diffDrive = 0
+
 # this is the gain for scaling diffDrive
 diffGain = 1
-# this ratio determines the steering [-1~1]
-bias = 0
-# this ratio determines the drive direction and magnitude [-1~1]
-advance = 0
 # this gain currently modulates the forward drive enhancement
 driveGain = 1
-# body turning p-gain
-h_pgain = 0.7
-# body turning d-gain
-h_dgain = 0.2
-
-# turn error
-turnError = 0
-# PID controller
-pid_bias = 0
-last_turn = 0
 
 #### defining state estimation variables
 # pixyViewV = 47
@@ -116,146 +77,14 @@ pix2ang_factor = 0.117
 refSize1 = 12
 # reference object two is side post (~50mm tall)
 refSize2 = 50
-# this is the distance estimation of an object
-objectDist = 0
 # this is some desired distance to keep (mm)
 targetDist = 100
 # reference distance; some fix distance to compare the object distance with
 refDist = 400
 
-sayingQueue = Queue()
-
-def sayNow(saying):
-    if not chatty:
-        return
-    try:
-        if saying.startswith("SLEEP"):
-            requests.get('%s/say?sleep=%s' % (VOICE_SERVICE_URL, saying.split()[1]))
-        else:
-            requests.get('%s/say?text=%s' % (VOICE_SERVICE_URL, saying))
-    except Exception, err:
-        print "Couldn't send saying to voice server",err
-
-def say(saying):
-    print "Saying '%s'" % saying
-    if not chatty:
-        return
-    sayingQueue.put(saying)
-
-def voiceThreadLoop():
-    def webSay(saying):
-        try:
-            if saying.startswith("SLEEP"):
-                requests.get('%s/say?sleep=%s' % (VOICE_SERVICE_URL, saying.split()[1]))
-            else:
-                requests.get('%s/say?text=%s' % (VOICE_SERVICE_URL, saying))
-        except Exception, err:
-            print "Couldn't send saying to voice server",err
-    lastSaying = None
-    lastTime = datetime.now()
-    while True:
-        saying = sayingQueue.get()
-        currentTime = datetime.now()
-        time_difference = currentTime - lastTime
-        if saying:
-            if not(saying==lastSaying) or time_difference.total_seconds() >= 3:
-                webSay(saying)
-                lastSaying = saying
-                lastTime = currentTime
-
-def handle_SIGINT(sig, frame):
-    """
-    Handle CTRL-C quit by setting run flag to false
-    This will break out of main loop and let you close
-    pixy gracefully
-    """
-    global run_flag
-    run_flag = False
-
-class Blocks(ctypes.Structure):
-    """
-    Block structure for use with getting blocks from
-    pixy.get_blocks()
-    """
-    _fields_ = [
-        ("type", ctypes.c_uint),
-        ("signature", ctypes.c_uint),
-        ("x", ctypes.c_uint),
-        ("y", ctypes.c_uint),
-        ("width", ctypes.c_uint),
-        ("height", ctypes.c_uint),
-        ("angle", ctypes.c_uint)
-    ]
-
-class ServoLoop(object):
-    """
-    Loop to set pixy pan position
-    """
-    def __init__(self, pgain, dgain):
-        self.m_pos = PIXY_RCS_CENTER_POS
-        self.m_prevError = 0x80000000L
-        self.m_pgain = pgain
-        self.m_dgain = dgain
-
-    def update(self, error):
-        if self.m_prevError != 0x80000000:
-            vel = (error * self.m_pgain + (error - self.m_prevError) * self.m_dgain) >> 10
-            self.m_pos += vel
-            if self.m_pos > PIXY_RCS_MAX_POS:
-                self.m_pos = PIXY_RCS_MAX_POS
-            elif self.m_pos < PIXY_RCS_MIN_POS:
-                self.m_pos = PIXY_RCS_MIN_POS
-        self.m_prevError = error
-
-# define pan loop
-panLoop = ServoLoop(300, 500)
-
-class PID:
-    """
-    Discrete PID control
-    """
-    def __init__(self, P=2.0, I=0.0, D=1.0, Derivator=0, Integrator=0, Integrator_max=500, Integrator_min=-500):
-        self.Kp=P
-        self.Ki=I
-        self.Kd=D
-        self.Derivator=Derivator
-        self.Integrator=Integrator
-        self.Integrator_max=Integrator_max
-        self.Integrator_min=Integrator_min
-        self.set_point=0.0
-        self.error=0.0
-
-    def update(self,current_value):
-        """
-        Calculate PID output value for given reference input and feedback
-        """
-        self.error = self.set_point - current_value
-        P_value = self.Kp * self.error
-        D_value = self.Kd * ( self.error - self.Derivator)
-        self.Derivator = self.error
-        self.Integrator = self.Integrator + self.error
-        if self.Integrator > self.Integrator_max:
-                self.Integrator = self.Integrator_max
-        elif self.Integrator < self.Integrator_min:
-                self.Integrator = self.Integrator_min
-        I_value = self.Integrator * self.Ki
-        PID = P_value + I_value + D_value
-        # print "SP:%2.2f PV:%2.2f Error:%2.2f -> P:%2.2f I:%2.2f D:%2.2f" % (self.set_point, current_value, self.error, P_value, I_value, D_value)
-        return PID
-
-    def setPoint(self,set_point):
-        """
-        Initilize the setpoint of PID
-        """
-        self.set_point = set_point
-        self.Integrator=0
-        self.Derivator=0
-
-pid = PID(h_pgain, 0, 0)
-
 # logic for horizon per signature, etc.
 def ignore(block):
-    above_horizon = block.y < 60
+    above_horizon = block.y < HORIZON_Y
     lines = (block.signature == LEFT_LINE) or (block.signature == CENTER_LINE) or (block.signature == RIGHT_LINE)
     if lines and above_horizon:
         return True
@@ -268,12 +97,20 @@ class Scene(object):
     """
     Detects different objects in a Scene.
     """
-    def __init__(self):
-        self.m_blocks = pixy.BlockArray(BLOCK_BUFFER_SIZE)
-        self.m_blockCount = []
+    def __init__(self, racer):
+        self.m_racer = racer
+        self.m_blocks = racer.pixy.BlockArray(BLOCK_BUFFER_SIZE)
+        self.m_blockmap = None
+        self.m_history = recovery.SideHistory(AVG_N)
         self.m_panError = 0
+        self.m_bend = 0
         self.m_brightness = BRIGHTNESS
         self.m_count = 0
+        self.m_seq = 0
+        self.m_stamp = 0
+        self.m_profile = None
+        self.m_calibrator = calibrate.BrightnessCalibrator(self.measure_brightness, SUFFICIENT_SCORE,
+                                                           BRIGHTNESS_FLOOR, calibrate.BRIGHTNESS_MAX)
 
     def is_sufficient(self):
         if not self.m_blockmap:
@@ -284,30 +121,39 @@ class Scene(object):
         return False
 
     def get_blocks(self):
-        self.m_count = pixy.pixy_get_blocks(BLOCK_BUFFER_SIZE, self.m_blocks)
+        racer = self.m_racer
+        if racer.grabber:
+            # take the freshest frame the acquisition thread has published
+            frame = racer.grabber.next_frame(self.m_seq, racer.flag)
+            if frame is None:
+                self.m_count = 0
+                return None
+            self.m_blocks = frame.blocks
+            self.m_count = frame.count
+            self.m_seq = frame.seq
+            self.m_stamp = frame.stamp
+            racer.profiler.camera(time.time() - frame.stamp)
+        else:
+            self.m_count = racer.pixy.pixy_get_blocks(BLOCK_BUFFER_SIZE, self.m_blocks)
+        racer.profiler.mark('get blocks')
 
         # If negative blocks, something went wrong
         if self.m_count < 0:
             print 'Error: pixy_get_blocks() [%d] ' % self.m_count
-            pixy.pixy_error(self.m_count)
+            racer.pixy.pixy_error(self.m_count)
             sys.exit(1)
+        if racer.tracker:
+            # steer by where the blocks will be when the motors respond
+            racer.tracker.update(self.m_blocks, self.m_count, self.m_stamp if racer.grabber else None)
+            racer.profiler.mark('tracking')
         if self.m_count == 0:
-            print "Detected no blocks"
+            racer.blackbox.log(telemetry.DEBUG, "Detected no blocks")
             return None
 
         # package per signature
-        i = 0
-        blockmap = {}
-        for block in self.m_blocks:
-            if ignore(block):
-                continue
-            if block.signature not in blockmap:
-                blockmap[block.signature] = []
-            blockmap[block.signature].append(block)
-            if i >= self.m_count:
-                break
-            i += 1
-        return blockmap
+        if racer.view:
+            return racer.view.group(self.m_blocks, self.m_count)
+        return blockview.group_blocks(self.m_blocks, self.m_count, ignore)
 
     def blocksSeen(self):
         return self.m_count > 0
@@ -325,11 +171,18 @@ class Scene(object):
         return CENTER_LINE in self.m_blockmap
 
     def setPanError(self):
+        self.m_bend = 0
         if self.m_count == 0 or not (CENTER_LINE in self.m_blockmap):
             self.m_panError = 0
             return
         center = self.m_blockmap[CENTER_LINE]
-        if len(center) > 1:
+        if self.m_racer.lookahead:
+            # fit the path through every center block: the error is where
+            # it passes under us, the bend how far it strays further on
+            near, far = blockview.fit_path(center, self.m_racer.lookahead)
+            self.m_panError = int(round(PIXY_X_CENTER - near))
+            self.m_bend = far - near
+        elif len(center) > 1:
             self.m_panError = PIXY_X_CENTER-self.m_blockmap[CENTER_LINE][1].x
         else:
             self.m_panError = PIXY_X_CENTER-self.m_blockmap[CENTER_LINE][0].x
@@ -339,432 +192,591 @@ class Scene(object):
     def panError(self):
         return self.m_panError
 
+    @property
+    def bend(self):
+        """With --lookahead, how far (pixels) the center line strays sideways ahead"""
+        return self.m_bend
+
+    def set_brightness(self, brightness):
+        racer = self.m_racer
+        racer.camera.pixy_cam_set_brightness(brightness)
+        if racer.grabber:
+            # the frame being captured right now may predate the change
+            self.m_seq = max(self.m_seq, racer.grabber.seq + 1)
+
+    def measure_brightness(self, brightness):
+        """Score a fresh frame taken at the given brightness"""
+        self.set_brightness(brightness)
+        if not self.m_racer.grabber:
+            self.m_racer.waiter.wait(self.m_racer.flag)
+        self.m_blockmap = self.get_blocks()
+        return calibrate.score(self.m_blockmap, SCORE_WEIGHTS)
+
+    def load_profile(self, profile):
+        """Start from the brightness that worked last time at this venue"""
+        self.m_profile = profile
+        if profile.brightness is not None:
+            self.m_brightness = profile.brightness
+            print "Starting from %s brightness %d" % (self.m_racer.venue, self.m_brightness)
+        return self.m_brightness
+
+    def calibrate_brightness(self):
+        """
+        Search for a brightness where we can see the track again.  Returns
+        True if one was found; the frame taken at it is left in m_blockmap.
+        """
+        blackbox = self.m_racer.blackbox
+        # stop at the first good enough frame: holding out for the best
+        # score ever saved would walk away from a brightness that works
+        self.m_calibrator.target = SUFFICIENT_SCORE
+        best, best_score = self.m_calibrator.search(self.m_brightness)
+        if self.m_calibrator.last != best:
+            self.measure_brightness(best)
+        if best_score < SUFFICIENT_SCORE:
+            blackbox.log(telemetry.WARNING, "Could not find good signatures after %d brightness changes!",
+                         self.m_calibrator.frames)
+            self.set_brightness(self.m_brightness)
+            return False
+        blackbox.log(telemetry.INFO, "Got good signtures at brightness %d after %d frames", best, self.m_calibrator.frames)
+        self.m_brightness = best
+        if self.m_profile:
+            self.m_profile.save(best, best_score)
+        return True
+
     def get_frame(self):
         """Populates panError, blockCount, and blocks for a frame"""
 
-        self.m_blockmap = None
-
-        if no_brightness_check:
-            self.m_blockmap = self.get_blocks()
-            self.setPanError()
-        else:
-            self.m_brightness = pixy.pixy_cam_get_brightness()
-            bmax = self.m_brightness + 20
-            if bmax > 255:
-                bmax = 255
-            bmin = self.m_brightness - 20
-            if bmin < 60:
-                bmin = min(self.m_brightness-1, 60)
-            gotit = False
-            for i in range(self.m_brightness, bmax):
-                self.m_blockmap = self.get_blocks()
-                if self.is_sufficient():
-                    gotit = True
-                    break
-                pixy.pixy_cam_set_brightness(i+1)
-            if not gotit:
-                for i in range(self.m_brightness-1, bmin, -1):
-                    self.m_blockmap = self.get_blocks()
-                    if self.is_sufficient():
-                        gotit = True
-                        break
-                    pixy.pixy_cam_set_brightness(i)
-
-            self.setPanError()
-            if gotit:
-                self.m_brightness = pixy.pixy_cam_get_brightness()
-                print "Got good signtures at brightness %d" % self.m_brightness
-            else:
-                print "Could not find good signatures after brightness changes!"
-                pixy.pixy_cam_set_brightness(self.m_brightness)
+        self.m_blockmap = self.get_blocks()
+        if not self.m_racer.no_brightness_check and not self.is_sufficient():
+            # only search for a new brightness once the track is lost
+            if not self.calibrate_brightness():
+                self.setPanError()
                 return
+        self.setPanError()
 
         # calculate center blocks on each side
-        right = 0
-        left = 0
         if not self.m_blockmap:
             return
-        if CENTER_LINE in self.m_blockmap:
-            for block in self.m_blockmap[CENTER_LINE]:
-                #print "Counting center block at %d" % block.x
-                if block.x > PIXY_X_CENTER:    #should look for center of car, not center of pixycam view.  
-                    right += 1
-                else:
-                    left += 1
+        view = self.m_racer.view
+        if view:
+            left, right = view.left, view.right
+        else:
+            #should look for center of car, not center of pixycam view.
+            left, right = blockview.count_sides(self.m_blockmap, CENTER_LINE, PIXY_X_CENTER)
 
         #print "Center blocks: left=%d, right=%d" % (left, right)
 
         # keep track of past AVG_N red blocks
-        if len(self.m_blockCount) > AVG_N:
-            self.m_blockCount.pop()
-        self.m_blockCount.insert(0, (left, right))
-
-
+        self.m_history.add(left, right)
 
-# init object processing
-scene = Scene()
 
-def setup():
+class Racer(object):
     """
-    One time setup. Inialize pixy and set sigint handler
+    The line following racer: everything one robot needs, so several can
+    be simulated side by side.  Options set from the command line are
+    plain attributes; set them before setup().
     """
-    pixy_init_status = pixy.pixy_init()
-    if pixy_init_status != 0:
-        print 'Error: pixy_init() [%d] ' % pixy_init_status
-        pixy.pixy_error(pixy_init_status)
-        return
-    else:
-        print "Pixy setup OK"
-    signal.signal(signal.SIGINT, handle_SIGINT)
-    pixy.pixy_cam_set_brightness(BRIGHTNESS)
-    pixy.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, PIXY_RCS_CENTER_POS)
-    
-    if chatty:
-        sayNow("I may not be the fastest but I have style")
-        #say("SLEEP 2")
-        time.sleep(2)
+    __slots__ = ('pixy', 'motors', 'camera', 'grabber', 'vision', 'view', 'waiter', 'scene', 'speaker', 'blackbox', 'profiler',
+                 'tracker', 'search',
+                 'flag', 'panLoop', 'pid', 'motion', 'camera_ready',
+                 'no_brightness_check', 'chatty', 'allow_move', 'finale', 'wait_mode', 'wait_budget', 'threaded',
+                 'vectorised', 'lookahead', 'recover', 'venue', 'lighting_file',
+                 'initThrottle', 'diffDriveStraight', 'diffDrivePosts', 'h_pgain',
+                 'firstPass', 'startTime', 'currentTime', 'lastTime', 'turnError', 'pid_bias', 'last_turn')
+
+    def __init__(self, pixy=None, motors=None):
+        # camera and motor driver, picked from the command line (see backends.py)
+        self.pixy = pixy
+        self.motors = motors
+        # pixy, or the acquisition thread standing in for it with --threaded
+        self.camera = None
+        self.grabber = None
+        # the vision process the camera is read in with --processes (see vision.py)
+        self.vision = None
+        # NumPy view of the block buffers with --numpy
+        self.view = None
+        # object processing, set up once the camera is
+        self.waiter = None
+        self.scene = None
+        # forwards sayings to the text2speech web service with --chatty (see voice.py)
+        self.speaker = None
+        # per-frame flight recorder and rate-limited logging (see telemetry.py)
+        self.blackbox = telemetry.Telemetry()
+        # per-stage timing with --profile (see latency.py)
+        self.profiler = latency.NullProfiler()
+        # predicts block positions with --predict (see tracking.py)
+        self.tracker = None
+        # finds the center line again with --recover (see recovery.py)
+        self.search = None
+        self.flag = control.RunFlag()
+        self.panLoop = control.ServoLoop(300, 500)
+        self.pid = control.PID(h_pgain, 0, 0)
+        self.motion = control.Drive(motors, MAX_MOTOR_SPEED)
+        # set once the camera has been initialised during bring-up
+        self.camera_ready = False
+
+        # options that can be set by command-line arguments
+        self.no_brightness_check = True
+        self.chatty = False
+        self.allow_move = True
+        self.finale = False
+        self.wait_mode = 'backoff'
+        self.wait_budget = framewait.WAIT_BUDGET
+        self.threaded = False
+        self.vectorised = False
+        self.lookahead = 0
+        self.recover = False
+        self.venue = calibrate.DEFAULT_VENUE
+        self.lighting_file = calibrate.LIGHTING_FILE
+
+        self.initThrottle = initThrottle
+        self.diffDriveStraight = diffDriveStraight
+        self.diffDrivePosts = diffDrivePosts
+        self.h_pgain = h_pgain
+
+        self.firstPass = True
+        self.startTime = time.time()
+        self.currentTime = datetime.now()
+        self.lastTime = datetime.now()
+        # turn error
+        self.turnError = 0
+        # PID controller
+        self.pid_bias = 0
+        self.last_turn = 0
+
+    def gains(self):
+        """The steering and throttle gains, by the names tuning.py uses"""
+        return {'h_pgain': self.h_pgain, 'pid_ki': self.pid.Ki, 'pid_kd': self.pid.Kd,
+                'initThrottle': self.initThrottle, 'diffDriveStraight': self.diffDriveStraight,
+                'diffDrivePosts': self.diffDrivePosts,
+                'pan_pgain': self.panLoop.m_pgain, 'pan_dgain': self.panLoop.m_dgain}
+
+    def set_gains(self, values):
+        """Use gains found by tuning.py; any not given keep their values"""
+        self.h_pgain = values.get('h_pgain', self.h_pgain)
+        self.initThrottle = values.get('initThrottle', self.initThrottle)
+        self.diffDriveStraight = values.get('diffDriveStraight', self.diffDriveStraight)
+        self.diffDrivePosts = values.get('diffDrivePosts', self.diffDrivePosts)
+        self.pid.Kp = self.h_pgain
+        self.pid.Ki = values.get('pid_ki', self.pid.Ki)
+        self.pid.Kd = values.get('pid_kd', self.pid.Kd)
+        self.panLoop.m_pgain = values.get('pan_pgain', self.panLoop.m_pgain)
+        self.panLoop.m_dgain = values.get('pan_dgain', self.panLoop.m_dgain)
+
+    def sayNow(self, saying):
+        """
+        Say something ahead of anything still queued; never waits for the server
+        """
+        if not self.speaker:
+            return
+        self.speaker.say(saying, urgent=True)
 
-def loop():
-    """
-    Main loop, Gets blocks from pixy, analyzes target location,
-    chooses action for robot and sends instruction to motors
-    """
-    global startTime, throttle, diffDrive, diffGain, bias, advance, turnError, currentTime, lastTime, objectDist, distError, panError_prev, distError_prev, firstPass, pid_bias, last_turn
-
-    currentTime = datetime.now()
-    # If no new blocks, don't do anything
-    while not pixy.pixy_blocks_are_new() and run_flag:
-        pass
-
-    if firstPass:
-        say("Here goes")
-        startTime = time.time()
-        firstPass = False
-
-    scene.get_frame()
-    if scene.blocksSeen():
-        lastTime = currentTime
-        
-    if finale:
-        refuseToPlay()
-        return False
+    def say(self, saying):
+        self.blackbox.log(telemetry.INFO, "Saying '%s'", saying)
+        if not self.speaker:
+            return
+        self.speaker.say(saying)
 
-    p = scene.panError
-    if p < 0:
-        p = -p
-    incr = p / 300.0
-    #print "panError: %f, incr: %f" % (scene.panError, incr)
-    #if incr > 0.65:
-    #    incr = 0.65
-    throttle = initThrottle  # - incr / 1.5
-    diffDrive = diffDriveStraight + incr
-
-    # amount of steering depends on how much deviation is there
-    #diffDrive = diffGain * abs(float(turnError)) / PIXY_X_CENTER
-    # use full available throttle for charging forward
-    advance = 1
-
-    panLoop.update(scene.panError)
-
-    # Update pixy's pan position
-    pixy.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, panLoop.m_pos)
-
-    # if Pixy sees nothing recognizable, don't move.
-    # time_difference = currentTime - lastTime
-    if not scene.seeCenter(): #time_difference.total_seconds() >= timeout:
-        print "Stopping since see nothing"
-        throttle = 0.0
-        diffDrive = 1
-
-    turn = 0
-
-    # this is turning to left
-    if panLoop.m_pos > PIXY_RCS_CENTER_POS:
-        # should be still int32_t
-        turnError = panLoop.m_pos - PIXY_RCS_CENTER_POS
-        # <0 is turning left; currently only p-control is implemented
-        turn = float(turnError) / float(PIXY_RCS_CENTER_POS)
-
-    # this is turning to right
-    elif panLoop.m_pos < PIXY_RCS_CENTER_POS:
-        # should be still int32_t
-        turnError = PIXY_RCS_CENTER_POS - panLoop.m_pos
-        # >0 is turning left; currently only p-control is implemented
-        turn = -float(turnError) / float(PIXY_RCS_CENTER_POS)
-
-    pid.setPoint(0)
-    pid_bias = pid.update(turn)
-    #print "PID controller: SP=%2.2f PV=%2.2f -> OP=%2.2f" % (0, turn, pid_bias)
-    last_turn = turn
-    bias = pid_bias # use PID controller on turn bias
-    # TODO: parameterize drive()
-
-    if bias < -0.3:
-        say("Going left")
-    if bias > 0.3:
-        say("Going right")
-
-    drive()
-    return run_flag
-
-def drive():
-
-    if not allow_move:
-        return
-    
-    if advance < 0:
-        say("Backup up.  Beep.  Beep.  Beep.")
-        print "Drive: Backing up.  Beeeep...Beeeep...Beeeep"
-
-    #print "Drive: advance=%2.2f, throttle=%2.2f, diffDrive=%2.2f, bias=%2.2f" % (advance, throttle, diffDrive, bias)
-
-    # synDrive is the drive level for going forward or backward (for both wheels)
-    synDrive = advance * (1 - diffDrive) * throttle * totalDrive
-    leftDiff = bias * diffDrive * throttle * totalDrive
-    rightDiff = -bias * diffDrive * throttle * totalDrive
-    #print "Drive: synDrive=%2.2f, leftDiff=%2.2f, rightDiff=%2.2f" % (synDrive, leftDiff, rightDiff)
-
-    # construct the drive levels
-    LDrive = (synDrive + leftDiff)
-    RDrive = (synDrive + rightDiff)
-
-    # Make sure that it is outside dead band and less than the max
-    if LDrive > deadband:
-        if LDrive > MAX_MOTOR_SPEED:
-            LDrive = MAX_MOTOR_SPEED
-    elif LDrive < -deadband:
-        if LDrive < -MAX_MOTOR_SPEED:
-            LDrive = -MAX_MOTOR_SPEED
-    else:
-        LDrive = 0
-
-    if RDrive > deadband:
-        if RDrive > MAX_MOTOR_SPEED:
-            RDrive = MAX_MOTOR_SPEED
-    elif RDrive < -deadband:
-        if RDrive < -MAX_MOTOR_SPEED:
-            RDrive = -MAX_MOTOR_SPEED
-    else:
-        RDrive = 0
-
-    # Actually Set the motors
-    motors.setSpeeds(int(LDrive), int(RDrive))
-
-### Dance moves
-
-def forward(t):
-    global bias, advance, throttle, diffDrive
-    bias =0
-    advance =1
-    throttle =.25
-    diffDrive=0
-    drive()
-    time.sleep(t) 
-
-def backward(t):
-    global bias, advance, throttle, diffDrive
-    bias =0
-    advance= -1
-    throttle=.3
-    diffDrive=0
-    drive()
-    time.sleep(t)
-
-def r_spin(t):
-    global bias, advance, throttle, diffDrive
-    bias =1
-    advance=1
-    throttle=.3
-    diffDrive=1
-    drive()
-    time.sleep(t)
-
-def l_spin(t):
-    global bias, advance, throttle, diffDrive
-    bias = -1
-    advance=1
-    throttle=.3
-    diffDrive=1
-    drive()
-    time.sleep(t)
-
-def right(t):
-    global bias, advance, throttle, diffDrive
-    bias =0.5
-    advance=1
-    throttle=.4
-    diffDrive=.5
-    drive()
-    time.sleep(t)
-
-def left(t):
-    global bias, advance, throttle, diffDrive
-    bias = -0.5
-    advance=1
-    throttle=.3
-    diffDrive=.5
-    drive()
-    time.sleep(t)
-
-###  Experimental behaviors
-
-def refuseToPlay():
-        motors.setSpeeds(0, 0)
-        l_spin(1)
-        
-        sayNow("I'm going to dance")
+    def setup(self):
+        """
+        One time setup. Inialize pixy and set sigint handler
+        """
+        pixy = self.pixy
+        pixy_init_status = 0 if self.camera_ready else pixy.pixy_init()
+        if pixy_init_status != 0:
+            print 'Error: pixy_init() [%d] ' % pixy_init_status
+            pixy.pixy_error(pixy_init_status)
+            return
+        else:
+            print "Pixy setup OK"
+        signal.signal(signal.SIGINT, self.flag.handle_SIGINT)
+        self.motion.motors = self.motors
+        self.camera = pixy
+        self.waiter = framewait.FrameWaiter(pixy, self.wait_mode, self.wait_budget)
+        self.scene = Scene(self)
+        if self.recover:
+            self.search = recovery.LineSearch(self.motion, self.scene.m_history, self.panLoop)
+        brightness = BRIGHTNESS
+        if not self.no_brightness_check:
+            brightness = self.scene.load_profile(calibrate.LightingProfile(self.lighting_file, self.venue))
+        pixy.pixy_cam_set_brightness(brightness)
+        pixy.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, PIXY_RCS_CENTER_POS)
+        if self.threaded:
+            self.grabber = acquisition.FrameGrabber(pixy, BLOCK_BUFFER_SIZE, self.wait_mode, self.wait_budget)
+            self.grabber.start()
+            self.camera = self.grabber
+        elif self.vision:
+            self.grabber = self.vision
+        if self.lookahead:
+            blockview.load_numpy()
+        if self.vectorised:
+            self.view = blockview.BlockView(Blocks, BLOCK_BUFFER_SIZE, HORIZON_Y, (CENTER_LINE, LEFT_LINE, RIGHT_LINE),
+                                            CENTER_LINE, PIXY_X_CENTER)
+
+        if self.chatty:
+            self.sayNow("I may not be the fastest but I have style")
+            #say("SLEEP 2")
+            time.sleep(2)
+
+    def loop(self):
+        """
+        Main loop, Gets blocks from pixy, analyzes target location,
+        chooses action for robot and sends instruction to motors
+        """
+        scene = self.scene
+        profiler = self.profiler
+        panLoop = self.panLoop
+        motion = self.motion
+
+        self.currentTime = datetime.now()
+        profiler.start_frame()
+        # If no new blocks, don't do anything
+        if not self.grabber and not self.waiter.wait(self.flag):
+            return self.flag.running
+        if not self.grabber:
+            profiler.camera()
+        profiler.mark('camera wait')
+
+        if self.firstPass:
+            self.say("Here goes")
+            self.startTime = time.time()
+            self.firstPass = False
+
+        frameStart = time.time()
+        scene.get_frame()
+        profiler.mark('get frame')
+        controlStart = time.time()
+        if scene.blocksSeen():
+            self.lastTime = self.currentTime
+
+        if self.finale:
+            self.refuseToPlay()
+            return False
+
+        if self.search:
+            pan = self.search.update(scene.seeCenter())
+            if pan is not None:
+                # still looking for the center line: the search drives
+                self.camera.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, pan)
+                self.drive()
+                profiler.mark('line search')
+                profiler.end_frame()
+                levels = motion.levels
+                self.blackbox.record(self.blackbox.count, scene.panError, pan, 0, 0, levels[0], levels[1],
+                                     (controlStart - frameStart) * 1000, (time.time() - controlStart) * 1000)
+                return self.flag.running
+
+        p = scene.panError
+        if p < 0:
+            p = -p
+        incr = p / 300.0
+        #print "panError: %f, incr: %f" % (scene.panError, incr)
+        #if incr > 0.65:
+        #    incr = 0.65
+        motion.throttle = self.initThrottle  # - incr / 1.5
+        if self.lookahead:
+            # ease off before a bend rather than once we are in it
+            motion.throttle *= 1 - CORNER_SLOWDOWN * min(1.0, abs(scene.bend) / FULL_BEND)
+        motion.diffDrive = self.diffDriveStraight + incr
+
+        # amount of steering depends on how much deviation is there
+        #diffDrive = diffGain * abs(float(turnError)) / PIXY_X_CENTER
+        # use full available throttle for charging forward
+        motion.advance = 1
+
+        panLoop.update(scene.panError)
+        profiler.mark('pan loop')
+
+        # Update pixy's pan position
+        self.camera.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, panLoop.m_pos)
+        profiler.mark('servo write')
+
+        # if Pixy sees nothing recognizable, don't move.
+        # time_difference = currentTime - lastTime
+        if not scene.seeCenter(): #time_difference.total_seconds() >= timeout:
+            self.blackbox.log(telemetry.INFO, "Stopping since see nothing")
+            motion.throttle = 0.0
+            motion.diffDrive = 1
+
+        turn = 0
+
+        # this is turning to left
+        if panLoop.m_pos > PIXY_RCS_CENTER_POS:
+            # should be still int32_t
+            self.turnError = panLoop.m_pos - PIXY_RCS_CENTER_POS
+            # <0 is turning left; currently only p-control is implemented
+            turn = float(self.turnError) / float(PIXY_RCS_CENTER_POS)
+
+        # this is turning to right
+        elif panLoop.m_pos < PIXY_RCS_CENTER_POS:
+            # should be still int32_t
+            self.turnError = PIXY_RCS_CENTER_POS - panLoop.m_pos
+            # >0 is turning left; currently only p-control is implemented
+            turn = -float(self.turnError) / float(PIXY_RCS_CENTER_POS)
+
+        self.pid.setPoint(0)
+        pid_bias = self.pid.update(turn)
+        profiler.mark('pid')
+        #print "PID controller: SP=%2.2f PV=%2.2f -> OP=%2.2f" % (0, turn, pid_bias)
+        self.pid_bias = pid_bias
+        self.last_turn = turn
+        motion.bias = pid_bias # use PID controller on turn bias
+
+        if pid_bias < -0.3:
+            self.say("Going left")
+        if pid_bias > 0.3:
+            self.say("Going right")
+
+        self.drive()
+        if self.tracker:
+            self.tracker.sent()
+        profiler.mark('motors')
+        profiler.end_frame()
+        levels = motion.levels
+        self.blackbox.record(self.blackbox.count, scene.panError, panLoop.m_pos, turn, pid_bias, levels[0], levels[1],
+                             (controlStart - frameStart) * 1000, (time.time() - controlStart) * 1000)
+        return self.flag.running
+
+    def drive(self):
+        if not self.allow_move:
+            return
+
+        if self.motion.advance < 0:
+            self.say("Backup up.  Beep.  Beep.  Beep.")
+            self.blackbox.log(telemetry.INFO, "Drive: Backing up.  Beeeep...Beeeep...Beeeep")
+
+        self.motion.send()
+
+    ### Dance moves
+
+    def move(self, t, advance, throttle, diffDrive, bias):
+        self.motion.set(advance, throttle, diffDrive, bias)
+        self.drive()
+        time.sleep(t)
+
+    def forward(self, t):
+        self.move(t, 1, .25, 0, 0)
+
+    def backward(self, t):
+        self.move(t, -1, .3, 0, 0)
+
+    def r_spin(self, t):
+        self.move(t, 1, .3, 1, 1)
+
+    def l_spin(self, t):
+        self.move(t, 1, .3, 1, -1)
+
+    def right(self, t):
+        self.move(t, 1, .4, .5, 0.5)
+
+    def left(self, t):
+        self.move(t, 1, .3, .5, -0.5)
+
+    ###  Experimental behaviors
+
+    def refuseToPlay(self):
+        self.motors.setSpeeds(0, 0)
+        self.l_spin(1)
+
+        self.sayNow("I'm going to dance")
         #say("SLEEP 1")
         time.sleep(2)
- 
-        right(1.5)
-        left(1.5)
-        forward(2)
-        backward(2)
-        r_spin(4)
-        l_spin(3)
-        r_spin(3)
-        right(1.5)
-        left(1.5)
-        backward(2)
-        forward(2)
-        r_spin(5)
-        l_spin(5)
+
+        self.right(1.5)
+        self.left(1.5)
+        self.forward(2)
+        self.backward(2)
+        self.r_spin(4)
+        self.l_spin(3)
+        self.r_spin(3)
+        self.right(1.5)
+        self.left(1.5)
+        self.backward(2)
+        self.forward(2)
+        self.r_spin(5)
+        self.l_spin(5)
         #while True:
         #    ok = loop()
         #    if not ok:
         #        break
         #pixy.pixy_close()
-        motors.setSpeeds(0, 0)
-
-    
-
-def backup():
-    panError = PIXY_X_CENTER - blocks[0].x
-    objectDist = refSize1 / (2 * math.tan(math.radians(blocks[0].width * pix2ang_factor)))
-    throttle = 0.5
-    # amount of steering depends on how much deviation is there
-    diffDrive = diffGain * abs(float(panError)) / PIXY_X_CENTER
-    distError = objectDist - targetDist
-    # this is in float format with sign indicating advancing or retreating
-    advance = driveGain * float(distError) / refDist
-
-
-def hailmary(block_count):
-    global throttle, diffDrive, diffGain, bias, advance, turnError, currentTime, lastTime, objectDist, distError, panError_prev, distError_prev
-    if len(block_count) == 0:
-        print "can't do hailmary with no blocks"
-        return
-
-    print "Attempting to hail Mary with %d block history"%len(block_count)
-    leftTotal = 0.0
-    rightTotal = 0.0
-    for (left, right) in block_count:
-        leftTotal += left
-        rightTotal += right
-    avgLeft = leftTotal / len(block_count)
-    avgRight = rightTotal / len(block_count)
-    print "Past %d frames had avg red blocks on (left=%d, right=%d)" % (AVG_N,avgLeft,avgRight)
-    # Turn towards the preponderance of red blocks
-    lastTime = currentTime
-    if avgLeft>avgRight:
-        print "Executing blind left turn"
-        bias = -1
-    elif avgRight>avgLeft:
-        print "Executing blind right turn"
-        bias = 1
-    else:
-        bias = 0
-    if bias != 0:
-        # Slow forward turn
-        advance = 1
-        throttle = 0.5
-        diffDrive = 1
-        # Reset pixy's head
-        pixy.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, PIXY_RCS_CENTER_POS)
-        normalDrive = False
-    #If hailmary didn't work, hold on to your rosary beads, we're going hunting!
-    else:
-        # Need some kind of hunting behavior here
-        #This situation usally arises when we're on a curve in one direction and want to sharply turn in the other direction
-        #pan the camera until we find a red block, then go straight toward it.  
-        print "Execute search and destroy"
-        i=0
-        noRedBlocks=True
-        advance=-1 #if we can't find it, retreat
-        while (noRedBlocks==True and i <= PIXY_RCS_MAX_POS):
-        #while redblock not found
-            #pan for red block
-            print "Panning for red block. i:%d" %(i)
-            pixy.pixy_rcs_set_position(PIXY_RCS_PAN_CHANNEL, i)
-            count = pixy.pixy_get_blocks(BLOCK_BUFFER_SIZE, blocks)
-            largestBlock = blocks[0]
-            #code stolen from earlier in file, maybe turn it into a function?
-            if largestBlock.signature == 2:
-                noRedBlocks=False
-                panError = PIXY_X_CENTER-blocks[0].x
-                p = panError / 40.0
-                if p < 0:
-                    p = -p
-                if p > 0.8:
-                    p = 0.8
-                throttle = 0.9 - p
-                diffDrive = 0.6
-                print "p: %f, panError: %d, turnError: %d" % (p, panError, turnError)
-                advance = 1
-            i= i +10
+        self.motors.setSpeeds(0, 0)
+
+    def close(self):
+        """Stop the robot and report, whatever state setup() got to"""
+        self.say("Good bye")
+        if self.grabber:
+            self.grabber.stop()
+            self.grabber.report()
+        self.pixy.pixy_close()
+        self.motors.setSpeeds(0, 0)
+        if self.waiter and not self.grabber:
+            self.waiter.report()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='The Heather RaspberryPi Robot Racer')
-    
+
     parser.add_argument('--chatty', dest='chatty', action='store_true')
-    parser.set_defaults(chatty=False)    
-    
+    parser.set_defaults(chatty=False)
+    parser.add_argument('--voice-url', dest='voice_url', metavar='URL',
+                        help='text to speech web service for --chatty')
+    parser.add_argument('--voice-max-age', dest='voice_max_age', type=float,
+                        help='seconds after which a saying still waiting is dropped')
+
     parser.add_argument('--bright', dest='bright', action='store_true')
-    parser.set_defaults(bright=False)    
+    parser.set_defaults(bright=False)
+
+    calibrate.add_arguments(parser)
 
     parser.add_argument('--no-move', dest='move', action='store_false')
-    parser.set_defaults(move=True)    
+    parser.set_defaults(move=True)
 
     parser.add_argument('--finale', dest='finale', action='store_true')
-    parser.set_defaults(finale=False)    
+    parser.set_defaults(finale=False)
 
     parser.add_argument("--lookahead", type=int, choices=[0, 1, 2],
-                        help="set the center lookahead")
-    parser.set_defaults(lookahead=0)    
+                        help="fit a line (1) or curve (2) through the center blocks and slow down before bends")
+    parser.set_defaults(lookahead=0)
+
+    framewait.add_arguments(parser)
+
+    scheduler.add_arguments(parser, dt)
+
+    parser.add_argument('--threaded', dest='threaded', action='store_true',
+                        help='read the camera on a background thread')
+    parser.set_defaults(threaded=False)
+
+    parser.add_argument('--processes', dest='processes', action='store_true',
+                        help='read the camera in a separate vision process')
+    parser.set_defaults(processes=False)
+
+    parser.add_argument('--numpy', dest='vectorised', action='store_true',
+                        help='group blocks with NumPy instead of a Python loop')
+    parser.set_defaults(vectorised=False)
+
+    parser.add_argument('--recover', dest='recover', action='store_true',
+                        help='when the center line is lost, turn towards where it was and pan to find it')
+    parser.set_defaults(recover=False)
+
+    parser.add_argument('--gains', dest='gains', metavar='FILE',
+                        help='steering and throttle gains to use, as written by tuning.py')
+
+    actuators.add_arguments(parser)
+    backends.add_arguments(parser)
+    telemetry.add_arguments(parser)
+    latency.add_arguments(parser)
+    tracking.add_arguments(parser)
+    startup.add_arguments(parser)
 
     args = parser.parse_args()
+    robot = Racer()
+    robot.blackbox = blackbox = telemetry.from_args(args)
+    robot.profiler = latency.from_args(args)
+    robot.tracker = tracking.from_args(args)
+    # kill -USR1 writes out the flight recorder without stopping
+    signal.signal(signal.SIGUSR1, lambda sig, frame: blackbox.dump())
     print "Chatty mode: ", args.chatty
     print "Alter brightness: ", args.bright
     print "Lookahead: ", args.lookahead
-    
-    if args.bright:
-        no_brightness_check = False
-
-    if not args.move:
-        allow_move = False
+    # the optional modules are only imported when their flags are given,
+    # so a plain run starts without loading them
+    if args.gains:
+        import tuning
+        robot.set_gains(tuning.load_gains(args.gains))
+        print "Gains from %s: %s" % (args.gains, ', '.join('%s=%g' % item for item in sorted(robot.gains().items())))
+
+    robot.no_brightness_check = not args.bright
+    robot.venue = args.venue
+    robot.lighting_file = args.lighting_file
+    robot.allow_move = args.move
+    robot.finale = args.finale
+    robot.wait_mode = args.wait
+    robot.wait_budget = args.wait_budget
+    robot.threaded = args.threaded
+    robot.vectorised = args.vectorised
+    robot.lookahead = args.lookahead
+    robot.recover = args.recover
+
+    options = backends.options_from(args, lambda: robot.flag.handle_SIGINT(None, None))
+    if args.replay:
+        args.camera = args.motors = 'scripted'
+        # replays run flat out, one recorded frame per step
+        args.period = 0
+        robot.threaded = False
+    if args.replay or args.record:
+        # recordings are made and checked frame by frame in this process
+        args.processes = False
+    # bring the camera and motor driver up side by side
+    boot = startup.Bringup()
+    open_camera = lambda: backends.init_camera(backends.open_camera(args.camera, options), args.retry_deadline)
+    if args.processes:
+        import vision
+        # the camera is opened in the vision process; this one only sees its frames
+        boot.start('camera', lambda: vision.VisionProcess(open_camera, BLOCK_BUFFER_SIZE, args.wait,
+                                                          args.wait_budget).start())
+    else:
+        boot.start('camera', open_camera)
+    if args.replay:
+        # the scripted motors check commands against the camera's recording
+        boot.result('camera')
+    boot.start('motors', lambda: backends.open_motors(args.motors, options))
+    pixy = boot.result('camera')
+    motors = boot.result('motors')
+    robot.camera_ready = True
+    if args.processes:
+        robot.vision = pixy
+    replay = pixy if args.replay else None
+    recording = None
+    if args.record:
+        import recorder
+        recording = recorder.Recorder(args.record)
+        pixy = recorder.RecordingPixy(pixy, recording)
+        motors = recorder.RecordingMotors(motors, recording)
+    if args.coalesce:
+        motors = actuators.MotorOutput(motors, args.motor_threshold, args.write_interval / 1000.0)
+        pixy = actuators.ServoOutput(pixy, args.servo_threshold, args.write_interval / 1000.0)
+    robot.pixy = pixy
+    robot.motors = motors
 
-    if args.finale:
-        finale = True
-        
     if args.chatty:
-        chatty = True
-        # Start thread to listen to say() commands and forward them to the text2speech web service
-        t = threading.Thread(target=voiceThreadLoop)
-        t.daemon = True
-        t.start()
-        
-    # Robot set up 
-    setup()
+        robot.chatty = True
+        # say() hands sayings to a background sender with its own connection to the text2speech web service
+        import voice
+        robot.speaker = voice.VoiceClient(args.voice_url or voice.VOICE_SERVICE_URL,
+                                          max_age=voice.MAX_AGE if args.voice_max_age is None else args.voice_max_age)
+
+    # Robot set up
+    boot.step('setup', robot.setup)
+    boot.ready()
     # Main loop
+    sched = scheduler.RateScheduler(args.period, args.overrun)
     try:
         while True:
-            ok = loop()
+            sched.tick()
+            ok = robot.loop()
             if not ok:
                 break
     finally:
-        say("Good bye")
-        pixy.pixy_close()
-        motors.setSpeeds(0, 0)
+        robot.close()
+        sched.report()
+        if args.coalesce:
+            motors.report()
+            pixy.report()
+        if recording:
+            recording.close()
+        if replay:
+            replay.report()
+        if robot.speaker:
+            # give "Good bye" a chance to be heard
+            robot.speaker.close(wait=1)
+            robot.speaker.report()
+        robot.profiler.report()
+        if robot.tracker:
+            robot.tracker.report()
+        if robot.search:
+            robot.search.report()
+        blackbox.report()
+        blackbox.dump()
+        blackbox.close()
         print "Robot Shutdown Completed"
-
@@ -0,0 +1,245 @@
+import time
+import struct
+import argparse
+import threading
+
+import framewait
+
+# file layout: MAGIC, then records back to back.  Every record starts with
+# a one byte tag and a double timestamp.
+MAGIC = 'PXYREC1\n'
+FRAME = struct.Struct('<cdH')       # 'F', time, block count
+BLOCK = struct.Struct('<6Ii')       # type, signature, x, y, width, height, angle (signed)
+MOTORS = struct.Struct('<cdhh')     # 'M', time, left, right
+SERVO = struct.Struct('<cdHi')      # 'S', time, channel, position
+
+class Recorder(object):
+    """
+    Appends frames and actuator commands to a compact binary file
+    """
+    def __init__(self, path):
+        self.m_file = open(path, 'ab')
+        if self.m_file.tell() == 0:
+            self.m_file.write(MAGIC)
+        self.m_lock = threading.Lock()
+        self.frames = 0
+
+    def frame(self, count, blocks):
+        data = FRAME.pack('F', time.time(), max(count, 0))
+        for i in range(count):
+            b = blocks[i]
+            data += BLOCK.pack(b.type, b.signature, b.x, b.y, b.width, b.height, b.angle)
+        with self.m_lock:
+            self.m_file.write(data)
+            self.frames += 1
+
+    def motors(self, left, right):
+        with self.m_lock:
+            self.m_file.write(MOTORS.pack('M', time.time(), left, right))
+
+    def servo(self, channel, pos):
+        with self.m_lock:
+            self.m_file.write(SERVO.pack('S', time.time(), channel, pos))
+
+    def close(self):
+        with self.m_lock:
+            self.m_file.close()
+        print "Recorded %d frames" % self.frames
+
+def read_records(path):
+    """
+    Yields ('F', time, blocks), ('M', time, left, right) and
+    ('S', time, channel, position) tuples, blocks being a list of
+    tuples of the Blocks fields
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a recording" % path)
+    offset = len(MAGIC)
+    while offset < len(data):
+        tag = data[offset]
+        if tag == 'F':
+            tag, stamp, count = FRAME.unpack_from(data, offset)
+            offset += FRAME.size
+            blocks = []
+            for i in range(count):
+                blocks.append(BLOCK.unpack_from(data, offset))
+                offset += BLOCK.size
+            yield tag, stamp, blocks
+        elif tag == 'M':
+            yield MOTORS.unpack_from(data, offset)
+            offset += MOTORS.size
+        elif tag == 'S':
+            yield SERVO.unpack_from(data, offset)
+            offset += SERVO.size
+        else:
+            raise ValueError("Corrupt record at offset %d of %s" % (offset, path))
+
+class RecordingPixy(object):
+    """
+    Wraps the pixy module and records every frame and servo move
+    """
+    def __init__(self, pixy, recorder):
+        self.m_pixy = pixy
+        self.m_recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.m_pixy, name)
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        count = self.m_pixy.pixy_get_blocks(max_blocks, blocks)
+        self.m_recorder.frame(count, blocks)
+        return count
+
+    def pixy_rcs_set_position(self, channel, pos):
+        self.m_recorder.servo(channel, pos)
+        return self.m_pixy.pixy_rcs_set_position(channel, pos)
+
+class RecordingMotors(object):
+    """
+    Wraps the motor driver and records every speed command
+    """
+    def __init__(self, motors, recorder):
+        self.m_motors = motors
+        self.m_recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.m_motors, name)
+
+    def setSpeeds(self, left, right):
+        self.m_recorder.motors(left, right)
+        self.m_motors.setSpeeds(left, right)
+
+class ReplayPixy(object):
+    """
+    Stands in for the pixy module and plays a recording back as fast as
+    the loop can take it.  Recorded commands are compared with the ones
+    the loop issues now; on_end() is called when the frames run out.
+    """
+    def __init__(self, path, on_end=None):
+        self.m_frames = []
+        self.m_motors = []
+        self.m_servos = []
+        first = last = None
+        for record in read_records(path):
+            if first is None:
+                first = record[1]
+            last = record[1]
+            if record[0] == 'F':
+                self.m_frames.append(record[2])
+            elif record[0] == 'M':
+                self.m_motors.append(record[2:])
+            else:
+                self.m_servos.append(record[2:])
+        self.m_duration = (last - first) if first is not None else 0
+        self.m_onEnd = on_end
+        self.m_next = 0
+        self.m_start = None
+        self.m_brightness = 0
+        self.m_motorIndex = 0
+        self.m_servoIndex = 0
+        self.mismatches = 0
+
+    def BlockArray(self, size):
+        return (framewait.Blocks * size)()
+
+    @property
+    def done(self):
+        return self.m_next >= len(self.m_frames)
+
+    def advance(self):
+        """
+        Step to the next frame without reading it; False at the end
+        """
+        if self.m_start is None:
+            self.m_start = time.time()
+        if self.done:
+            if self.m_onEnd:
+                self.m_onEnd()
+                self.m_onEnd = None
+            return False
+        self.m_next += 1
+        return True
+
+    def pixy_init(self):
+        return 0
+
+    def pixy_close(self):
+        pass
+
+    def pixy_error(self, code):
+        print "Replay error %d" % code
+
+    def pixy_blocks_are_new(self):
+        if self.done:
+            self.advance()
+            return 0
+        return 1
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        if not self.advance():
+            return 0
+        frame = self.m_frames[self.m_next - 1]
+        count = min(len(frame), max_blocks)
+        for i in range(count):
+            block = blocks[i]
+            (block.type, block.signature, block.x, block.y,
+             block.width, block.height, block.angle) = frame[i]
+        return count
+
+    def pixy_cam_get_brightness(self):
+        return self.m_brightness
+
+    def pixy_cam_set_brightness(self, brightness):
+        self.m_brightness = brightness
+        return 0
+
+    def pixy_rcs_set_position(self, channel, pos):
+        if self.m_servoIndex < len(self.m_servos):
+            if self.m_servos[self.m_servoIndex] != (channel, pos):
+                self.mismatches += 1
+            self.m_servoIndex += 1
+        return 0
+
+    def setSpeeds(self, left, right):
+        if self.m_motorIndex < len(self.m_motors):
+            if self.m_motors[self.m_motorIndex] != (left, right):
+                self.mismatches += 1
+            self.m_motorIndex += 1
+
+    def report(self):
+        elapsed = time.time() - self.m_start if self.m_start else 0
+        speedup = self.m_duration / elapsed if elapsed > 0 else 0
+        print "Replayed %d frames in %.2fs (%.1fs recorded, %.0fx real time)" % \
+            (self.m_next, elapsed, self.m_duration, speedup)
+        print "Replay: %d of %d motor and %d of %d servo commands compared, %d differed" % \
+            (self.m_motorIndex, len(self.m_motors), self.m_servoIndex, len(self.m_servos), self.mismatches)
+
+class ReplayMotors(object):
+    """
+    Motor driver for replays; commands are checked against the recording
+    """
+    def __init__(self, replay):
+        self.m_replay = replay
+
+    def setSpeeds(self, left, right):
+        self.m_replay.setSpeeds(left, right)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarise a recording')
+    parser.add_argument('file')
+    args = parser.parse_args()
+
+    counts = {'F': 0, 'M': 0, 'S': 0}
+    first = last = None
+    blocks = 0
+    for record in read_records(args.file):
+        counts[record[0]] += 1
+        if record[0] == 'F':
+            blocks += len(record[2])
+        if first is None:
+            first = record[1]
+        last = record[1]
+    print "%d frames (%d blocks), %d motor and %d servo commands over %.1fs" % \
+        (counts['F'], blocks, counts['M'], counts['S'], (last - first) if first else 0)
@@ -0,0 +1,192 @@
+"""
+Finds the center line again once it is lost, a step per frame inside the
+normal loop so the robot never stops reading the camera.  First a blind
+turn towards the side the line was last seen on, then a pan search that
+looks at a few far apart positions on that side, then the other, then
+ever finer positions in between, until a center line block has been seen
+on CONFIRM_FRAMES frames in a row.
+"""
+from collections import deque
+
+from control import PIXY_RCS_MIN_POS, PIXY_RCS_MAX_POS, PIXY_RCS_CENTER_POS
+
+# frames without the center line before recovery starts
+LOST_FRAMES = 5
+# frames of blind turning before the pan search, and how hard to turn
+BLIND_FRAMES = 10
+BLIND_THROTTLE = 0.5
+# frames for the servo to get there and a frame taken after it did
+SETTLE_FRAMES = 2
+# frames in a row the line must be seen before it counts as found
+CONFIRM_FRAMES = 2
+# the finest pan step searched
+FINE_STEP = 100
+
+# search phases
+IDLE = 0
+TURNING = 1
+SEARCHING = 2
+
+class SideHistory(object):
+    """
+    How many center line blocks were left and right of the middle over
+    the last size frames, kept as running sums so adding a frame is O(1)
+    """
+    __slots__ = ('m_left', 'm_right', 'left', 'right')
+
+    def __init__(self, size):
+        self.m_left = deque(maxlen=size)
+        self.m_right = deque(maxlen=size)
+        self.left = 0
+        self.right = 0
+
+    def add(self, left, right):
+        if len(self.m_left) == self.m_left.maxlen:
+            # the oldest frame is about to drop out
+            self.left -= self.m_left[0]
+            self.right -= self.m_right[0]
+        self.m_left.append(left)
+        self.m_right.append(right)
+        self.left += left
+        self.right += right
+
+    def favoured(self):
+        """-1 if the line has mostly been left of the middle, 1 if right, 0 if neither"""
+        if self.left > self.right:
+            return -1
+        if self.right > self.left:
+            return 1
+        return 0
+
+    def __len__(self):
+        return len(self.m_left)
+
+def search_positions(side):
+    """
+    Pan positions coarse to fine, each pass looking on the favoured side
+    (-1 left, 1 right, 0 neither) before the other.  Panning left is a
+    pan position above the center.
+    """
+    toward = 1 if side <= 0 else -1
+    positions = []
+    seen = set([PIXY_RCS_CENTER_POS])
+    step = (PIXY_RCS_MAX_POS - PIXY_RCS_MIN_POS) / 2
+    while step >= FINE_STEP:
+        near = []
+        far = []
+        offset = step / 2
+        while offset <= PIXY_RCS_MAX_POS - PIXY_RCS_CENTER_POS:
+            for sign, found in ((toward, near), (-toward, far)):
+                pos = PIXY_RCS_CENTER_POS + sign * offset
+                if pos not in seen:
+                    seen.add(pos)
+                    found.append(pos)
+            offset += step
+        positions += near + far
+        step /= 2
+    return tuple(positions)
+
+# worked out once for each side
+SEARCHES = dict((side, search_positions(side)) for side in (-1, 0, 1))
+
+class LineSearch(object):
+    """
+    Call update() every frame with whether the center line is in view.
+    While it is recovering it sets the drive state and returns the pan
+    position to command; otherwise it returns None and the normal loop
+    steers.
+    """
+    __slots__ = ('m_motion', 'm_history', 'm_panLoop', 'm_lost', 'm_phase', 'm_frames', 'm_side',
+                 'm_positions', 'm_next', 'm_pos', 'm_seen', 'recoveries', 'found')
+
+    def __init__(self, motion, history, panLoop):
+        self.m_motion = motion
+        self.m_history = history
+        self.m_panLoop = panLoop
+        self.m_lost = 0
+        self.m_phase = IDLE
+        self.m_frames = 0
+        self.m_side = 0
+        self.m_positions = SEARCHES[0]
+        self.m_next = 0
+        self.m_pos = PIXY_RCS_CENTER_POS
+        self.m_seen = 0
+        # times recovery started, and how many of those found the line
+        self.recoveries = 0
+        self.found = 0
+
+    @property
+    def active(self):
+        return self.m_phase != IDLE
+
+    def update(self, seen):
+        if self.m_phase == IDLE:
+            if seen:
+                self.m_lost = 0
+                return None
+            self.m_lost += 1
+            if self.m_lost < LOST_FRAMES:
+                return None
+            self.recoveries += 1
+            self.m_side = self.m_history.favoured()
+            self.m_positions = SEARCHES[self.m_side]
+            self._turn()
+
+        self.m_frames += 1
+        settled = self.m_frames > SETTLE_FRAMES
+        if seen and settled:
+            self.m_seen += 1
+            if self.m_seen >= CONFIRM_FRAMES:
+                return self._found()
+            # look again from here to make sure
+            return self.m_pos
+        self.m_seen = 0
+
+        if self.m_phase == TURNING:
+            if self.m_frames >= BLIND_FRAMES:
+                self._search()
+        elif settled:
+            # nothing here: on to the next position, or start over
+            if self.m_next >= len(self.m_positions):
+                self._turn()
+            else:
+                self._look(self.m_positions[self.m_next])
+                self.m_next += 1
+        return self.m_pos
+
+    def _turn(self):
+        """Turn blind towards the side the line was last seen on, camera ahead"""
+        self.m_phase = TURNING
+        self.m_frames = 0
+        self.m_seen = 0
+        self.m_pos = PIXY_RCS_CENTER_POS
+        if self.m_side:
+            self.m_motion.set(1, BLIND_THROTTLE, 1, self.m_side)
+        else:
+            self.m_frames = BLIND_FRAMES
+            self.m_motion.set(1, 0.0, 1, 0)
+
+    def _search(self):
+        """Stand still and pan"""
+        self.m_phase = SEARCHING
+        self.m_motion.set(1, 0.0, 1, 0)
+        self._look(self.m_positions[0])
+        self.m_next = 1
+
+    def _look(self, pos):
+        self.m_pos = pos
+        self.m_frames = 0
+        self.m_seen = 0
+
+    def _found(self):
+        # carry on following from where the camera found the line
+        self.m_panLoop.m_pos = self.m_pos
+        self.m_panLoop.m_prevError = 0x80000000L
+        self.m_phase = IDLE
+        self.m_lost = 0
+        self.m_seen = 0
+        self.found += 1
+        return None
+
+    def report(self):
+        print "Line search: recovered %d of %d times the center line was lost" % (self.found, self.recoveries)
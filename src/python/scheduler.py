@@ -0,0 +1,90 @@
+import time
+
+POLICIES = ['skip', 'catchup']
+
+# most ticks to run back to back when catching up
+MAX_CATCHUP = 5
+
+class RateScheduler(object):
+    """
+    Runs the control step at a fixed period (ms).
+
+    When a step overruns its slot, 'skip' drops the missed ticks and
+    realigns to the next one on the grid, while 'catchup' runs up to
+    max_catchup missed ticks back to back before giving up and
+    realigning.  A period of 0 means run flat out.
+    """
+    def __init__(self, period, policy='skip', max_catchup=MAX_CATCHUP):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overrun policy '%s'" % policy)
+        self.m_period = period / 1000.0
+        self.m_policy = policy
+        self.m_maxCatchup = max_catchup
+        self.m_start = None
+        self.m_deadline = None
+        self.m_behind = 0
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+
+    def tick(self):
+        """
+        Sleep until the next slot is due.  Call once before every step.
+        """
+        now = time.time()
+        if self.m_deadline is None:
+            self.m_start = now
+            self.m_deadline = now
+        elif self.m_period > 0:
+            self.m_deadline += self.m_period
+            late = now - self.m_deadline
+            if late > 0:
+                # the last step ran into this slot; it is a fresh overrun
+                # unless we are just working off an earlier backlog
+                missed = int(late / self.m_period)
+                if missed >= self.m_behind:
+                    self.overruns += 1
+                if self.m_policy == 'catchup' and missed <= self.m_maxCatchup:
+                    self.m_behind = missed
+                else:
+                    self.skipped += missed
+                    self.m_deadline += missed * self.m_period
+                    self.m_behind = 0
+            else:
+                self.m_behind = 0
+            if now < self.m_deadline:
+                time.sleep(self.m_deadline - now)
+                now = time.time()
+
+        jitter = max(0.0, now - self.m_deadline) if self.m_period > 0 else 0.0
+        self.ticks += 1
+        self.total_jitter += jitter
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+
+    @property
+    def rate(self):
+        """Achieved steps per second"""
+        if self.ticks < 2:
+            return 0.0
+        elapsed = time.time() - self.m_start
+        return self.ticks / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        if self.ticks == 0:
+            return
+        target = (1.0 / self.m_period) if self.m_period > 0 else 0
+        print "Scheduler (%s): %d steps at %.1fHz (target %.1fHz), %d overruns, %d ticks skipped" % \
+            (self.m_policy, self.ticks, self.rate, target, self.overruns, self.skipped)
+        print "Scheduler (%s): jitter avg %.2fms, max %.2fms" % \
+            (self.m_policy, 1000.0 * self.total_jitter / self.ticks, 1000.0 * self.max_jitter)
+
+def add_arguments(parser, period):
+    parser.add_argument('--period', dest='period', type=float,
+                        help='control step period in ms (0 runs flat out)')
+    parser.set_defaults(period=period)
+    parser.add_argument('--overrun', dest='overrun', choices=POLICIES,
+                        help='what to do with ticks missed by a slow step')
+    parser.set_defaults(overrun='skip')
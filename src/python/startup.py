@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import threading
+
+# hardware retries: 50ms, 100ms, 200ms ... at most 1s apart
+RETRY_FIRST = 0.05
+RETRY_MAX = 1.0
+# how long to keep trying a device before giving up on it
+RETRY_DEADLINE = 30.0
+
+def process_age():
+    """
+    Seconds since this process was started, from /proc, so time spent
+    importing modules counts too; None where there is no /proc
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # starttime is field 22, counted from after the command name
+            ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def retry(fn, what, deadline=RETRY_DEADLINE):
+    """
+    Call fn until it stops raising, backing off exponentially between
+    tries; after deadline seconds (None for ever) the last error is raised
+    """
+    give_up = None if deadline is None else time.time() + deadline
+    delay = RETRY_FIRST
+    while True:
+        try:
+            return fn()
+        except Exception, err:
+            if give_up is not None and time.time() + delay > give_up:
+                raise
+            print "%s failed (%s), trying again in %.2fs" % (what, err, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX)
+
+class Bringup(object):
+    """
+    Gets the robot from power-on to its first motor command: each device
+    is brought up on its own thread so a slow USB enumeration or serial
+    port does not hold up the others, and ready() prints where the time
+    went.
+    """
+    def __init__(self):
+        self.m_began = time.time()
+        self.m_age = process_age()
+        self.m_threads = {}
+        self.m_results = {}
+        self.m_errors = {}
+        self.m_steps = []
+
+    def start(self, name, fn):
+        """Bring up a device by calling fn on a thread of its own"""
+        def run():
+            start = time.time()
+            try:
+                self.m_results[name] = fn()
+            except Exception:
+                self.m_errors[name] = sys.exc_info()
+            self.m_steps.append((name, start, time.time()))
+        thread = threading.Thread(target=run, name='bringup-' + name)
+        thread.daemon = True
+        thread.start()
+        self.m_threads[name] = thread
+
+    def result(self, name, required=True):
+        """
+        Wait for a device started with start().  If it could not be
+        brought up its error is raised, or for an optional device a
+        warning is printed and None returned.
+        """
+        thread = self.m_threads[name]
+        while thread.is_alive():
+            # a timeout keeps CTRL-C working while we wait
+            thread.join(0.1)
+        if name in self.m_errors:
+            kind, err, trace = self.m_errors[name]
+            if required:
+                raise kind, err, trace
+            print "Carrying on without the %s: %s" % (name, err)
+            return None
+        return self.m_results[name]
+
+    def step(self, name, fn, *args):
+        """Call fn here and now, timed like the devices"""
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.m_steps.append((name, start, time.time()))
+
+    def ready(self):
+        now = time.time()
+        parts = []
+        if self.m_age is not None:
+            parts.append("%.0fms loading" % (self.m_age * 1000))
+        devices = [s for s in self.m_steps if s[0] in self.m_threads]
+        if devices:
+            span = max(s[2] for s in devices) - min(s[1] for s in devices)
+            parts.append("%s side by side in %.0fms" %
+                         (', '.join("%s %.0fms" % (name, (end - start) * 1000) for name, start, end in devices),
+                          span * 1000))
+        for name, start, end in self.m_steps:
+            if name not in self.m_threads:
+                parts.append("%s %.0fms" % (name, (end - start) * 1000))
+        total = now - self.m_began + (self.m_age or 0)
+        print "Ready in %.0fms: %s" % (total * 1000, '; '.join(parts))
+        return total
+
+def add_arguments(parser):
+    parser.add_argument('--retry-deadline', dest='retry_deadline', type=float, metavar='SECONDS',
+                        help='how long to keep retrying the camera and serial link at start up')
+    parser.set_defaults(retry_deadline=RETRY_DEADLINE)
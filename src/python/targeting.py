@@ -0,0 +1,119 @@
+"""
+Picks which block to chase when more than one is in view.  Pixy sorts
+blocks largest first, so without this the robot chases whatever happens
+to look biggest this frame.  Every block of a signature worth chasing is
+scored on how near it is, how far off the middle of the view it is and
+how many frames in a row it has been seen, so the robot sticks with the
+opponent it is already on rather than flicking between them.  Ranges
+come from tables worked out once for every block width Pixy can report.
+"""
+import math
+
+from control import PIXY_MAX_X, PIXY_X_CENTER
+from tracking import GATE
+
+# how much each thing counts in a block's score
+RANGE_WEIGHT = 1.0
+OFFSET_WEIGHT = 0.5
+AGE_WEIGHT = 0.5
+# frames in a row after which a block gets the whole age bonus
+FULL_AGE = 10
+
+def range_table(size, pix2ang_factor):
+    """
+    Distance (mm) to an object size mm across for each width in pixels
+    from 0 to the full width of the view.  Nothing narrower than a pixel
+    can be told apart, so width 0 reads as 1.
+    """
+    table = [size / (2 * math.tan(math.radians(width * pix2ang_factor))) for width in range(1, PIXY_MAX_X + 2)]
+    return [table[0]] + table
+
+class TargetSelector(object):
+    """
+    Call select() on each frame.  targets maps each signature worth
+    chasing to its (weight, range table); range_scale is the range (mm)
+    that costs a block RANGE_WEIGHT.
+    """
+    __slots__ = ('m_targets', 'm_rangeScale', 'm_gate', 'm_seen', 'm_nextId', 'm_chosen',
+                 'frames', 'candidates', 'switches')
+
+    def __init__(self, targets, range_scale, gate=GATE):
+        self.m_targets = targets
+        self.m_rangeScale = float(range_scale)
+        self.m_gate = gate * gate
+        # [signature, x, y, age, id, taken] for each candidate in the last frame
+        self.m_seen = []
+        self.m_nextId = 0
+        self.m_chosen = None
+        self.frames = 0
+        self.candidates = 0
+        self.switches = 0
+
+    def select(self, blocks, count):
+        """Index of the block to chase, or -1 if none is worth chasing"""
+        targets = self.m_targets
+        previous = self.m_seen
+        seen = []
+        best = -1
+        bestScore = None
+        bestId = None
+        for i in range(count):
+            block = blocks[i]
+            signature = block.signature
+            target = targets.get(signature)
+            if target is None:
+                continue
+            weight, ranges = target
+            x = block.x
+            y = block.y
+            # the same block as last frame if it is the nearest one within
+            # the gate that no other block has already been matched to
+            match = None
+            nearest = self.m_gate
+            for before in previous:
+                if before[5] or before[0] != signature:
+                    continue
+                dx = x - before[1]
+                dy = y - before[2]
+                d = dx * dx + dy * dy
+                if d <= nearest:
+                    nearest = d
+                    match = before
+            if match is None:
+                age = 1
+                ident = self.m_nextId
+                self.m_nextId += 1
+            else:
+                match[5] = True
+                age = match[3] + 1
+                ident = match[4]
+            seen.append([signature, x, y, age, ident, False])
+            distance = ranges[min(block.width, PIXY_MAX_X + 1)]
+            score = (weight - RANGE_WEIGHT * distance / self.m_rangeScale
+                     - OFFSET_WEIGHT * abs(x - PIXY_X_CENTER) / PIXY_X_CENTER
+                     + AGE_WEIGHT * min(age, FULL_AGE) / FULL_AGE)
+            if bestScore is None or score > bestScore:
+                best = i
+                bestScore = score
+                bestId = ident
+        self.m_seen = seen
+        self.frames += 1
+        self.candidates += len(seen)
+        if bestId is not None:
+            if self.m_chosen is not None and bestId != self.m_chosen:
+                self.switches += 1
+            self.m_chosen = bestId
+        return best
+
+    def report(self):
+        print "Targeting: %d frames, %.1f targets in view on average, switched target %d times" % \
+            (self.frames, float(self.candidates) / self.frames if self.frames else 0, self.switches)
+
+def add_arguments(parser):
+    parser.add_argument('--rank-targets', dest='rank_targets', action='store_true',
+                        help='chase the best target in view by range, offset and how long it has been seen, '
+                             'rather than the largest')
+    parser.set_defaults(rank_targets=False)
+
+def from_args(args, targets, range_scale):
+    return TargetSelector(targets, range_scale) if args.rank_targets else None
@@ -0,0 +1,181 @@
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+import tempfile
+
+# log levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING}
+
+# a repeated message is printed at most once per this many seconds
+LOG_INTERVAL = 1.0
+# messages remembered before ones not seen for an interval are forgotten
+LOG_MEMORY = 256
+# one minute of frames at 50Hz
+RING_SIZE = 3000
+# where the ring is written at shutdown without --telemetry, out of the
+# way of the source tree the robot is usually run from
+DUMP_FILE = os.path.join(tempfile.gettempdir(), 'telemetry.bin')
+
+# file layout: HEADER, then size fixed-size RECORDs.  count is the number
+# of records ever written, so the oldest one is at slot count % size once
+# the ring has wrapped.
+MAGIC = 'PXYTLM1\n'
+HEADER = struct.Struct('<8sII')     # magic, size, count
+# time, frame, panError, pan position, turn, PID output, LDrive, RDrive,
+# ms getting the frame, ms deciding what to do with it
+RECORD = struct.Struct('<dIffffhhff')
+FIELDS = ('time', 'frame', 'panError', 'pan', 'turn', 'pid', 'left', 'right', 'frame_ms', 'control_ms')
+
+class Telemetry(object):
+    """
+    A flight recorder for the control loop.  record() packs one
+    fixed-size record per frame into a ring buffer allocated up front,
+    which costs about as much as a function call; nothing is printed.
+    With a path the ring is an mmap of that file, so it survives a crash.
+
+    log() replaces print for messages that may come every frame: below
+    the level nothing is done at all, and a message already printed with
+    the same arguments in the last interval seconds is only counted.
+    """
+    def __init__(self, size=RING_SIZE, path=None, level=INFO, interval=LOG_INTERVAL):
+        self.m_size = size
+        self.m_path = path
+        length = HEADER.size + size * RECORD.size
+        if path:
+            rotate(path)
+            self.m_file = open(path, 'w+b')
+            self.m_file.truncate(length)
+            self.m_buffer = mmap.mmap(self.m_file.fileno(), length)
+        else:
+            self.m_file = None
+            self.m_buffer = bytearray(length)
+        self.m_count = 0
+        self.m_level = level
+        self.m_interval = interval
+        self.m_logged = {}
+        self.suppressed = 0
+        HEADER.pack_into(self.m_buffer, 0, MAGIC, size, 0)
+
+    def record(self, frame, pan_error, pan, turn, pid, left, right, frame_ms, control_ms):
+        offset = HEADER.size + (self.m_count % self.m_size) * RECORD.size
+        RECORD.pack_into(self.m_buffer, offset, time.time(), frame, pan_error, pan, turn, pid,
+                         left, right, frame_ms, control_ms)
+        self.m_count += 1
+        HEADER.pack_into(self.m_buffer, 0, MAGIC, self.m_size, self.m_count)
+
+    def log(self, level, message, *args):
+        if level < self.m_level:
+            return
+        now = time.time()
+        # "Saying 'Going left'" must not hide "Saying 'Going right'"
+        key = (message, args)
+        last = self.m_logged.get(key)
+        if last and now - last[0] < self.m_interval:
+            last[1] += 1
+            self.suppressed += 1
+            return
+        text = message % args if args else message
+        if last and last[1]:
+            text += " (%d more)" % last[1]
+        if last is None and len(self.m_logged) >= LOG_MEMORY:
+            self._forget(now)
+        self.m_logged[key] = [now, 0]
+        print text
+
+    def _forget(self, now):
+        """Drop messages whose interval is over, so varying arguments can't grow the table"""
+        for key, last in self.m_logged.items():
+            if now - last[0] >= self.m_interval:
+                del self.m_logged[key]
+
+    @property
+    def count(self):
+        return self.m_count
+
+    def dump(self, path=None):
+        """
+        Write the ring out; an mmap-backed ring is just flushed to its file
+        """
+        if self.m_file:
+            self.m_buffer.flush()
+            path = self.m_path
+        else:
+            path = path or DUMP_FILE
+            with open(path, 'wb') as f:
+                f.write(self.m_buffer)
+        print "Telemetry: %d frames recorded, last %d in %s" % (self.m_count, min(self.m_count, self.m_size), path)
+
+    def report(self):
+        if self.suppressed:
+            print "Telemetry: %d repeated messages not printed" % self.suppressed
+
+    def close(self):
+        if self.m_file:
+            self.m_buffer.close()
+            self.m_file.close()
+
+def rotate(path):
+    """
+    Move last run's recorder out of the way to path.1, so a restart after
+    a crash does not wipe the record of it
+    """
+    if os.path.exists(path):
+        os.rename(path, path + '.1')
+        print "Telemetry: kept the last run's %s as %s.1" % (path, path)
+
+def read_records(path):
+    """
+    Yields the records in a dump, oldest first, as tuples in FIELDS order
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, size, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("%s is not a telemetry dump" % path)
+    first = count - min(count, size)
+    for i in range(first, count):
+        yield RECORD.unpack_from(data, HEADER.size + (i % size) * RECORD.size)
+
+def add_arguments(parser):
+    parser.add_argument('--telemetry', dest='telemetry', metavar='FILE',
+                        help='keep the per-frame flight recorder in FILE (written as it goes); '
+                             'one already there is kept as FILE.1')
+    parser.add_argument('--telemetry-size', dest='telemetry_size', type=int,
+                        help='frames the flight recorder keeps')
+    parser.set_defaults(telemetry_size=RING_SIZE)
+    parser.add_argument('--log-level', dest='log_level', choices=sorted(LEVELS, key=LEVELS.get),
+                        help='least important messages to print')
+    parser.set_defaults(log_level='info')
+    parser.add_argument('--log-interval', dest='log_interval', type=float,
+                        help='seconds before the same message is printed again')
+    parser.set_defaults(log_interval=LOG_INTERVAL)
+
+def from_args(args):
+    return Telemetry(args.telemetry_size, args.telemetry, LEVELS[args.log_level], args.log_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarise a telemetry dump')
+    parser.add_argument('file')
+    parser.add_argument('--csv', action='store_true', help='print every record as CSV instead')
+    args = parser.parse_args()
+
+    records = list(read_records(args.file))
+    if args.csv:
+        print ','.join(FIELDS)
+        for r in records:
+            print ','.join(str(v) for v in r)
+        sys.exit(0)
+    if not records:
+        print "No records"
+        sys.exit(0)
+    span = records[-1][0] - records[0][0]
+    print "%d frames over %.1fs" % (len(records), span)
+    for i in range(2, len(FIELDS)):
+        values = [r[i] for r in records]
+        print "  %-10s min %9.2f  mean %9.2f  max %9.2f" % (FIELDS[i], min(values), sum(values) / len(values), max(values))
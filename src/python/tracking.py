@@ -0,0 +1,194 @@
+"""
+Predicts where blocks will be when the motor command made from them
+lands.  Each block is matched to the nearest track of its signature from
+the frame before, an alpha-beta filter per track estimates its position
+and velocity in the image, and the block's x and y are moved to where
+the track will be lead seconds after the frame was captured.  lead is
+the measured capture to motor command delay, plus --predict-lead for the
+motor driver and wheels.
+"""
+import sys
+import time
+
+from control import PIXY_MAX_X, PIXY_MAX_Y
+
+# filter gains: how much of a surprise goes into position and velocity
+ALPHA = 0.6
+BETA = 0.2
+# pixels a block can move between frames and still be the same one
+GATE = 40
+# frames a track survives without a block
+MAX_MISSED = 3
+# how quickly the capture to command delay estimate follows changes
+LEAD_SMOOTHING = 0.1
+
+class Track(object):
+    """One block followed from frame to frame"""
+    __slots__ = ('signature', 'x', 'y', 'vx', 'vy', 'mx', 'my', 'stamp', 'missed')
+
+    def __init__(self, signature, x, y, stamp):
+        self.signature = signature
+        # filtered position and velocity (pixels, pixels per second)
+        self.x = self.mx = float(x)
+        self.y = self.my = float(y)
+        self.vx = self.vy = 0.0
+        self.stamp = stamp
+        self.missed = 0
+
+class Tracker(object):
+    """
+    Sits between pixy_get_blocks() and whatever reads the blocks: call
+    update() on each frame and sent() once its motor command is out.
+    """
+    def __init__(self, lead=0.0, alpha=ALPHA, beta=BETA, gate=GATE, max_missed=MAX_MISSED, clock=time.time):
+        self.clock = clock
+        self.m_extra = lead
+        self.m_alpha = alpha
+        self.m_beta = beta
+        self.m_gate = gate
+        self.m_maxMissed = max_missed
+        self.m_tracks = []
+        self.m_stamp = None
+        self.m_delay = None
+        # one-frame-ahead x error of the filter, and of holding the last
+        # position as the loop did without it
+        self.m_predError = 0.0
+        self.m_holdError = 0.0
+        self.m_matched = 0
+        self.m_started = 0
+        self.frames = 0
+
+    @property
+    def lead(self):
+        """Seconds after capture the motor command is expected to land"""
+        return (self.m_delay or 0.0) + self.m_extra
+
+    def update(self, blocks, count, stamp=None):
+        """
+        Match the count blocks captured at stamp to the tracks, then move
+        each block to its track's predicted position
+        """
+        if stamp is None:
+            stamp = self.clock()
+        self.m_stamp = stamp
+        self.frames += 1
+        tracks = self.m_tracks
+        for track in tracks:
+            track.missed += 1
+        lead = self.lead
+        gate = self.m_gate * self.m_gate
+        for i in range(count):
+            block = blocks[i]
+            signature = block.signature
+            mx = block.x
+            my = block.y
+            best = None
+            nearest = gate
+            for track in tracks:
+                if track.missed == 0 or track.signature != signature:
+                    continue
+                dt = stamp - track.stamp
+                ex = mx - (track.x + track.vx * dt)
+                ey = my - (track.y + track.vy * dt)
+                d = ex * ex + ey * ey
+                if d <= nearest:
+                    best = track
+                    nearest = d
+            if best is None:
+                tracks.append(Track(signature, mx, my, stamp))
+                self.m_started += 1
+                continue
+            self._correct(best, mx, my, stamp)
+            # the block as it will be seen when the command lands, kept
+            # within GATE pixels of where it is so a bad velocity cannot
+            # throw the robot off
+            dx = max(-self.m_gate, min(self.m_gate, best.vx * lead))
+            dy = max(-self.m_gate, min(self.m_gate, best.vy * lead))
+            block.x = max(0, min(PIXY_MAX_X, int(round(best.x + dx))))
+            block.y = max(0, min(PIXY_MAX_Y, int(round(best.y + dy))))
+            # the SWIG BlockArray hands out copies, so put it back
+            blocks[i] = block
+        if tracks:
+            self.m_tracks = [t for t in tracks if t.missed <= self.m_maxMissed]
+        return count
+
+    def _correct(self, track, mx, my, stamp):
+        dt = stamp - track.stamp
+        if dt > 0:
+            rx = mx - (track.x + track.vx * dt)
+            ry = my - (track.y + track.vy * dt)
+            self.m_predError += abs(rx)
+            self.m_holdError += abs(mx - track.mx)
+            self.m_matched += 1
+            track.x += track.vx * dt + self.m_alpha * rx
+            track.y += track.vy * dt + self.m_alpha * ry
+            track.vx += self.m_beta * rx / dt
+            track.vy += self.m_beta * ry / dt
+        else:
+            track.x = mx
+            track.y = my
+        track.mx = mx
+        track.my = my
+        track.stamp = stamp
+        track.missed = 0
+
+    def sent(self, now=None):
+        """The motor command made from the last frame has just gone out"""
+        if self.m_stamp is None:
+            return
+        if now is None:
+            now = self.clock()
+        delay = now - self.m_stamp
+        if self.m_delay is None:
+            self.m_delay = delay
+        else:
+            self.m_delay += LEAD_SMOOTHING * (delay - self.m_delay)
+
+    def report(self):
+        print "Tracker: %d frames, %d tracks started, predicting %.1fms ahead (%.1fms capture to command + %.1fms)" % \
+            (self.frames, self.m_started, self.lead * 1000, (self.m_delay or 0.0) * 1000, self.m_extra * 1000)
+        if self.m_matched:
+            pred = self.m_predError / self.m_matched
+            hold = self.m_holdError / self.m_matched
+            print "Tracker: next frame x error %.2fpx predicted vs %.2fpx holding the last position (%+.0f%%)" % \
+                (pred, hold, (pred / hold - 1) * 100 if hold else 0)
+
+def add_arguments(parser):
+    parser.add_argument('--predict', dest='predict', action='store_true',
+                        help='track blocks between frames and steer by where they will be when the motors respond')
+    parser.set_defaults(predict=False)
+    parser.add_argument('--predict-lead', dest='predict_lead', type=float, default=0.0, metavar='MS',
+                        help='with --predict, how long after the command the wheels respond')
+
+def from_args(args):
+    return Tracker(args.predict_lead / 1000.0) if args.predict else None
+
+if __name__ == '__main__':
+    # check predictions reach an array that, like pixy's SWIG BlockArray,
+    # returns a copy of the block from blocks[i]
+    import copy
+    import framewait
+
+    class CopyingBlockArray(object):
+        def __init__(self, size):
+            self.m_blocks = (framewait.Blocks * size)()
+        def __getitem__(self, i):
+            return copy.copy(self.m_blocks[i])
+        def __setitem__(self, i, block):
+            self.m_blocks[i] = block
+
+    tracker = Tracker(lead=0.05)
+    blocks = CopyingBlockArray(1)
+    for frame in range(10):
+        # a block moving right at 500 pixels a second
+        block = blocks[0]
+        block.signature = 1
+        block.x = 100 + 10 * frame
+        block.y = 100
+        blocks[0] = block
+        tracker.update(blocks, 1, frame * 0.02)
+    seen = blocks[0].x
+    print "Tracker: block at %dpx reads as %dpx predicted 50ms ahead" % (100 + 10 * frame, seen)
+    if seen <= 100 + 10 * frame:
+        print "Tracker: predicted positions did not reach the BlockArray"
+        sys.exit(1)
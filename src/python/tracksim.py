@@ -0,0 +1,410 @@
+"""
+Closed-loop track simulator for the racer.  A differential drive robot
+follows the motor speeds Racer.drive() sets, carrying a simulated Pixy
+on its pan servo that sees dashed tape lines and posts laid out along a
+track.  The racer's own setup() and loop() run unmodified against it,
+one loop per simulated 50Hz frame and as fast as the CPU allows.
+
+    python tracksim.py --laps 3
+    python tracksim.py --straight 3000 --radius 600 --width 500
+    python tracksim.py --gains gains.json
+"""
+import math
+import time
+import argparse
+from collections import deque
+
+import numpy
+
+import bench
+import backends
+import framewait
+import tuning
+import tracking
+from control import CENTER_LINE, LEFT_LINE, RIGHT_LINE, L_POST, R_POST
+
+##### camera
+PIXY_WIDTH = 320
+PIXY_HEIGHT = 200
+# racer.pix2ang_factor is degrees per pixel of the 640x400 sensor image;
+# block coordinates are in 320x200, so a block pixel is twice that
+DEG_PER_PIXEL = 2 * 0.117
+CAMERA_HEIGHT = 120.0       # mm above the floor
+CAMERA_TILT = 25.0          # degrees below horizontal at the center row
+CAMERA_FORWARD = 60.0       # mm ahead of the axle
+NEAR = 40.0                 # mm, nothing closer than this is in focus
+HALF_FOV_SLOPE = math.tan(math.radians(PIXY_WIDTH / 2 * DEG_PER_PIXEL))
+# pan servo: 0..1000, 500 straight ahead, more is further left
+PAN_CENTER = 500
+PAN_DEG_PER_UNIT = 0.18
+
+##### robot
+MM_PER_UNIT = 1.0           # mm/s per motor driver speed unit
+WHEEL_BASE = 120.0          # mm
+MOTOR_LAG = 0.08            # s, time constant of the wheels reaching speed
+COMMAND_LATENCY = 0.03      # s from a frame being captured to the command made from it reaching the wheels
+
+##### track
+TAPE_WIDTH = 20.0
+DASH = 100.0
+GAP = 100.0
+POST_SPACING = 1000.0
+POST_OFFSET = 100.0         # mm outside the edge lines
+POST_WIDTH = 30.0
+POST_HEIGHT = 50.0
+# mm either side of the last position searched when finding the robot
+WINDOW = 300.0
+
+FRAME_TIME = 1.0 / framewait.PIXY_FRAME_RATE
+
+class Track(object):
+    """
+    A closed track from its center line polyline (an Nx2 array in mm,
+    anticlockwise), with edge lines width/2 either side.  All three lines
+    are dashed tape; posts stand outside both edges.
+    """
+    def __init__(self, points, width):
+        self.width = width
+        center = numpy.asarray(points, dtype=float)
+        step = numpy.roll(center, -1, axis=0) - center
+        seg = numpy.hypot(step[:, 0], step[:, 1])
+        self.length = seg.sum()
+        self.m_s = numpy.concatenate(([0.0], numpy.cumsum(seg)[:-1]))
+        tangent = step / seg[:, None]
+        # left of the direction of travel
+        normal = numpy.column_stack((-tangent[:, 1], tangent[:, 0]))
+        self.m_center = center
+        self.m_normal = normal
+        self.m_tangent = tangent
+        self.m_window = max(1, int(WINDOW / seg.mean()))
+
+        # every dash of every line, and every post, in flat arrays so the
+        # camera can project them all at once
+        starts = numpy.arange(0.0, self.length - DASH, DASH + GAP)
+        a, b, signatures = [], [], []
+        for signature, offset in ((CENTER_LINE, 0.0), (LEFT_LINE, width / 2.0), (RIGHT_LINE, -width / 2.0)):
+            a.append(self.point_at(starts, offset))
+            b.append(self.point_at(starts + DASH, offset))
+            signatures.append(numpy.full(len(starts), signature, dtype=int))
+        self.dash_a = numpy.concatenate(a)
+        self.dash_b = numpy.concatenate(b)
+        self.dash_signature = numpy.concatenate(signatures)
+        s = numpy.arange(0.0, self.length, POST_SPACING)
+        self.posts = numpy.concatenate((self.point_at(s, width / 2.0 + POST_OFFSET),
+                                        self.point_at(s, -width / 2.0 - POST_OFFSET)))
+        self.post_signature = numpy.repeat((L_POST, R_POST), len(s))
+        self.points = numpy.concatenate((self.dash_a, self.dash_b, self.posts))
+
+    def point_at(self, s, offset=0.0):
+        """Points offset mm left of the center line at arc lengths s"""
+        s = numpy.mod(s, self.length)
+        i = numpy.searchsorted(self.m_s, s, side='right') - 1
+        along = (s - self.m_s[i])[:, None]
+        return self.m_center[i] + self.m_tangent[i] * along + self.m_normal[i] * offset
+
+    def locate(self, x, y, near=None):
+        """
+        Arc length of the nearest center line point and how far left of it
+        (x, y) is; with near, only points within WINDOW of that arc length
+        are searched
+        """
+        if near is None:
+            d = self.m_center - (x, y)
+            i = int(numpy.argmin(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]))
+        else:
+            j = int(numpy.searchsorted(self.m_s, near))
+            window = numpy.arange(j - self.m_window, j + self.m_window) % len(self.m_s)
+            d = self.m_center[window] - (x, y)
+            i = int(window[numpy.argmin(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])])
+        rel = (x - self.m_center[i, 0], y - self.m_center[i, 1])
+        along = rel[0] * self.m_tangent[i, 0] + rel[1] * self.m_tangent[i, 1]
+        lateral = rel[0] * self.m_normal[i, 0] + rel[1] * self.m_normal[i, 1]
+        return (self.m_s[i] + along) % self.length, lateral
+
+    def start_pose(self):
+        return self.m_center[0, 0], self.m_center[0, 1], math.atan2(self.m_tangent[0, 1], self.m_tangent[0, 0])
+
+def stadium(straight=2000.0, radius=800.0, width=600.0, spacing=10.0):
+    """Two straights joined by half circles, driven anticlockwise"""
+    points = []
+    for x in numpy.arange(0.0, straight, spacing):
+        points.append((x, -radius))
+    for a in numpy.arange(-math.pi / 2, math.pi / 2, spacing / radius):
+        points.append((straight + radius * math.cos(a), radius * math.sin(a)))
+    for x in numpy.arange(straight, 0.0, -spacing):
+        points.append((x, radius))
+    for a in numpy.arange(math.pi / 2, 3 * math.pi / 2, spacing / radius):
+        points.append((radius * math.cos(a), radius * math.sin(a)))
+    return Track(points, width)
+
+class SimRobot(object):
+    """
+    The motor driver: a command lands latency seconds after the frame it
+    was made from was captured, wheel speeds then follow it with a first
+    order lag, and step() moves the robot through simulated time.  now
+    is the simulated time inside the loop, for the racer's clocks.
+    """
+    def __init__(self, x=0.0, y=0.0, heading=0.0, latency=COMMAND_LATENCY):
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.now = 0.0
+        self.m_time = 0.0
+        self.m_latency = latency
+        self.m_pending = deque()
+        self.m_command = (0, 0)
+        self.m_left = 0.0
+        self.m_right = 0.0
+        self.commands = 0
+
+    def capture(self):
+        """A frame is taken now"""
+        self.now = self.m_time
+
+    def setSpeeds(self, left, right):
+        self.now = self.m_time + self.m_latency
+        self.m_pending.append((self.now, (left, right)))
+        self.commands += 1
+
+    def step(self, dt):
+        end = self.m_time + dt
+        pending = self.m_pending
+        while pending and pending[0][0] <= end:
+            due, command = pending.popleft()
+            if due > self.m_time:
+                self._move(due - self.m_time)
+                self.m_time = due
+            self.m_command = command
+        if end > self.m_time:
+            self._move(end - self.m_time)
+        self.m_time = end
+
+    def _move(self, dt):
+        k = dt / (MOTOR_LAG + dt)
+        self.m_left += (self.m_command[0] * MM_PER_UNIT - self.m_left) * k
+        self.m_right += (self.m_command[1] * MM_PER_UNIT - self.m_right) * k
+        speed = (self.m_left + self.m_right) / 2.0
+        self.heading += (self.m_right - self.m_left) / WHEEL_BASE * dt
+        self.x += speed * math.cos(self.heading) * dt
+        self.y += speed * math.sin(self.heading) * dt
+
+class SimCamera(backends.NullPixy):
+    """
+    The Pixy on its pan servo, on the robot: projects the track's tape
+    dashes and posts that are in view into blocks, largest first as the
+    Pixy reports them
+    """
+    def __init__(self, track, robot):
+        self.m_track = track
+        self.m_robot = robot
+        self.m_pan = PAN_CENTER
+        self.m_brightness = 0
+
+    def pixy_rcs_set_position(self, channel, pos):
+        if channel == 0:
+            self.m_pan = pos
+        return 0
+
+    def pixy_cam_get_brightness(self):
+        return self.m_brightness
+
+    def pixy_cam_set_brightness(self, brightness):
+        self.m_brightness = brightness
+        return 0
+
+    def _row(self, height, forward):
+        """Image rows of points height mm off the floor, forward mm ahead"""
+        below = numpy.degrees(numpy.arctan((CAMERA_HEIGHT - height) / forward))
+        return PIXY_HEIGHT / 2.0 + (below - CAMERA_TILT) / DEG_PER_PIXEL
+
+    def view(self):
+        """
+        Signature, center x, y, width and height of the blobs in view,
+        largest first, as rows of an integer array
+        """
+        robot = self.m_robot
+        track = self.m_track
+        yaw = robot.heading + math.radians((self.m_pan - PAN_CENTER) * PAN_DEG_PER_UNIT)
+        c, s = math.cos(yaw), math.sin(yaw)
+        cx = robot.x + CAMERA_FORWARD * math.cos(robot.heading)
+        cy = robot.y + CAMERA_FORWARD * math.sin(robot.heading)
+
+        # dash ends and post bases in camera coordinates, all in one go
+        points = track.points
+        rx = points[:, 0] - cx
+        ry = points[:, 1] - cy
+        forward = rx * c + ry * s
+        left = ry * c - rx * s
+        # anything behind the camera, or wholly off one side of the picture,
+        # can be dropped before the trigonometry
+        reach = forward * HALF_FOV_SLOPE
+        n = len(track.dash_a)
+        fa, fb, fp = forward[:n], forward[n:2 * n], forward[2 * n:]
+        la, lb, lp = left[:n], left[n:2 * n], left[2 * n:]
+        ra, rb, rp = reach[:n], reach[n:2 * n], reach[2 * n:]
+        dashes = numpy.nonzero((fa > NEAR) & (fb > NEAR) & ~((la > ra) & (lb > rb)) & ~((la < -ra) & (lb < -rb)))[0]
+        posts = numpy.nonzero((fp > NEAR) & (numpy.abs(lp) < rp + POST_WIDTH))[0]
+        keep = numpy.concatenate((dashes, dashes + n, posts + 2 * n))
+        forward = forward[keep]
+        x = PIXY_WIDTH / 2.0 - numpy.degrees(numpy.arctan2(left[keep], forward)) / DEG_PER_PIXEL
+        y = self._row(0.0, forward)
+        scale = numpy.degrees(1.0 / forward) / DEG_PER_PIXEL
+        d, p = len(dashes), 2 * len(dashes)
+
+        # dashes: the box round both ends, as wide as the tape at the near end
+        tape = TAPE_WIDTH * numpy.maximum(scale[:d], scale[d:p])
+        xa, xb, ya, yb = x[:d], x[d:p], y[:d], y[d:p]
+        # posts: upright, POST_WIDTH wide and POST_HEIGHT tall
+        half = POST_WIDTH / 2.0 * scale[p:]
+        top = y[p:] - POST_HEIGHT * scale[p:]
+
+        signature = numpy.concatenate((track.dash_signature[dashes], track.post_signature[posts]))
+        x0 = numpy.concatenate((numpy.minimum(xa, xb) - tape / 2, x[p:] - half))
+        x1 = numpy.concatenate((numpy.maximum(xa, xb) + tape / 2, x[p:] + half))
+        y0 = numpy.concatenate((numpy.minimum(ya, yb) - tape / 4, top))
+        y1 = numpy.concatenate((numpy.maximum(ya, yb) + tape / 4, y[p:]))
+        # the Pixy only reports the part of a blob inside the image
+        inside = (x1 > 0) & (x0 < PIXY_WIDTH) & (y1 > 0) & (y0 < PIXY_HEIGHT)
+        x0 = numpy.maximum(x0[inside], 0)
+        x1 = numpy.minimum(x1[inside], PIXY_WIDTH - 1)
+        y0 = numpy.maximum(y0[inside], 0)
+        y1 = numpy.minimum(y1[inside], PIXY_HEIGHT - 1)
+        width = (x1 - x0).astype(int) + 1
+        height = (y1 - y0).astype(int) + 1
+        blobs = numpy.column_stack((signature[inside], (x0 + x1).astype(int) // 2, (y0 + y1).astype(int) // 2,
+                                    width, height))
+        return blobs[numpy.argsort(-(width * height), kind='mergesort')]
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        seen = self.view()[:max_blocks].tolist()
+        for i, (signature, x, y, width, height) in enumerate(seen):
+            block = blocks[i]
+            block.type = 0
+            block.signature = signature
+            block.x = x
+            block.y = y
+            block.width = width
+            block.height = height
+            block.angle = 0
+        return len(seen)
+
+class Result(object):
+    """What happened on a simulated run"""
+    def __init__(self):
+        self.time = 0.0
+        self.frames = 0
+        self.laps = []
+        self.distance = 0.0
+        self.line_losses = 0
+        self.lost_time = 0.0
+        self.off_track_time = 0.0
+        self.crashed = False
+        self.wall_time = 0.0
+
+    @property
+    def best_lap(self):
+        return min(self.laps) if self.laps else None
+
+    def report(self):
+        print "Simulated %.1fs (%d frames) in %.2fs, %.0fx real time" % \
+            (self.time, self.frames, self.wall_time, self.time / self.wall_time if self.wall_time else 0)
+        if self.laps:
+            print "Laps: %s (best %.2fs)" % (', '.join('%.2fs' % lap for lap in self.laps), self.best_lap)
+        else:
+            print "No laps completed (%.0fmm covered)" % self.distance
+        print "Line lost %d times for %.2fs in all; %.2fs off the track%s" % \
+            (self.line_losses, self.lost_time, self.off_track_time, ', then crashed' if self.crashed else '')
+
+def run(racer, track, laps=3, time_limit=300.0, crash_after=3.0, latency=COMMAND_LATENCY):
+    """
+    Drive a racer.Racer around the track until it has done laps laps,
+    time_limit simulated seconds have passed, or it has been off the
+    track for crash_after seconds in a row.  Whatever racer prints is
+    thrown away.
+    """
+    x, y, heading = track.start_pose()
+    robot = SimRobot(x, y, heading, latency)
+    racer.pixy = SimCamera(track, robot)
+    racer.motors = robot
+    return bench.quietly(_race, racer, track, robot, laps, time_limit, crash_after)
+
+def _race(racer, track, robot, laps, time_limit, crash_after):
+    racer.setup()
+    result = Result()
+    if racer.tracker:
+        # frames are captured and commands sent on simulated time, the
+        # commands latency after the frame
+        racer.tracker.clock = lambda: robot.now
+    s, lateral = track.locate(robot.x, robot.y)
+    travelled = 0.0
+    lap_start = 0.0
+    off_since = None
+    seeing = True
+    start = time.time()
+    while result.time < time_limit and len(result.laps) < laps:
+        robot.capture()
+        racer.loop()
+        robot.step(FRAME_TIME)
+        result.time += FRAME_TIME
+        result.frames += 1
+
+        if racer.scene.seeCenter():
+            seeing = True
+        else:
+            if seeing:
+                result.line_losses += 1
+            seeing = False
+            result.lost_time += FRAME_TIME
+
+        new_s, lateral = track.locate(robot.x, robot.y, s)
+        # unwrap across the start line
+        travelled += (new_s - s + track.length / 2) % track.length - track.length / 2
+        s = new_s
+        if travelled >= track.length * (len(result.laps) + 1):
+            result.laps.append(result.time - lap_start)
+            lap_start = result.time
+
+        if abs(lateral) > track.width / 2.0:
+            result.off_track_time += FRAME_TIME
+            if off_since is None:
+                off_since = result.time
+            elif result.time - off_since >= crash_after:
+                result.crashed = True
+                break
+        else:
+            off_since = None
+    result.distance = travelled
+    result.wall_time = time.time() - start
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Race racer.py round a simulated track')
+    parser.add_argument('--laps', type=int, default=3)
+    parser.add_argument('--time-limit', dest='time_limit', type=float, default=300.0,
+                        help='simulated seconds to give up after')
+    parser.add_argument('--straight', type=float, default=2000.0, help='mm')
+    parser.add_argument('--radius', type=float, default=800.0, help='mm, of the center line round the bends')
+    parser.add_argument('--width', type=float, default=600.0, help='mm between the edge lines')
+    parser.add_argument('--latency', type=float, default=COMMAND_LATENCY * 1000, metavar='MS',
+                        help='from a frame being captured to the command made from it reaching the wheels')
+    tuning.add_arguments(parser)
+    tracking.add_arguments(parser)
+    parser.add_argument('--lookahead', type=int, choices=[0, 1, 2], default=0,
+                        help="as racer.py's: fit a line (1) or curve (2) through the center blocks")
+    parser.add_argument('--recover', action='store_true', help="as racer.py's: search for the line when it is lost")
+    args = parser.parse_args()
+
+    import racer
+    robot = racer.Racer()
+    robot.tracker = tracking.from_args(args)
+    robot.lookahead = args.lookahead
+    robot.recover = args.recover
+    if args.gains:
+        robot.set_gains(tuning.load_gains(args.gains))
+    track = stadium(args.straight, args.radius, args.width)
+    print "Track: %.1fm round, %.0fmm wide" % (track.length / 1000, track.width)
+    run(robot, track, args.laps, args.time_limit, latency=args.latency / 1000.0).report()
+    if robot.tracker:
+        robot.tracker.report()
+    if robot.search:
+        robot.search.report()
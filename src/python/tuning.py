@@ -0,0 +1,229 @@
+"""
+Searches racer.py's steering and throttle gains against the closed-loop
+track simulator (tracksim.py), one candidate per CPU core at a time,
+writes every candidate ranked by score to a CSV table and the best ones
+to a gains file that racer.py --gains loads.
+
+    python tuning.py --search halving --candidates 81
+    python tuning.py --search grid --vary h_pgain,pan_pgain --steps 5
+    python racer.py --gains gains.json
+"""
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+
+GAINS_FILE = 'gains.json'
+RESULTS_FILE = 'tuning.csv'
+
+# name: (low, high, type) of every gain Racer.set_gains() takes
+PARAMETERS = {
+    'h_pgain': (0.1, 2.0, float),
+    'pid_ki': (0.0, 0.1, float),
+    'pid_kd': (0.0, 1.0, float),
+    'initThrottle': (0.4, 1.0, float),
+    'diffDriveStraight': (0.1, 0.8, float),
+    'diffDrivePosts': (0.1, 0.8, float),
+    'pan_pgain': (50, 800, int),
+    'pan_dgain': (0, 1000, int),
+}
+# loop() calls pid.setPoint() every frame, which clears the integrator and
+# derivator, so pid_ki and pid_kd only add to h_pgain; diffDrivePosts is not
+# used by loop() at all.  Searching them would only waste candidates.
+DEFAULT_VARY = ('h_pgain', 'initThrottle', 'diffDriveStraight', 'pan_pgain', 'pan_dgain')
+
+# scoring, in simulated seconds: lower is better
+CRASH_PENALTY = 60.0
+OFF_TRACK_PENALTY = 2.0     # per second off the track
+LOST_PENALTY = 1.0          # per second without the center line
+CRAWL_SPEED = 100.0         # mm/s charged for distance not covered
+
+def load_gains(path):
+    """The gains in a file written by save_gains()"""
+    with open(path) as f:
+        gains = json.load(f)['gains']
+    unknown = set(gains) - set(PARAMETERS)
+    if unknown:
+        raise ValueError("%s has unknown gains: %s" % (path, ', '.join(sorted(unknown))))
+    return dict((name, PARAMETERS[name][2](value)) for name, value in gains.items())
+
+def save_gains(path, gains, score=None, track=None):
+    with open(path, 'w') as f:
+        json.dump({'gains': gains, 'score': score, 'track': track,
+                   'updated': time.strftime('%Y-%m-%d %H:%M:%S')}, f, indent=2, sort_keys=True)
+
+def add_arguments(parser):
+    parser.add_argument('--gains', dest='gains', metavar='FILE',
+                        help='steering and throttle gains to use, as written by tuning.py')
+
+##### search
+
+def grid(base, vary, steps):
+    """Every combination of steps evenly spaced values of each varied gain"""
+    axes = []
+    for name in vary:
+        low, high, kind = PARAMETERS[name]
+        axes.append([kind(low + (high - low) * i / float(steps - 1)) for i in range(steps)])
+    for values in itertools.product(*axes):
+        gains = dict(base)
+        gains.update(zip(vary, values))
+        yield gains
+
+def sample(base, vary, count, rng):
+    """count candidates with each varied gain drawn uniformly from its range"""
+    for _ in range(count):
+        gains = dict(base)
+        for name in vary:
+            low, high, kind = PARAMETERS[name]
+            value = rng.uniform(low, high)
+            gains[name] = int(round(value)) if kind is int else value
+        yield gains
+
+##### scoring
+
+class Candidate(object):
+    """A set of gains and how it did on its longest run so far"""
+    def __init__(self, gains):
+        self.gains = gains
+        self.laps = 0
+        self.result = None
+        self.score = None
+
+def score(result, laps, length):
+    """Simulated seconds for laps laps, plus penalties"""
+    total = result.time + OFF_TRACK_PENALTY * result.off_track_time + LOST_PENALTY * result.lost_time
+    if len(result.laps) < laps:
+        total += CRASH_PENALTY + (laps * length - max(result.distance, 0.0)) / CRAWL_SPEED
+    return total
+
+# per worker process: the track, built once
+_track = None
+
+def _init_worker(shape):
+    global _track
+    import tracksim
+    _track = tracksim.stadium(*shape)
+
+def _evaluate(task):
+    """Run one candidate in a worker, on a fresh Racer so no state leaks between runs"""
+    index, gains, laps = task
+    import racer
+    import tracksim
+    robot = racer.Racer()
+    robot.set_gains(gains)
+    time_limit = laps * _track.length / CRAWL_SPEED
+    result = tracksim.run(robot, _track, laps, time_limit)
+    return index, result, score(result, laps, _track.length)
+
+def evaluate(pool, candidates, laps):
+    tasks = [(i, c.gains, laps) for i, c in enumerate(candidates)]
+    for i, result, value in pool.imap_unordered(_evaluate, tasks):
+        candidate = candidates[i]
+        candidate.laps, candidate.result, candidate.score = laps, result, value
+    return sorted(candidates, key=lambda c: c.score)
+
+def halving(pool, candidates, laps, max_laps, eta):
+    """
+    Successive halving: run everything for laps laps, keep the best
+    1/eta, and run those eta times as long, until one is left or they
+    have had max_laps
+    """
+    while True:
+        ranked = evaluate(pool, candidates, laps)
+        print "  %d candidates over %d lap%s, best %.2f" % (len(candidates), laps, 's' if laps > 1 else '', ranked[0].score)
+        if len(ranked) <= 1 or laps >= max_laps:
+            return
+        candidates = ranked[:int(math.ceil(len(ranked) / float(eta)))]
+        laps = min(laps * eta, max_laps)
+
+def ranked(candidates):
+    """Longest runs first, then by score"""
+    return sorted(candidates, key=lambda c: (-c.laps, c.score))
+
+def write_results(path, candidates, names):
+    import csv
+    with open(path, 'wb') as f:
+        out = csv.writer(f)
+        out.writerow(['rank', 'score', 'laps', 'completed', 'best_lap', 'line_losses', 'lost_time',
+                      'off_track_time', 'crashed'] + names)
+        for rank, c in enumerate(candidates, 1):
+            r = c.result
+            out.writerow([rank, '%.3f' % c.score, c.laps, len(r.laps), '%.2f' % r.best_lap if r.laps else '',
+                          r.line_losses, '%.2f' % r.lost_time, '%.2f' % r.off_track_time, int(r.crashed)] +
+                         [c.gains[name] for name in names])
+
+def show(candidates, names, count):
+    print "%4s %8s %5s %8s %6s  %s" % ('rank', 'score', 'laps', 'best', 'losses', '  '.join(names))
+    for rank, c in enumerate(candidates[:count], 1):
+        r = c.result
+        print "%4d %8.2f %2d/%-2d %8s %6d  %s" % (rank, c.score, len(r.laps), c.laps,
+                                                  '%.2f' % r.best_lap if r.laps else '-', r.line_losses,
+                                                  '  '.join('%*g' % (len(name), c.gains[name]) for name in names))
+
+if __name__ == '__main__':
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(description='Tune racer.py gains on the track simulator')
+    parser.add_argument('--search', choices=['grid', 'random', 'halving'], default='halving')
+    parser.add_argument('--vary', default=','.join(DEFAULT_VARY),
+                        help='comma separated gains to search (of %s); the rest keep their values' %
+                        ', '.join(sorted(PARAMETERS)))
+    parser.add_argument('--steps', type=int, default=3, help='values per gain for --search grid, at least 2')
+    parser.add_argument('--candidates', type=int, default=64, help='candidates for --search random and halving')
+    parser.add_argument('--laps', type=int, default=3, help='laps each candidate runs (the most, with halving)')
+    parser.add_argument('--eta', type=int, default=3, help='halving keeps the best 1/ETA each round')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='worker processes')
+    parser.add_argument('--straight', type=float, default=2000.0, help='mm')
+    parser.add_argument('--radius', type=float, default=800.0, help='mm, of the center line round the bends')
+    parser.add_argument('--width', type=float, default=600.0, help='mm between the edge lines')
+    parser.add_argument('--results', default=RESULTS_FILE, help='ranked table of every candidate')
+    parser.add_argument('--out', default=GAINS_FILE, help='where to write the best gains')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    vary = [name for name in args.vary.split(',') if name]
+    for name in vary:
+        if name not in PARAMETERS:
+            parser.error("unknown gain %s" % name)
+    if args.search == 'grid' and args.steps < 2:
+        parser.error("--steps must be at least 2, to take in both ends of each gain's range")
+    import racer
+    base = racer.Racer().gains()
+    if args.gains:
+        base.update(load_gains(args.gains))
+
+    if args.search == 'grid':
+        candidates = [Candidate(g) for g in grid(base, vary, args.steps)]
+    else:
+        candidates = [Candidate(g) for g in sample(base, vary, args.candidates, random.Random(args.seed))]
+    # the gains we started from compete too
+    candidates.insert(0, Candidate(base))
+    shape = (args.straight, args.radius, args.width)
+    print "Tuning %s over %d candidates on %d processes" % (', '.join(vary), len(candidates), args.jobs)
+
+    start = time.time()
+    pool = multiprocessing.Pool(args.jobs, _init_worker, (shape,))
+    try:
+        if args.search == 'halving':
+            halving(pool, candidates, 1, args.laps, args.eta)
+        else:
+            evaluate(pool, candidates, args.laps)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print "Done in %.1fs" % (time.time() - start)
+
+    names = sorted(PARAMETERS)
+    candidates = ranked(candidates)
+    write_results(args.results, candidates, names)
+    show(candidates, vary, 10)
+    best = candidates[0]
+    save_gains(args.out, best.gains, best.score,
+               {'straight': args.straight, 'radius': args.radius, 'width': args.width, 'laps': best.laps})
+    print "Best gains written to %s, all %d candidates to %s" % (args.out, len(candidates), args.results)
@@ -0,0 +1,371 @@
+"""
+Reads the camera in a process of its own, so USB calls and frame waits
+run on another core and never hold the control loop's GIL.  The vision
+process owns pixy; each frame's blocks go into a ring of slots in shared
+memory, each slot guarded by its own multiprocessing lock, and a byte
+down a pipe wakes the control process, which owns the motors.  Servo and
+brightness writes go the other way through the same shared memory.
+
+    python vision.py --seconds 5 --camera-cost 3 --control-cost 5
+"""
+import os
+import time
+import mmap
+import errno
+import fcntl
+import ctypes
+import select
+import signal
+import argparse
+import multiprocessing
+
+import framewait
+import acquisition
+import blockview
+
+# frames the ring holds; a slot is rewritten RING frames after it was
+# published, so a reader has that long to copy it
+RING = 4
+# longest a reader waits for a slot's lock before checking the vision
+# process is still there; copying a slot takes microseconds
+LOCK_TIMEOUT = 0.1
+
+# vision process states
+STARTING = 0
+READY = 1
+FAILED = 2
+STOPPED = 3
+
+BLOCK_SIZE = ctypes.sizeof(framewait.Blocks)
+
+def _layout(size):
+    """The shared memory layout for frames of up to size blocks"""
+    class Slot(ctypes.Structure):
+        _fields_ = [
+            ("seq", ctypes.c_uint),
+            ("count", ctypes.c_int),
+            ("stamp", ctypes.c_double),
+            ("blocks", framewait.Blocks * size),
+        ]
+
+    class Shared(ctypes.Structure):
+        _fields_ = [
+            ("seq", ctypes.c_uint),
+            ("running", ctypes.c_int),
+            ("state", ctypes.c_int),
+            ("captured", ctypes.c_uint),
+            # the last servo and brightness writes, -1 until there is one
+            ("pan", ctypes.c_int * 2),
+            ("brightness", ctypes.c_int),
+            ("camera_brightness", ctypes.c_int),
+            ("slots", Slot * RING),
+        ]
+    return Shared
+
+class VisionProcess(object):
+    """
+    Stands in for pixy in the control process.  It has the same
+    next_frame() as acquisition.FrameGrabber, and the pixy calls as
+    well, so it can also be read like a camera.  open_camera is called
+    in the vision process to open and initialise the real camera there,
+    as libpixyusb handles cannot cross a fork.
+    """
+    def __init__(self, open_camera, size, wait_mode='backoff', wait_budget=framewait.WAIT_BUDGET):
+        self.m_open = open_camera
+        self.m_size = size
+        self.m_waitMode = wait_mode
+        self.m_waitBudget = wait_budget
+        layout = _layout(size)
+        # anonymous mmaps are shared with processes forked from this one
+        self.m_memory = mmap.mmap(-1, ctypes.sizeof(layout))
+        self.m_shared = layout.from_buffer(self.m_memory)
+        self.m_shared.running = 1
+        self.m_shared.pan[0] = self.m_shared.pan[1] = -1
+        self.m_shared.brightness = -1
+        # the only ordering between the processes: taking and releasing a
+        # lock are full memory barriers, which plain stores to the mmap
+        # are not on the Pi's ARM cores
+        self.m_locks = [multiprocessing.Lock() for i in range(RING)]
+        self.m_wakeRead, self.m_wakeWrite = os.pipe()
+        for fd in (self.m_wakeRead, self.m_wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.m_blocks = self.BlockArray(size)
+        self.m_process = multiprocessing.Process(target=self._run, name='vision')
+        self.m_process.daemon = True
+        self.m_lastTaken = 0
+        self.taken = 0
+        self.dropped = 0
+        self.retries = 0
+
+    ##### the vision process
+
+    def _run(self):
+        # CTRL-C is for the control process, which stops us
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        shared = self.m_shared
+        try:
+            source = self.m_open()
+        except Exception, err:
+            print "Vision process: could not open the camera: %s" % err
+            shared.state = FAILED
+            return
+        shared.camera_brightness = source.pixy_cam_get_brightness()
+        shared.state = READY
+        waiter = framewait.FrameWaiter(source, self.m_waitMode, self.m_waitBudget)
+        blocks = source.BlockArray(self.m_size)
+        address = blockview.block_address(blocks)
+        running = lambda: shared.running
+        pan = [-1, -1]
+        brightness = -1
+        seq = 0
+        try:
+            while shared.running:
+                if not waiter.wait(running):
+                    break
+                # each is a single word, so compare them every frame rather
+                # than trust a flag written alongside to arrive in order
+                for channel in (0, 1):
+                    pos = shared.pan[channel]
+                    if pos >= 0 and pos != pan[channel]:
+                        source.pixy_rcs_set_position(channel, pos)
+                        pan[channel] = pos
+                if shared.brightness >= 0 and shared.brightness != brightness:
+                    brightness = shared.brightness
+                    source.pixy_cam_set_brightness(brightness)
+                count = source.pixy_get_blocks(self.m_size, blocks)
+                stamp = time.time()
+                seq += 1
+                slot = shared.slots[seq % RING]
+                with self.m_locks[seq % RING]:
+                    if count > 0:
+                        ctypes.memmove(ctypes.addressof(slot.blocks), address, count * BLOCK_SIZE)
+                    slot.count = count
+                    slot.stamp = stamp
+                    slot.seq = seq
+                # published after the release, so a reader that sees seq
+                # and then takes the lock sees the whole slot
+                shared.seq = seq
+                shared.captured += 1
+                try:
+                    os.write(self.m_wakeWrite, 'x')
+                except OSError:
+                    # the pipe is full of wake ups nobody has read yet
+                    pass
+        finally:
+            source.pixy_close()
+            shared.state = STOPPED
+            waiter.report()
+
+    ##### the control process
+
+    def start(self):
+        """Start the vision process and wait until it has the camera open"""
+        self.m_process.start()
+        while self.m_shared.state == STARTING and self.m_process.is_alive():
+            time.sleep(0.01)
+        if self.m_shared.state != READY:
+            self.m_process.join(1.0)
+            raise IOError("the vision process could not open the camera")
+        return self
+
+    def _alive(self):
+        return self.m_shared.state == READY and self.m_process.is_alive()
+
+    def _read(self, seq, blocks):
+        """
+        Copy frame seq into blocks.  Returns its (count, stamp), or None
+        if the vision process had already reused the slot or holds its
+        lock for too long.
+        """
+        lock = self.m_locks[seq % RING]
+        if not lock.acquire(True, LOCK_TIMEOUT):
+            return None
+        try:
+            slot = self.m_shared.slots[seq % RING]
+            if slot.seq != seq:
+                return None
+            count = slot.count
+            if count > 0:
+                ctypes.memmove(blockview.block_address(blocks), ctypes.addressof(slot.blocks), count * BLOCK_SIZE)
+            return count, slot.stamp
+        finally:
+            lock.release()
+
+    def _take(self, blocks):
+        """
+        Copy the newest frame into blocks and return (seq, count, stamp),
+        or None if the vision process has stopped or died
+        """
+        if not self._alive():
+            return None
+        # a slot is only missed if the vision process laps a reader that
+        # was descheduled mid-read, so a few tries is plenty
+        for i in range(RING):
+            seq = self.m_shared.seq
+            read = self._read(seq, blocks)
+            if read is not None:
+                break
+            self.retries += 1
+            if not self._alive():
+                return None
+        else:
+            return None
+        if self.m_lastTaken:
+            self.dropped += seq - self.m_lastTaken - 1
+        self.m_lastTaken = seq
+        self.taken += 1
+        return seq, read[0], read[1]
+
+    def next_frame(self, last_seq, running=None, timeout=0.1):
+        """
+        Return the newest frame with a sequence number above last_seq,
+        waiting for one if needed.  Returns None if running() goes false
+        or the vision process stops first.
+        """
+        shared = self.m_shared
+        while shared.seq <= last_seq:
+            if not self._alive() or (running is not None and not running()):
+                return None
+            try:
+                ready = select.select([self.m_wakeRead], [], [], timeout)[0]
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                continue
+            if ready:
+                try:
+                    os.read(self.m_wakeRead, 4096)
+                except OSError:
+                    pass
+        taken = self._take(self.m_blocks)
+        if taken is None:
+            return None
+        seq, count, stamp = taken
+        return acquisition.Frame(self.m_blocks, count, seq, stamp)
+
+    @property
+    def seq(self):
+        return self.m_shared.seq
+
+    def BlockArray(self, size):
+        return (framewait.Blocks * size)()
+
+    def pixy_init(self):
+        return 0 if self.m_shared.state == READY else -1
+
+    def pixy_error(self, code):
+        print "Camera error %d" % code
+
+    def pixy_blocks_are_new(self):
+        return 1 if self.m_shared.seq > self.m_lastTaken else 0
+
+    def pixy_get_blocks(self, max_blocks, blocks):
+        taken = self._take(blocks)
+        # like libpixyusb, a negative count when the camera has gone
+        return taken[1] if taken else -1
+
+    def pixy_rcs_set_position(self, channel, pos):
+        self.m_shared.pan[channel] = pos
+        return 0
+
+    def pixy_cam_set_brightness(self, brightness):
+        self.m_shared.brightness = brightness
+        return 0
+
+    def pixy_cam_get_brightness(self):
+        if self.m_shared.brightness >= 0:
+            return self.m_shared.brightness
+        return self.m_shared.camera_brightness
+
+    def stop(self):
+        self.m_shared.running = 0
+        if self.m_process.is_alive():
+            self.m_process.join(1.0)
+        if self.m_process.is_alive():
+            self.m_process.terminate()
+
+    def pixy_close(self):
+        self.stop()
+
+    def report(self):
+        unused = self.dropped + self.m_shared.seq - self.m_lastTaken
+        print "Vision process: %d frames captured, %d used, %d dropped, %d reads retried" % \
+            (self.m_shared.captured, self.taken, unused, self.retries)
+
+##### benchmark
+
+def _busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+if __name__ == '__main__':
+    import bench
+    import latency
+    import backends
+    import racer
+
+    parser = argparse.ArgumentParser(description='Compare the racer loop with the camera read in this '
+                                     'process, on a thread, and in a vision process')
+    parser.add_argument('--seconds', type=float, default=5.0, help='per mode')
+    parser.add_argument('--camera-cost', dest='camera_cost', type=float, default=3.0, metavar='MS',
+                        help='CPU time each camera read takes, standing in for USB')
+    parser.add_argument('--control-cost', dest='control_cost', type=float, default=5.0, metavar='MS',
+                        help='CPU time each loop spends besides the racer code (voice, prints)')
+    parser.add_argument('--modes', default='single,threaded,processes')
+    args = parser.parse_args()
+
+    epoch = time.time()
+
+    class StampedPixy(backends.SimPixy):
+        """SimPixy at 50Hz that costs CPU to read and stamps each block with its frame's birth"""
+        def pixy_get_blocks(self, max_blocks, blocks):
+            _busy(args.camera_cost / 1000.0)
+            count = backends.SimPixy.pixy_get_blocks(self, max_blocks, blocks)
+            born = int((self.m_start + self.m_served * self.m_period - epoch) * 1e6)
+            for i in range(count):
+                blocks[i].angle = born
+            return count
+
+    class TimedMotors(backends.NullMotors):
+        """Costs CPU per command, and times each new frame as its first command goes out"""
+        def __init__(self, robot):
+            self.robot = robot
+            self.last = None
+            self.commands = 0
+            self.latency = latency.Histogram()
+        def setSpeeds(self, left, right):
+            _busy(args.control_cost / 1000.0)
+            self.commands += 1
+            scene = self.robot.scene
+            if scene is None or scene.m_count <= 0:
+                return
+            born = scene.m_blocks[0].angle
+            if born != self.last:
+                self.last = born
+                self.latency.record((time.time() - epoch) * 1e6 - born)
+
+    print "%-10s %8s %8s %8s %8s %8s" % ('mode', 'loops/s', 'frames/s', 'p50 ms', 'p95 ms', 'max ms')
+    for mode in args.modes.split(','):
+        robot = racer.Racer()
+        motors = TimedMotors(robot)
+        robot.motors = motors
+        robot.camera_ready = True
+        if mode == 'processes':
+            robot.vision = bench.quietly(VisionProcess(StampedPixy, racer.BLOCK_BUFFER_SIZE).start)
+            robot.pixy = robot.vision
+        else:
+            robot.pixy = StampedPixy()
+            robot.threaded = mode == 'threaded'
+        bench.quietly(robot.setup)
+
+        def run():
+            end = time.time() + args.seconds
+            while time.time() < end and robot.loop():
+                pass
+            robot.close()
+        bench.quietly(run)
+        h = motors.latency
+        print "%-10s %8.1f %8.1f %8.2f %8.2f %8.2f" % (mode, motors.commands / args.seconds, h.count / args.seconds,
+                                                       h.percentile(50) / 1000.0, h.percentile(95) / 1000.0,
+                                                       h.max / 1000.0)
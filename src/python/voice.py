@@ -0,0 +1,191 @@
+import time
+import argparse
+import threading
+from collections import deque
+
+VOICE_SERVICE_URL = "http://10.9.6.2:8080"
+
+# seconds to wait for the voice server to accept a connection / answer
+CONNECT_TIMEOUT = 0.5
+READ_TIMEOUT = 2.0
+# phrases waiting longer than this are not worth saying any more
+MAX_AGE = 3.0
+# don't repeat the same phrase within this many seconds
+REPEAT_INTERVAL = 3.0
+QUEUE_SIZE = 8
+
+class VoiceClient(object):
+    """
+    Sends phrases to the text to speech web service from a background
+    thread over one kept-alive connection.  say() never blocks: the queue
+    is bounded and drops its oldest phrase when full, a phrase repeated
+    within REPEAT_INTERVAL is only said once, and phrases that waited
+    longer than max_age are dropped instead of being said late.
+    """
+    def __init__(self, url=VOICE_SERVICE_URL, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_age=MAX_AGE, repeat_interval=REPEAT_INTERVAL, queue_size=QUEUE_SIZE):
+        import requests
+        self.m_requests = requests
+        self.m_session = requests.Session()
+        self.m_url = url + '/say'
+        self.m_timeout = (connect_timeout, read_timeout)
+        self.m_maxAge = max_age
+        self.m_repeat = repeat_interval
+        self.m_queue = deque(maxlen=queue_size)
+        self.m_cond = threading.Condition()
+        self.m_lastSaying = None
+        self.m_lastTime = 0
+        self.m_running = True
+        self.sent = 0
+        self.failed = 0
+        self.repeats = 0
+        self.stale = 0
+        self.overflow = 0
+        self.m_thread = threading.Thread(target=self._run)
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def say(self, saying, urgent=False):
+        """
+        Queue a phrase.  An urgent one jumps the queue and drops whatever
+        was still waiting.
+        """
+        with self.m_cond:
+            if urgent:
+                self.overflow += len(self.m_queue)
+                self.m_queue.clear()
+            elif self.m_queue and self.m_queue[-1][0] == saying:
+                self.repeats += 1
+                return
+            elif len(self.m_queue) == self.m_queue.maxlen:
+                self.overflow += 1
+            self.m_queue.append((saying, time.time()))
+            self.m_cond.notify()
+
+    def _next(self):
+        with self.m_cond:
+            while not self.m_queue and self.m_running:
+                self.m_cond.wait(1.0)
+            if not self.m_running:
+                return None
+            return self.m_queue.popleft()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            saying, queued = item
+            now = time.time()
+            if now - queued > self.m_maxAge:
+                self.stale += 1
+                continue
+            if saying == self.m_lastSaying and now - self.m_lastTime < self.m_repeat:
+                self.repeats += 1
+                continue
+            self._send(saying)
+            self.m_lastSaying = saying
+            self.m_lastTime = now
+
+    def _send(self, saying):
+        if saying.startswith("SLEEP"):
+            params = {'sleep': saying.split()[1]}
+        else:
+            params = {'text': saying}
+        try:
+            response = self.m_session.get(self.m_url, params=params, timeout=self.m_timeout)
+            response.close()
+            self.sent += 1
+        except self.m_requests.RequestException, err:
+            self.failed += 1
+            print "Couldn't send saying to voice server", err
+
+    def close(self, wait=0):
+        """
+        Stop the sender, giving it up to wait seconds to finish the queue
+        """
+        deadline = time.time() + wait
+        while wait and self.m_queue and time.time() < deadline:
+            time.sleep(0.05)
+        with self.m_cond:
+            self.m_running = False
+            self.m_cond.notify()
+        # let a saying already on its way finish
+        if wait:
+            self.m_thread.join(max(deadline - time.time(), 0))
+
+    def report(self):
+        print "Voice: %d said, %d failed, %d repeats skipped, %d stale, %d dropped from a full queue" % \
+            (self.sent, self.failed, self.repeats, self.stale, self.overflow)
+
+class VoiceStandIn(object):
+    """
+    A local stand-in for the voice web service that just remembers what it
+    was asked to say, optionally taking delay seconds to answer.
+    """
+    def __init__(self, port=0, delay=0):
+        import BaseHTTPServer
+        import SocketServer
+        stand_in = self
+        self.said = []
+        self.delay = delay
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                time.sleep(stand_in.delay)
+                stand_in.said.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        # one thread per connection, so a client holding its connection
+        # open doesn't stop shutdown()
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # clients hanging up on a kept-alive connection
+                pass
+
+        self.m_server = Server(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.m_server.server_port
+        thread = threading.Thread(target=self.m_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.m_server.shutdown()
+        self.m_server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exercise the voice client against a local stand-in server')
+    parser.add_argument('--delay', type=float, default=0.2, help='seconds the stand-in takes to answer')
+    parser.add_argument('--phrases', type=int, default=200)
+    args = parser.parse_args()
+
+    stand_in = VoiceStandIn(delay=args.delay)
+    client = VoiceClient(stand_in.url)
+    worst = 0
+    for i in range(args.phrases):
+        start = time.time()
+        client.say(["Going left", "Going right", "Here goes"][i % 7 % 3])
+        worst = max(worst, time.time() - start)
+        time.sleep(0.02)
+    client.close(wait=MAX_AGE)
+    print "Slowest say() call: %.3fms" % (worst * 1000)
+    client.report()
+    print "Stand-in heard %d requests" % len(stand_in.said)
+    stand_in.close()
+
+    # nothing listening: say() must still return at once
+    client = VoiceClient('http://10.255.255.1:8080', connect_timeout=0.2)
+    start = time.time()
+    client.say("Hello?", urgent=True)
+    print "say() to an unreachable server took %.3fms" % ((time.time() - start) * 1000)
+    client.close(wait=1)
+    client.report()